@@ -1,20 +1,26 @@
-from flask import Flask, request, jsonify, abort, make_response, send_file
+from flask import Flask, Response, request, jsonify, abort, make_response, stream_with_context
 from werkzeug.exceptions import HTTPException
 import os
 import sys
+import math
 import time
 import rq
 import json
 import io
+import zipfile
+import hashlib
 from functools import wraps
 import base64
 import traceback
 import dotenv
 import redis
-from datetime import datetime
-from contextlib import contextmanager
+from rq.job import JobStatus
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
 
-from . import form_management
+from . import core, form_management, settings_store
+from .cache import TTLCache
+from .log_writer import LogWriter
 
 DOTENVFILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
 dotenv.load_dotenv(dotenv_path=DOTENVFILE)
@@ -23,76 +29,165 @@ ERROR_LOG = os.environ.get("ERROR_LOG")
 ACCESS_LOG = os.environ.get("ACCESS_LOG")
 SETTINGS_JOB_TIMEOUT = os.environ.get("SETTINGS_JOB_TIMEOUT", 600)
 REDIS_URL = os.environ["REDIS_URL"]
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 500))
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 60))
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 4096))
+RATE_LIMIT = int(os.environ.get("RATE_LIMIT", 20))
+RATE_LIMIT_WINDOW = int(os.environ.get("RATE_LIMIT_WINDOW", 60))
+MAX_RESULT_WAIT = int(os.environ.get("MAX_RESULT_WAIT", 60))
+FEEDBACK_CHUNK_SIZE = int(os.environ.get("FEEDBACK_CHUNK_SIZE", 1024 * 1024))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 1))
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 0))
+LOG_ROTATE_INTERVAL = float(os.environ.get("LOG_ROTATE_INTERVAL", 0))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 5))
+FAIR_SHARE_BY_SETTINGS = os.environ.get("FAIR_SHARE_BY_SETTINGS", "").lower() in ("1", "true", "yes")
+ADMISSION_MAX_QUEUED = int(os.environ.get("ADMISSION_MAX_QUEUED", 0))
+ADMISSION_MAX_WAIT = int(os.environ.get("ADMISSION_MAX_WAIT", 0))
+ADMISSION_MAX_MEMORY = float(os.environ.get("ADMISSION_MAX_MEMORY", 0.9))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 60))
+THROUGHPUT_WINDOW = int(os.environ.get("THROUGHPUT_WINDOW", 5))
+MIN_JOB_TIMEOUT = int(os.environ.get("MIN_JOB_TIMEOUT", 30))
+JOB_SETUP_TIME = int(os.environ.get("JOB_SETUP_TIME", 30))
+RUNTIME_PERCENTILE = float(os.environ.get("RUNTIME_PERCENTILE", 0))
+RUNTIME_HEADROOM = float(os.environ.get("RUNTIME_HEADROOM", 2))
+RUNTIME_MIN_SAMPLES = int(os.environ.get("RUNTIME_MIN_SAMPLES", 20))
 
 REDIS_CONNECTION = redis.Redis.from_url(REDIS_URL)
 
-app = Flask(__name__)
+API_KEY_CACHE = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+SETTINGS_OWNER_CACHE = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+_SCHEMA_CACHE = (None, {})
 
+_LOG_WRITER_OPTIONS = {
+    "queue_size": LOG_QUEUE_SIZE,
+    "flush_interval": LOG_FLUSH_INTERVAL,
+    "max_bytes": LOG_MAX_BYTES,
+    "rotate_interval": LOG_ROTATE_INTERVAL,
+    "backup_count": LOG_BACKUP_COUNT,
+}
+ACCESS_LOGGER = LogWriter(ACCESS_LOG, fallback=sys.stdout, **_LOG_WRITER_OPTIONS)
+ERROR_LOGGER = LogWriter(ERROR_LOG, fallback=sys.stderr, **_LOG_WRITER_OPTIONS)
 
-@contextmanager
-def _open_log(log, mode="a", fallback=sys.stdout):
-    if log:
-        with open(log, mode) as f:
-            yield f
-    else:
-        yield fallback
+_RATE_LIMIT_SCRIPT = REDIS_CONNECTION.register_script(core.RATE_LIMIT_SCRIPT)
+
+app = Flask(__name__)
+
+# batch test runs are dispatched to the batch queue by the fair-share scheduler (see autotest_server.scheduler)
+FAIR_SHARE_OWNERS_KEY = "autotest:fair_share:owners"
+FAIR_SHARE_PENDING_KEY = "autotest:fair_share:pending:{}"
+# ids of jobs waiting in each rq queue scored by test id (see autotest_server.scheduler)
+QUEUE_POSITION_KEY = "autotest:queue_position:{}"
+# durations of recently finished tests (written by the workers)
+DURATIONS_KEY = "autotest:durations"
+# number of tests finished in each minute (written by the workers)
+THROUGHPUT_KEY = "autotest:throughput:{}"
+# set to stop a test that is already running (checked by the workers)
+CANCEL_KEY = "autotest:cancel:{}"
+_QUEUE_PRIORITY = ("high", "low", "batch")
 
 
 @app.errorhandler(Exception)
 def _handle_error(e):
-    code = 500
-    error = str(e)
+    code, error, headers = 500, str(e), {}
     if isinstance(e, HTTPException):
         code = e.code
-    with _open_log(ERROR_LOG, fallback=sys.stderr) as f:
-        try:
-            api_key = request.headers.get("Api-Key")
-        except Exception:
-            api_key = "ERROR: user not found"
-        f.write(f"{datetime.now()}\n\tuser: {api_key}\n\t{traceback.format_exc()}\n")
-        f.flush()
+    elif isinstance(e, core.RequestError):
+        code, error, headers = e.code, e.message, e.headers
+    try:
+        api_key = request.headers.get("Api-Key")
+        url = request.url
+    except Exception:
+        api_key = "ERROR: user not found"
+        url = None
+    ERROR_LOGGER.write(core.error_record(url, api_key, code, traceback.format_exc()))
     if not app.debug:
-        error = str(e).replace(api_key, "[client-api-key]")
-    return jsonify(message=error), code
+        error = core.redact(error, api_key)
+    return jsonify(message=error), code, headers
+
+
+def _request_cost():
+    """
+    Return the number of requests that the current request counts as when rate limiting.
+    Running tests counts as one request per test run.
+    """
+    if request.endpoint == "run_tests":
+        return max(len((request.get_json(silent=True) or {}).get("test_data") or []), 1)
+    return 1
 
 
 def _check_rate_limit(api_key):
-    key = f"autotest:ratelimit:{api_key}:{datetime.now().minute}"
-    n_requests = REDIS_CONNECTION.get(key) or 0
-    user_limit = REDIS_CONNECTION.get(f"autotest:ratelimit:{api_key}:limit") or 20  # TODO: make default configurable
-    if int(n_requests) > int(user_limit):
-        abort(make_response(jsonify(message="Too many requests"), 429))
-    else:
-        with REDIS_CONNECTION.pipeline() as pipe:
-            pipe.incr(key)
-            pipe.expire(key, 59)
-            pipe.execute()
+    allowed = _RATE_LIMIT_SCRIPT(
+        keys=core.rate_limit_keys(api_key),
+        args=[RATE_LIMIT, RATE_LIMIT_WINDOW, _request_cost()],
+        client=REDIS_CONNECTION,
+    )
+    core.check_rate_limit(allowed, RATE_LIMIT_WINDOW)
 
 
 def _authorize_user():
     api_key = request.headers.get("Api-Key")
-    if api_key is None or (REDIS_CONNECTION.hgetall("autotest:user_credentials") or {}).get(api_key.encode()) is None:
-        abort(make_response(jsonify(message="Unauthorized"), 401))
+    core.check_api_key(api_key, api_key is not None and _api_key_exists(api_key))
     _check_rate_limit(api_key)
     return api_key
 
 
+def _api_key_exists(api_key):
+    """
+    Return True if api_key is a registered key. Only known keys are cached so that newly registered keys can be
+    used immediately.
+    """
+    if API_KEY_CACHE.get(api_key):
+        return True
+    exists = bool(REDIS_CONNECTION.hexists("autotest:user_credentials", api_key))
+    if exists:
+        API_KEY_CACHE.set(api_key, True)
+    return exists
+
+
+def _settings_owner(settings_id):
+    """
+    Return the api key of the user who owns the settings with id settings_id or None if the settings do not exist.
+    """
+    settings_id = str(settings_id)
+    owner = SETTINGS_OWNER_CACHE.get(settings_id)
+    if owner is not None:
+        return owner
+    (owner,) = settings_store.get_fields(REDIS_CONNECTION, settings_id, "user")
+    if owner is not None:
+        SETTINGS_OWNER_CACHE.set(settings_id, owner)
+    return owner
+
+
 def _authorize_settings(user, settings_id=None, **_kw):
     if settings_id:
-        settings_ = REDIS_CONNECTION.hget("autotest:settings", settings_id)
-        if settings_ is None:
-            abort(make_response(jsonify(message="Settings not found"), 404))
-        if json.loads(settings_).get("_user") != user:
-            abort(make_response(jsonify(message="Unauthorized"), 401))
+        core.check_settings_owner(_settings_owner(settings_id), user)
 
 
 def _authorize_tests(tests_id=None, settings_id=None, **_kw):
     if settings_id and tests_id:
-        test_setting = REDIS_CONNECTION.hget("autotest:tests", tests_id)
-        if test_setting is None:
-            abort(make_response(jsonify(message="Test not found"), 404))
-        if int(test_setting) != int(settings_id):
-            abort(make_response(jsonify(message="Unauthorized"), 401))
+        core.check_test_settings(REDIS_CONNECTION.hget("autotest:tests", tests_id), settings_id)
+
+
+def _get_schema():
+    """
+    Return a tuple containing the version of the current schema and the schema itself.
+
+    The parsed schema is cached in this process and is only reloaded when the version written by the autotester's
+    installer changes. The returned schema is shared so it should not be modified by the caller.
+    """
+    global _SCHEMA_CACHE
+    version = REDIS_CONNECTION.get("autotest:schema_version")
+    if version is not None and version.decode() == _SCHEMA_CACHE[0]:
+        return _SCHEMA_CACHE
+    schema_str = REDIS_CONNECTION.get("autotest:schema") or b"{}"
+    if version is None:
+        # the schema was written by an installer that did not write a version
+        version = hashlib.sha256(schema_str).hexdigest()
+    else:
+        version = version.decode()
+    _SCHEMA_CACHE = (version, json.loads(schema_str))
+    return _SCHEMA_CACHE
 
 
 def _update_settings(settings_id, user):
@@ -105,14 +200,15 @@ def _update_settings(settings_id, user):
             raise Exception(".. not allowed in uploaded file path")
         if os.path.isabs(filename):
             raise Exception("uploaded files cannot include an absolute path")
-    error = form_management.validate_against_schema(test_settings, schema(), test_files)
+    version, schema_ = _get_schema()
+    error = form_management.validate_against_schema(test_settings, schema_, test_files, version=version)
     if error:
         abort(make_response(jsonify(message=error), 422))
 
-    test_settings["_user"] = user
-    test_settings["_last_access"] = int(time.time())
-    test_settings["_env_status"] = "setup"
-    REDIS_CONNECTION.hset("autotest:settings", key=settings_id, value=json.dumps(test_settings))
+    settings_store.update(
+        REDIS_CONNECTION, settings_id, {"settings": json.dumps(test_settings), "user": user, "status": "setup"}
+    )
+    SETTINGS_OWNER_CACHE.pop(str(settings_id))
 
     queue = rq.Queue("settings", connection=REDIS_CONNECTION)
     data = {"user": user, "settings_id": settings_id, "test_settings": test_settings, "file_url": file_url}
@@ -125,15 +221,90 @@ def _update_settings(settings_id, user):
 
 
 def _get_jobs(test_ids, settings_id):
-    for id_ in test_ids:
-        test_setting = REDIS_CONNECTION.hget("autotest:tests", id_)
-        if test_setting is None or int(test_setting) != int(settings_id):
-            yield None
-        else:
-            try:
-                yield rq.job.Job.fetch(str(id_), connection=REDIS_CONNECTION)
-            except rq.exceptions.NoSuchJobError:
-                yield None
+    """
+    Yield lists of (test_id, job) tuples for each id in test_ids in chunks of at most BULK_CHUNK_SIZE.
+    The job is None if it does not exist or does not belong to settings_id. Each chunk costs a single HMGET
+    and a single pipelined fetch of the job data.
+    """
+    for chunk in core.chunks(test_ids, BULK_CHUNK_SIZE):
+        owned = core.owned(REDIS_CONNECTION.hmget("autotest:tests", chunk), settings_id)
+        jobs = iter(
+            rq.job.Job.fetch_many(
+                [str(id_) for id_, is_owned in zip(chunk, owned) if is_owned], connection=REDIS_CONNECTION
+            )
+        )
+        yield [(id_, next(jobs) if is_owned else None) for id_, is_owned in zip(chunk, owned)]
+
+
+def _fair_share_owner(user, settings_id):
+    """Return the owner of tests run by user for settings_id when sharing workers between batch test runs"""
+    return f"{user}:{settings_id}" if FAIR_SHARE_BY_SETTINGS else user
+
+
+def _cancel_job(job, pipeline):
+    """
+    Cancel job using pipeline. A worker that is already running the job stops it, and records it as canceled, when it
+    sees the cancel key (which is set whatever the job's status is in case a worker starts it in the meantime).
+    """
+    pipeline.set(CANCEL_KEY.format(job.id), 1, ex=max(job.timeout or 0, 3600))
+    job.set_status(JobStatus.CANCELED, pipeline=pipeline)
+    core.remove_from_registries(job, pipeline, REDIS_CONNECTION)
+    pipeline.zrem(QUEUE_POSITION_KEY.format(job.origin), job.id)
+    if job.origin == "batch" and job.kwargs.get("user") is not None:
+        owner = _fair_share_owner(job.kwargs["user"], job.kwargs["settings_id"])
+        pipeline.zrem(FAIR_SHARE_PENDING_KEY.format(owner), job.id)
+    rq.registry.CanceledJobRegistry(job.origin, connection=REDIS_CONNECTION).add(job, pipeline=pipeline)
+
+
+def _feedback_chunks(key, start, end):
+    """Yield bytes start to end (exclusive) of the feedback file stored at key in chunks of FEEDBACK_CHUNK_SIZE bytes"""
+    while start < end:
+        chunk = REDIS_CONNECTION.getrange(key, start, min(start + FEEDBACK_CHUNK_SIZE, end) - 1)
+        if not chunk:
+            # the file expired while it was being sent
+            return
+        yield chunk
+        start += len(chunk)
+
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable file object that zipfile writes to so that an archive can be sent while it is being written"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self):
+        """Return and clear everything that has been written since this was last called"""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_feedback_files(tests_id, feedback_ids):
+    """Yield a zip archive containing the feedback files of tests_id with feedback_ids and then delete the files"""
+    keys = [f"autotest:feedback_file:{tests_id}:{id_}" for id_ in feedback_ids]
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_STORED) as zip_file:
+        for id_, key in zip(feedback_ids, keys):
+            size = REDIS_CONNECTION.strlen(key)
+            if not size:
+                continue
+            info = zipfile.ZipInfo(str(id_), date_time=time.localtime()[:6])
+            with zip_file.open(info, "w", force_zip64=size > zipfile.ZIP64_LIMIT) as f:
+                for chunk in _feedback_chunks(key, 0, size):
+                    f.write(chunk)
+                    yield stream.pop()
+            yield stream.pop()
+    yield stream.pop()
+    REDIS_CONNECTION.delete(f"autotest:feedback_files:{tests_id}", *keys)
 
 
 def authorize(func):
@@ -141,23 +312,14 @@ def authorize(func):
     @wraps(func)
     def _f(*args, **kwargs):
         user = None
-        log_msg = None
         try:
             user = _authorize_user()
             _authorize_settings(**kwargs, user=user)
             _authorize_tests(**kwargs)
-            log_msg = f"AUTHORIZED\n\t{datetime.now()}\n\turl: {request.url}\n\tuser: {user}\n"
-        except HTTPException as e:
-            log_msg = (
-                f"UNAUTHORIZED\n\t{datetime.now()}\n\t"
-                f"url: {request.url}\n\tuser: {user}\n\tresponse: {e.response.response}\n"
-            )
+        except core.RequestError as e:
+            ACCESS_LOGGER.write(core.access_record(request.url, user, e))
             raise e
-        finally:
-            if log_msg:
-                with _open_log(ACCESS_LOG) as f:
-                    f.write(log_msg)
-                    f.flush()
+        ACCESS_LOGGER.write(core.access_record(request.url, user))
         return func(*args, **kwargs, user=user)
 
     return _f
@@ -182,31 +344,33 @@ def reset_credentials(user):
     credentials = request.json.get("credentials")
     data = {"auth_type": auth_type, "credentials": credentials}
     REDIS_CONNECTION.hset("autotest:user_credentials", key=user, value=json.dumps(data))
+    API_KEY_CACHE.pop(user)
     return jsonify(success=True)
 
 
 @app.route("/schema", methods=["GET"])
 @authorize
 def schema(**_kwargs):
-    return json.loads(REDIS_CONNECTION.get("autotest:schema") or "{}")
+    version, schema_ = _get_schema()
+    response = jsonify(schema_)
+    response.set_etag(version)
+    return response.make_conditional(request)
 
 
 @app.route("/settings/<settings_id>", methods=["GET"])
 @authorize
 def settings(settings_id, **_kw):
-    settings_ = json.loads(REDIS_CONNECTION.hget("autotest:settings", key=settings_id) or "{}")
-    if settings_.get("_error"):
-        raise Exception(f"Settings Error: {settings_['_error']}")
-    return {k: v for k, v in settings_.items() if not k.startswith("_")}
+    settings_, error = settings_store.get_fields(REDIS_CONNECTION, settings_id, "settings", "error")
+    if error:
+        raise Exception(f"Settings Error: {error}")
+    return {k: v for k, v in json.loads(settings_ or "{}").items() if not k.startswith("_")}
 
 
 @app.route("/settings", methods=["POST"])
 @authorize
 def create_settings(user):
     settings_id = REDIS_CONNECTION.incr("autotest:settings_id")
-    REDIS_CONNECTION.hset(
-        "autotest:settings", key=settings_id, value=json.dumps({"_user": user, "_env_status": "setup"})
-    )
+    settings_store.update(REDIS_CONNECTION, settings_id, {"user": user, "status": "setup"})
     _update_settings(settings_id, user)
     return {"settings_id": settings_id}
 
@@ -218,87 +382,287 @@ def update_settings(settings_id, user):
     return {"settings_id": settings_id}
 
 
+def _throughput():
+    """Return the number of tests finished per second over the last THROUGHPUT_WINDOW minutes"""
+    minute = int(time.time()) // 60
+    counts = REDIS_CONNECTION.mget([THROUGHPUT_KEY.format(minute - i) for i in range(1, THROUGHPUT_WINDOW + 1)])
+    return sum(int(count or 0) for count in counts) / (THROUGHPUT_WINDOW * 60)
+
+
+def _estimate_wait(queue_name, owner, test_runtime):
+    """
+    Return the total number of tests waiting to run and the estimated number of seconds before a new test in
+    queue_name owned by owner starts (None if there are no workers for that queue).
+
+    Tests ahead of the new test are those in queues that workers select from first, the owner's own pending batch
+    tests and (for batch tests) one test for each other owner with batch tests pending. The wait is estimated from the
+    recent throughput or, if no tests finished recently, from test_runtime (the estimated runtime of one test).
+    """
+    owners = [o.decode() for o in REDIS_CONNECTION.smembers(FAIR_SHARE_OWNERS_KEY)]
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        for name in _QUEUE_PRIORITY:
+            pipe.llen(rq.Queue(name, connection=REDIS_CONNECTION).key)
+        for owner_ in owners:
+            pipe.zcard(FAIR_SHARE_PENDING_KEY.format(owner_))
+        queued = pipe.execute()
+    workers = rq.Worker.count(queue=rq.Queue(queue_name, connection=REDIS_CONNECTION))
+    pending = dict(zip(owners, queued[len(_QUEUE_PRIORITY) :]))  # noqa: E203
+    ahead = sum(queued[: _QUEUE_PRIORITY.index(queue_name) + 1])
+    if queue_name == "batch":
+        ahead += pending.get(owner, 0) + sum(1 for owner_, n in pending.items() if n and owner_ != owner)
+    total = sum(queued)
+    if not workers:
+        return total, None
+    throughput = _throughput()
+    if throughput:
+        return total, ahead / throughput
+    return total, ahead * test_runtime / workers
+
+
+def _reject(status_code, message, retry_after):
+    response = make_response(jsonify(message=message), status_code)
+    response.headers["Retry-After"] = str(max(1, int(retry_after)))
+    abort(response)
+
+
+def _admit(queue_name, owner, n_tests, test_runtime):
+    """
+    Reject a request to run n_tests tests with 503 if redis is running out of memory or with 429 if running them
+    would exceed the maximum number of waiting tests or the maximum estimated wait. Otherwise, return the estimated
+    number of seconds before the first of the tests starts (None if it can't be estimated).
+    """
+    if ADMISSION_MAX_MEMORY:
+        try:
+            memory = REDIS_CONNECTION.info("memory")
+        except redis.ResponseError:  # some hosted redis services don't allow INFO
+            memory = {}
+        if memory.get("maxmemory") and memory["used_memory"] >= memory["maxmemory"] * ADMISSION_MAX_MEMORY:
+            _reject(503, "The autotester is overloaded, please try again later", ADMISSION_RETRY_AFTER)
+    queued, wait = _estimate_wait(queue_name, owner, test_runtime)
+    if ADMISSION_MAX_QUEUED and queued + n_tests > ADMISSION_MAX_QUEUED:
+        throughput = _throughput()
+        retry_after = (queued + n_tests - ADMISSION_MAX_QUEUED) / throughput if throughput else ADMISSION_RETRY_AFTER
+        _reject(429, f"Too many tests waiting to run ({queued}), please try again later", retry_after)
+    if ADMISSION_MAX_WAIT:
+        if wait is None:
+            _reject(503, "No workers are available to run tests, please try again later", ADMISSION_RETRY_AFTER)
+        if wait > ADMISSION_MAX_WAIT:
+            _reject(429, f"Tests would wait about {int(wait)} seconds to start", wait - ADMISSION_MAX_WAIT)
+    return wait
+
+
+def _longest_timeout(test_settings, categories):
+    """Return the longest timeout of the tests in test_settings that are run for any of categories"""
+    categories = set(categories)
+    return max(
+        (
+            data.get("timeout") or 0
+            for tester in test_settings.get("testers", [])
+            for data in tester.get("test_data", [])
+            if categories & set(data.get("category", []))
+        ),
+        default=0,
+    )
+
+
+def _job_timeout(settings_id, timeout, longest_timeout=0):
+    """
+    Return the timeout for a job that runs tests with a total timeout of timeout seconds for settings_id, the longest
+    of which have a timeout of longest_timeout seconds.
+
+    This is 1.5 times timeout or, if RUNTIME_PERCENTILE is set and enough runtimes have been recorded for the
+    settings, RUNTIME_HEADROOM times that percentile of the recorded runtimes if that is shorter. It is never less
+    than JOB_SETUP_TIME seconds more than longest_timeout, so that the files can be set up and the longest tests can
+    run to their own timeout, or less than MIN_JOB_TIMEOUT.
+    """
+    job_timeout = timeout * 1.5
+    if RUNTIME_PERCENTILE and timeout:
+        fractions = sorted(settings_store.runtime_fractions(REDIS_CONNECTION, settings_id))
+        if fractions and len(fractions) >= RUNTIME_MIN_SAMPLES:
+            percentile = fractions[max(0, math.ceil(RUNTIME_PERCENTILE * len(fractions)) - 1)]
+            job_timeout = min(job_timeout, percentile * timeout * RUNTIME_HEADROOM)
+    return max(int(job_timeout), longest_timeout + JOB_SETUP_TIME, MIN_JOB_TIMEOUT)
+
+
 @app.route("/settings/<settings_id>/test", methods=["PUT"])
 @authorize
 def run_tests(settings_id, user):
-    test_settings = json.loads(REDIS_CONNECTION.hget("autotest:settings", key=settings_id))
-    env_status = test_settings.get("_env_status")
+    test_settings, env_status, settings_error = settings_store.get_fields(
+        REDIS_CONNECTION, settings_id, "settings", "status", "error"
+    )
     if env_status == "setup":
         raise Exception("Setting up test environment. Please try again later.")
     elif env_status == "error":
         msg = "Settings Error"
-        settings_error = test_settings.get("_error", "")
         if settings_error:
             msg += f": {settings_error}"
         raise Exception(msg)
 
+    test_settings = json.loads(test_settings)
     test_data = request.json["test_data"]
     categories = request.json["categories"]
     high_priority = request.json.get("request_high_priority")
+    callback_url = request.json.get("callback_url")
+    if callback_url is not None and urlparse(callback_url).scheme not in ("http", "https"):
+        abort(make_response(jsonify(message="callback_url must be an http or https url"), 422))
     queue_name = "batch" if len(test_data) > 1 else ("high" if high_priority else "low")
     queue = rq.Queue(queue_name, connection=REDIS_CONNECTION)
-
-    timeout = 0
-
-    for settings_ in test_settings["testers"]:
-        for data in settings_["test_data"]:
-            timeout += data["timeout"]
-
-    ids = []
-    for data in test_data:
-        url = data["file_url"]
-        test_env_vars = data.get("env_vars", {})
-        id_ = REDIS_CONNECTION.incr("autotest:tests_id")
-        REDIS_CONNECTION.hset("autotest:tests", key=id_, value=settings_id)
-        ids.append(id_)
-        data = {
+    owner = _fair_share_owner(user, settings_id)
+
+    # only the tests in the requested categories are run
+    timeout = settings_store.category_timeout(test_settings, categories)
+    wait = _admit(queue_name, owner, len(test_data), timeout)
+
+    # reserve a block of ids and enqueue every job in one pipeline so that the number of round trips to redis
+    # doesn't grow with the size of the batch
+    last_id = REDIS_CONNECTION.incrby("autotest:tests_id", len(test_data))
+    ids = list(range(last_id - len(test_data) + 1, last_id + 1))
+    job_options = {"timeout": _job_timeout(settings_id, timeout, _longest_timeout(test_settings, categories))}
+    job_options.update(failure_ttl=3600, result_ttl=3600)  # TODO: make this configurable
+    job_kwargs = [
+        {
             "settings_id": settings_id,
             "test_id": id_,
-            "files_url": url,
+            "files_url": data["file_url"],
             "categories": categories,
             "user": user,
-            "test_env_vars": test_env_vars,
+            "test_env_vars": data.get("env_vars", {}),
+            "callback_url": callback_url,
         }
-        queue.enqueue_call(
-            "autotest_server.run_test",
-            kwargs=data,
-            job_id=str(id_),
-            timeout=int(timeout * 1.5),
-            failure_ttl=3600,
-            result_ttl=3600,
-        )  # TODO: make this configurable
-
-    return {"test_ids": ids}
+        for id_, data in zip(ids, test_data)
+    ]
+    with REDIS_CONNECTION.pipeline() as pipe:
+        if ids:
+            pipe.hset("autotest:tests", mapping={id_: settings_id for id_ in ids})
+        if queue_name == "batch":
+            # jobs are saved as queued but are left for the fair-share scheduler to add to the queue so that batches
+            # from different owners are interleaved
+            for id_, kwargs in zip(ids, job_kwargs):
+                job = queue.create_job("autotest_server.run_test", kwargs=kwargs, job_id=str(id_), **job_options)
+                job.save(pipeline=pipe)
+            pipe.zadd(FAIR_SHARE_PENDING_KEY.format(owner), {id_: id_ for id_ in ids})
+            pipe.sadd(FAIR_SHARE_OWNERS_KEY, owner)
+        else:
+            job_datas = [
+                rq.Queue.prepare_data("autotest_server.run_test", kwargs=kwargs, job_id=str(id_), **job_options)
+                for id_, kwargs in zip(ids, job_kwargs)
+            ]
+            queue.enqueue_many(job_datas, pipeline=pipe)
+            if ids:
+                pipe.zadd(QUEUE_POSITION_KEY.format(queue_name), {id_: id_ for id_ in ids})
+        pipe.execute()
+
+    if wait is None:
+        return {"test_ids": ids, "estimated_wait": None, "estimated_start": None}
+    return {
+        "test_ids": ids,
+        "estimated_wait": int(wait),
+        "estimated_start": (datetime.now(timezone.utc) + timedelta(seconds=int(wait))).isoformat(timespec="seconds"),
+    }
 
 
 @app.route("/settings/<settings_id>/test/<tests_id>", methods=["GET"])
 @authorize
 def get_result(settings_id, tests_id, **_kw):
     job = rq.job.Job.fetch(tests_id, connection=REDIS_CONNECTION)
-    job_status = job.get_status()
-    result = {"status": job_status}
-    if job_status == "finished":
+    wait = min(request.args.get("wait", 0, type=int), MAX_RESULT_WAIT)
+    if wait > 0 and job.get_status(refresh=False) in core.JOB_WAITING_STATUSES:
+        # rq writes a result to the job's result stream in the same transaction that marks it as finished or failed
+        # so block on that stream until the job is done or the wait times out.
+        if job.latest_result(timeout=wait) is None:
+            # don't clean up the job yet so that the client can wait for it again
+            return {"status": job.get_status()}
+        job.get_status(refresh=True)
+    test_result = None
+    if job.get_status(refresh=False) == JobStatus.FINISHED:
         test_result = REDIS_CONNECTION.get(f"autotest:test_result:{tests_id}")
-        try:
-            result.update(json.loads(test_result))
-        except json.JSONDecodeError:
-            result.update({"error": f"invalid json: {test_result}"})
-    elif job_status == "failed":
-        result.update({"error": str(job.exc_info)})
+    result = core.job_result(job, test_result)
     job.delete()
-    REDIS_CONNECTION.delete(f"autotest:test_result:{tests_id}")
+    REDIS_CONNECTION.delete(*core.result_keys(tests_id))
     return result
 
 
+@app.route("/settings/<settings_id>/test/<tests_id>/stream", methods=["GET"])
+@authorize
+def get_result_stream(settings_id, tests_id, **_kw):
+    cursor = request.args.get("cursor", "0-0")
+    wait = min(request.args.get("wait", 0, type=int), MAX_RESULT_WAIT)
+    entries = REDIS_CONNECTION.xread({f"autotest:test_stream:{tests_id}": cursor}, block=wait * 1000 or None)
+    return core.stream_response(entries, cursor)
+
+
+@app.route("/settings/<settings_id>/tests/results", methods=["GET"])
+@authorize
+def get_results(settings_id, **_kw):
+    test_ids = request.json["test_ids"]
+    result = {}
+    for chunk in _get_jobs(test_ids, settings_id):
+        finished = core.finished(chunk)
+        test_results = {}
+        if finished:
+            keys = [core.result_keys(id_)[0] for id_ in finished]
+            test_results = dict(zip(finished, REDIS_CONNECTION.mget(keys)))
+        with REDIS_CONNECTION.pipeline() as pipe:
+            for id_, job in chunk:
+                if job is None:
+                    result[id_] = None
+                    continue
+                result[id_] = core.job_result(job, test_results.get(id_))
+                # unlike get_result, only clean up jobs that are done since a batch usually has some still in progress
+                if job.get_status(refresh=False) in core.JOB_DONE_STATUSES:
+                    core.delete_job(job, pipe, REDIS_CONNECTION)
+                    pipe.delete(*core.result_keys(id_))
+            pipe.execute()
+    return result
+
+
+@app.route("/settings/<settings_id>/test/<tests_id>/feedback", methods=["GET"])
+@authorize
+def get_feedback_files(settings_id, tests_id, **_kw):
+    """
+    Stream all feedback files for a test as a single zip archive. Each feedback file is stored in the archive
+    (still gzip compressed) with its feedback id as its name. The files are deleted once the whole archive is sent.
+    """
+    feedback_ids = sorted(int(id_) for id_ in REDIS_CONNECTION.smembers(f"autotest:feedback_files:{tests_id}"))
+    if not feedback_ids:
+        abort(make_response(jsonify(message="No feedback files exist"), 404))
+    return Response(
+        stream_with_context(_zip_feedback_files(tests_id, feedback_ids)),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={tests_id}.zip"},
+    )
+
+
 @app.route("/settings/<settings_id>/test/<tests_id>/feedback/<feedback_id>", methods=["GET"])
 @authorize
 def get_feedback_file(settings_id, tests_id, feedback_id, **_kw):
+    """
+    Stream a single feedback file. A single byte range can be requested with a Range header. The file is deleted
+    once a response that includes its last byte is sent.
+    """
     key = f"autotest:feedback_file:{tests_id}:{feedback_id}"
-    data = REDIS_CONNECTION.get(key)
-    if data is None:
+    size = REDIS_CONNECTION.strlen(key)
+    if not size:
         abort(make_response(jsonify(message="File doesn't exist"), 404))
-    REDIS_CONNECTION.delete(key)
-    return send_file(io.BytesIO(data), mimetype="application/gzip", as_attachment=True, download_name=str(feedback_id))
+    start, end, status = 0, size, 200
+    headers = {"Accept-Ranges": "bytes", "Content-Disposition": f"attachment; filename={feedback_id}"}
+    if request.range is not None and len(request.range.ranges) == 1:
+        range_ = request.range.range_for_length(size)
+        if range_ is None:
+            response = make_response(jsonify(message="Requested range not satisfiable"), 416)
+            response.headers["Content-Range"] = f"bytes */{size}"
+            abort(response)
+        (start, end), status = range_, 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+
+    def generate():
+        yield from _feedback_chunks(key, start, end)
+        if end == size:
+            REDIS_CONNECTION.delete(key)
+            REDIS_CONNECTION.srem(f"autotest:feedback_files:{tests_id}", feedback_id)
+
+    return Response(stream_with_context(generate()), status=status, mimetype="application/gzip", headers=headers)
 
 
 @app.route("/settings/<settings_id>/tests/status", methods=["GET"])
@@ -306,8 +670,76 @@ def get_feedback_file(settings_id, tests_id, feedback_id, **_kw):
 def get_statuses(settings_id, **_kw):
     test_ids = request.json["test_ids"]
     result = {}
-    for id_, job in zip(test_ids, _get_jobs(test_ids, settings_id)):
-        result[id_] = job if job is None else job.get_status()
+    for chunk in _get_jobs(test_ids, settings_id):
+        finished = core.finished(chunk)
+        cancelled = []
+        if finished:
+            cancelled = core.cancelled(finished, REDIS_CONNECTION.mget([CANCEL_KEY.format(id_) for id_ in finished]))
+        result.update(core.statuses(chunk, cancelled))
+    if request.json.get("summary"):
+        return core.status_summary(result)
+    return result
+
+
+def _queue_snapshot():
+    """
+    Return the number of jobs waiting in each queue, the number of workers for each queue, the number of batch jobs
+    waiting to be dispatched for each fair-share owner and the average duration of recently finished tests (None if
+    no durations have been recorded).
+    """
+    owners = [o.decode() for o in REDIS_CONNECTION.smembers(FAIR_SHARE_OWNERS_KEY)]
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        for name in _QUEUE_PRIORITY:
+            pipe.zcard(QUEUE_POSITION_KEY.format(name))
+        for name in _QUEUE_PRIORITY:
+            pipe.scard(rq.worker_registration.WORKERS_BY_QUEUE_KEY % name)
+        for owner in owners:
+            pipe.zcard(FAIR_SHARE_PENDING_KEY.format(owner))
+        pipe.lrange(DURATIONS_KEY, 0, -1)
+        values = iter(pipe.execute())
+    lengths = {name: next(values) for name in _QUEUE_PRIORITY}
+    workers = {name: next(values) for name in _QUEUE_PRIORITY}
+    pending = {owner: next(values) for owner in owners}
+    durations = next(values)
+    average = sum(float(d) for d in durations) / len(durations) if durations else None
+    return lengths, workers, pending, average
+
+
+@app.route("/settings/<settings_id>/tests/position", methods=["GET"])
+@authorize
+def get_positions(settings_id, **_kw):
+    """
+    Return the position of each queued test in its queue (the number of tests that will start before it), the number
+    of workers for that queue and the estimated number of seconds before the test starts.
+
+    Positions are looked up by rank in sorted sets of waiting tests rather than by scanning the queues. Batch tests
+    that the fair-share scheduler hasn't dispatched yet are positioned after the tests already in the batch queue,
+    the owner's earlier tests and as many tests from each other owner. This is only an estimate since the order the
+    scheduler dispatches them in depends on the owners' weights, the tests' timeouts and how long they have waited.
+    """
+    test_ids = request.json["test_ids"]
+    lengths, workers, pending, average = _queue_snapshot()
+    result = {}
+    for chunk in _get_jobs(test_ids, settings_id):
+        queued = [(i, job) for i, job in chunk if job is not None and job.get_status(refresh=False) == JobStatus.QUEUED]
+        owners = [_fair_share_owner(job.kwargs.get("user"), job.kwargs.get("settings_id")) for _, job in queued]
+        with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+            for (_, job), owner in zip(queued, owners):
+                pipe.zrank(QUEUE_POSITION_KEY.format(job.origin), job.id)
+                pipe.zrank(FAIR_SHARE_PENDING_KEY.format(owner), job.id)
+            ranks = pipe.execute()
+        for id_, job in chunk:
+            result[id_] = job if job is None else {"status": job.get_status(refresh=False)}
+        for (id_, job), owner, position, pending_rank in zip(queued, owners, ranks[::2], ranks[1::2]):
+            if position is None and pending_rank is not None:
+                others = sum(min(n, pending_rank + 1) for owner_, n in pending.items() if owner_ != owner)
+                position = lengths.get(job.origin, 0) + pending_rank + others
+            queue_workers = workers.get(job.origin, 0)
+            eta = None
+            if position is not None and queue_workers and average is not None:
+                higher = _QUEUE_PRIORITY[: _QUEUE_PRIORITY.index(job.origin)] if job.origin in _QUEUE_PRIORITY else ()
+                eta = int((sum(lengths[q] for q in higher) + position) * average / queue_workers)
+            result[id_].update(queue=job.origin, position=position, workers=queue_workers, eta=eta)
     return result
 
 
@@ -315,9 +747,12 @@ def get_statuses(settings_id, **_kw):
 @authorize
 def cancel_tests(settings_id, **_kw):
     test_ids = request.json["test_ids"]
-    result = {}
-    for id_, job in zip(test_ids, _get_jobs(test_ids, settings_id)):
-        result[id_] = job if job is None else job.cancel()
+    for chunk in _get_jobs(test_ids, settings_id):
+        with REDIS_CONNECTION.pipeline() as pipe:
+            for _, job in chunk:
+                if job is not None and job.get_status(refresh=False) != JobStatus.CANCELED:
+                    _cancel_job(job, pipe)
+            pipe.execute()
     return jsonify(success=True)
 
 
@@ -0,0 +1,361 @@
+"""
+ASGI serving mode for the API.
+
+The endpoints that clients poll (test results, statuses and result streams) are served natively using an asyncio
+redis client so that requests that are waiting for tests to finish don't each hold a thread or a redis connection.
+All other routes are delegated to the flask app, which is run in a thread pool.
+
+This can be run with any ASGI server. For example, using uvicorn:
+
+    uvicorn --app-dir markus-autotesting/client --host localhost --port 5000 autotest_client.asgi:app
+"""
+
+import os
+import re
+import json
+import asyncio
+import traceback
+from urllib.parse import parse_qs
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio
+import rq
+from a2wsgi import WSGIMiddleware
+from rq.job import JobStatus
+from rq.results import Result
+
+import autotest_client as api
+from autotest_client import core, settings_store
+
+WSGI_WORKERS = int(os.environ.get("WSGI_WORKERS", 10))
+ASYNC_REDIS_MAX_CONNECTIONS = int(os.environ.get("ASYNC_REDIS_MAX_CONNECTIONS", 50))
+
+ASYNC_REDIS_CONNECTION = redis.asyncio.Redis(
+    connection_pool=redis.asyncio.BlockingConnectionPool.from_url(
+        api.REDIS_URL, max_connections=ASYNC_REDIS_MAX_CONNECTIONS
+    )
+)
+
+# registered once, each call passes the connection to run the script with
+_RATE_LIMIT_SCRIPT = ASYNC_REDIS_CONNECTION.register_script(core.RATE_LIMIT_SCRIPT)
+
+_flask_app = WSGIMiddleware(api.app, workers=WSGI_WORKERS)
+
+
+class _Request:
+    """The parts of an ASGI http request used by the natively served endpoints"""
+
+    def __init__(self, scope: Dict, body: bytes) -> None:
+        self.headers = {k.decode("latin1").lower(): v.decode("latin1") for k, v in scope["headers"]}
+        self.args = {k: v[-1] for k, v in parse_qs(scope["query_string"].decode("latin1")).items()}
+        host = self.headers.get("host", "localhost")
+        query = f"?{scope['query_string'].decode('latin1')}" if scope["query_string"] else ""
+        self.url = f"{scope.get('scheme', 'http')}://{host}{scope.get('root_path', '')}{scope['path']}{query}"
+        self.body = body
+
+    @property
+    def json(self) -> Dict:
+        try:
+            return json.loads(self.body)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            raise core.RequestError(400, "Failed to decode JSON object")
+
+    def int_arg(self, name: str, default: int = 0) -> int:
+        """Return the query argument name as an integer or default if it is missing or not an integer"""
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+
+def _stream_id(id_: str) -> Tuple[int, ...]:
+    """Return a redis stream entry id as a tuple that can be compared to other ids"""
+    return tuple(int(part) for part in id_.split("-"))
+
+
+class _StreamWaiter:
+    """
+    Wait for new entries to be added to redis streams. All waiting requests in this process share a single blocking
+    XREAD so that each waiting request does not hold its own redis connection.
+    """
+
+    def __init__(self, block: int = 1000) -> None:
+        self.block = block
+        self._waiters: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        self._task = None
+
+    async def wait(self, key: str, cursor: str, timeout: float) -> bool:
+        """
+        Wait up to timeout seconds for an entry to be added to the stream at key after the entry with id cursor.
+        Return True if there is such an entry.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, []).append((cursor, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._read())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            # remove this waiter if it timed out (waiters that are notified are removed by _read)
+            waiters = [w for w in self._waiters.get(key, []) if w[1] is not future]
+            if waiters:
+                self._waiters[key] = waiters
+            else:
+                self._waiters.pop(key, None)
+
+    async def _read(self) -> None:
+        while self._waiters:
+            streams = {key: min((c for c, _ in waiters), key=_stream_id) for key, waiters in self._waiters.items()}
+            try:
+                response = await ASYNC_REDIS_CONNECTION.xread(streams, block=self.block)
+            except Exception as e:
+                for waiters in self._waiters.values():
+                    for _, future in waiters:
+                        if not future.done():
+                            future.set_exception(e)
+                self._waiters.clear()
+                return
+            for key, entries in response or []:
+                key = key.decode()
+                last = _stream_id(entries[-1][0].decode())
+                waiting = []
+                for cursor, future in self._waiters.get(key, []):
+                    if _stream_id(cursor) < last:
+                        if not future.done():
+                            future.set_result(True)
+                    else:
+                        waiting.append((cursor, future))
+                if waiting:
+                    self._waiters[key] = waiting
+                else:
+                    self._waiters.pop(key, None)
+
+
+_STREAM_WAITER = _StreamWaiter()
+
+
+async def _check_rate_limit(api_key: str) -> None:
+    allowed = await _RATE_LIMIT_SCRIPT(
+        keys=core.rate_limit_keys(api_key),
+        args=[api.RATE_LIMIT, api.RATE_LIMIT_WINDOW, 1],
+        client=ASYNC_REDIS_CONNECTION,
+    )
+    core.check_rate_limit(allowed, api.RATE_LIMIT_WINDOW)
+
+
+async def _api_key_exists(api_key: str) -> bool:
+    if api.API_KEY_CACHE.get(api_key):
+        return True
+    exists = bool(await ASYNC_REDIS_CONNECTION.hexists("autotest:user_credentials", api_key))
+    if exists:
+        api.API_KEY_CACHE.set(api_key, True)
+    return exists
+
+
+async def _settings_owner(settings_id: str) -> Optional[str]:
+    owner = api.SETTINGS_OWNER_CACHE.get(settings_id)
+    if owner is not None:
+        return owner
+    owner = await ASYNC_REDIS_CONNECTION.hget(settings_store.settings_key(settings_id), "user")
+    if owner is None:
+        return None
+    owner = owner.decode()
+    api.SETTINGS_OWNER_CACHE.set(settings_id, owner)
+    return owner
+
+
+async def _authorize(request: _Request, settings_id: str, tests_id: Optional[str] = None) -> str:
+    """Async equivalent of the flask app's authorize decorator. Return the api key of the authorized user"""
+    user = None
+    try:
+        api_key = request.headers.get("api-key")
+        core.check_api_key(api_key, api_key is not None and await _api_key_exists(api_key))
+        await _check_rate_limit(api_key)
+        user = api_key
+        core.check_settings_owner(await _settings_owner(settings_id), user)
+        if tests_id:
+            core.check_test_settings(await ASYNC_REDIS_CONNECTION.hget("autotest:tests", tests_id), settings_id)
+    except core.RequestError as e:
+        api.ACCESS_LOGGER.write(core.access_record(request.url, user, e))
+        raise e
+    api.ACCESS_LOGGER.write(core.access_record(request.url, user))
+    return user
+
+
+async def _fetch_jobs(job_ids: List[str]) -> List[Optional[rq.job.Job]]:
+    """Async equivalent of rq.job.Job.fetch_many"""
+    if not job_ids:
+        return []
+    async with ASYNC_REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hgetall(rq.job.Job.key_for(job_id))
+        results = await pipe.execute()
+    jobs = []
+    for job_id, data in zip(job_ids, results):
+        if data:
+            job = rq.job.Job(job_id, connection=api.REDIS_CONNECTION)
+            job.restore(data)
+            jobs.append(job)
+        else:
+            jobs.append(None)
+    return jobs
+
+
+async def _get_jobs(test_ids: List, settings_id: str):
+    """Async equivalent of the flask app's _get_jobs"""
+    for chunk in core.chunks(test_ids, api.BULK_CHUNK_SIZE):
+        owned = core.owned(await ASYNC_REDIS_CONNECTION.hmget("autotest:tests", chunk), settings_id)
+        jobs = iter(await _fetch_jobs([str(id_) for id_, is_owned in zip(chunk, owned) if is_owned]))
+        yield [(id_, next(jobs) if is_owned else None) for id_, is_owned in zip(chunk, owned)]
+
+
+async def _job_result(job: rq.job.Job, test_result: Optional[bytes]) -> Dict:
+    """
+    Async equivalent of core.job_result. The error for failed jobs is read from the job's latest result here so that
+    it isn't read with the (blocking) connection that the job was created with.
+    """
+    exc_info = None
+    if job.get_status(refresh=False) == JobStatus.FAILED:
+        exc_info = job._exc_info
+        latest = await ASYNC_REDIS_CONNECTION.xrevrange(Result.get_key(job.id), "+", "-", count=1)
+        if latest:
+            result_id, payload = latest[0]
+            result = Result.restore(job.id, result_id.decode(), payload, connection=api.REDIS_CONNECTION)
+            if result.type == Result.Type.FAILED:
+                exc_info = result.exc_string
+    return core.job_result(job, test_result, exc_info)
+
+
+async def _get_result(request: _Request, settings_id: str, tests_id: str, **_kw) -> Dict:
+    (job,) = await _fetch_jobs([tests_id])
+    if job is None:
+        raise rq.exceptions.NoSuchJobError(f"No such job: {tests_id}")
+    wait = min(request.int_arg("wait"), api.MAX_RESULT_WAIT)
+    if wait > 0 and job.get_status(refresh=False) in core.JOB_WAITING_STATUSES:
+        if not await _STREAM_WAITER.wait(Result.get_key(job.id), "0-0", wait):
+            status = await ASYNC_REDIS_CONNECTION.hget(job.key, "status")
+            return {"status": JobStatus(status.decode()) if status else job.get_status(refresh=False)}
+        (job,) = await _fetch_jobs([tests_id])
+    test_result = None
+    if job.get_status(refresh=False) == JobStatus.FINISHED:
+        test_result = await ASYNC_REDIS_CONNECTION.get(core.result_keys(tests_id)[0])
+    result = await _job_result(job, test_result)
+    async with ASYNC_REDIS_CONNECTION.pipeline() as pipe:
+        core.delete_job(job, pipe, api.REDIS_CONNECTION)
+        pipe.delete(*core.result_keys(tests_id))
+        await pipe.execute()
+    return result
+
+
+async def _get_results(request: _Request, settings_id: str, **_kw) -> Dict:
+    test_ids = request.json["test_ids"]
+    result = {}
+    async for chunk in _get_jobs(test_ids, settings_id):
+        finished = core.finished(chunk)
+        test_results = {}
+        if finished:
+            keys = [core.result_keys(id_)[0] for id_ in finished]
+            test_results = dict(zip(finished, await ASYNC_REDIS_CONNECTION.mget(keys)))
+        async with ASYNC_REDIS_CONNECTION.pipeline() as pipe:
+            for id_, job in chunk:
+                if job is None:
+                    result[id_] = None
+                    continue
+                result[id_] = await _job_result(job, test_results.get(id_))
+                if job.get_status(refresh=False) in core.JOB_DONE_STATUSES:
+                    core.delete_job(job, pipe, api.REDIS_CONNECTION)
+                    pipe.delete(*core.result_keys(id_))
+            await pipe.execute()
+    return result
+
+
+async def _get_statuses(request: _Request, settings_id: str, **_kw) -> Dict:
+    test_ids = request.json["test_ids"]
+    result = {}
+    async for chunk in _get_jobs(test_ids, settings_id):
+        finished = core.finished(chunk)
+        cancelled = []
+        if finished:
+            keys = [api.CANCEL_KEY.format(id_) for id_ in finished]
+            cancelled = core.cancelled(finished, await ASYNC_REDIS_CONNECTION.mget(keys))
+        result.update(core.statuses(chunk, cancelled))
+    if request.json.get("summary"):
+        return core.status_summary(result)
+    return result
+
+
+async def _get_result_stream(request: _Request, settings_id: str, tests_id: str, **_kw) -> Dict:
+    cursor = request.args.get("cursor", "0-0")
+    wait = min(request.int_arg("wait"), api.MAX_RESULT_WAIT)
+    key = f"autotest:test_stream:{tests_id}"
+    entries = await ASYNC_REDIS_CONNECTION.xread({key: cursor})
+    if not entries and wait > 0 and await _STREAM_WAITER.wait(key, cursor, wait):
+        entries = await ASYNC_REDIS_CONNECTION.xread({key: cursor})
+    return core.stream_response(entries, cursor)
+
+
+_ROUTES = [
+    (re.compile(r"^/settings/(?P<settings_id>[^/]+)/test/(?P<tests_id>[^/]+)$"), _get_result),
+    (re.compile(r"^/settings/(?P<settings_id>[^/]+)/tests/results$"), _get_results),
+    (re.compile(r"^/settings/(?P<settings_id>[^/]+)/tests/status$"), _get_statuses),
+    (re.compile(r"^/settings/(?P<settings_id>[^/]+)/test/(?P<tests_id>[^/]+)/stream$"), _get_result_stream),
+]
+
+
+async def _send_json(send, code: int, body: Dict, headers: Optional[Dict[str, str]] = None) -> None:
+    content = json.dumps(body).encode()
+    response_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(content)).encode())]
+    response_headers.extend((k.lower().encode(), v.encode()) for k, v in (headers or {}).items())
+    await send({"type": "http.response.start", "status": code, "headers": response_headers})
+    await send({"type": "http.response.body", "body": content})
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _handle(scope: Dict, receive, send, handler, kwargs: Dict[str, str]) -> None:
+    request = _Request(scope, await _read_body(receive))
+    try:
+        user = await _authorize(request, **kwargs)
+        await _send_json(send, 200, await handler(request, **kwargs, user=user))
+    except Exception as e:
+        api_key = request.headers.get("api-key")
+        code, message, headers = 500, str(e), {}
+        if isinstance(e, core.RequestError):
+            code, message, headers = e.code, e.message, e.headers
+        api.ERROR_LOGGER.write(core.error_record(request.url, api_key, code, traceback.format_exc()))
+        if not api.app.debug:
+            message = core.redact(message, api_key)
+        await _send_json(send, code, {"message": message}, headers)
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await ASYNC_REDIS_CONNECTION.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope: Dict, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] == "http" and scope["method"] == "GET":
+        if scope["path"] == "/status":
+            return await _send_json(send, 200, {"success": True})
+        for pattern, handler in _ROUTES:
+            match = pattern.match(scope["path"])
+            if match:
+                return await _handle(scope, receive, send, handler, match.groupdict())
+    return await _flask_app(scope, receive, send)
@@ -0,0 +1,223 @@
+"""
+Request handling shared by the flask app (autotest_client) and the ASGI app (autotest_client.asgi).
+
+The helpers here don't read from or write to redis. They are given the values that the caller read from redis (with
+the blocking client in the flask app and the asyncio client in the ASGI app) and return the response, or raise a
+RequestError to return an error response, so that each app only differs in how it talks to redis.
+"""
+
+import json
+from collections import Counter
+from datetime import datetime
+from typing import Container, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import redis
+import rq
+from rq.job import Job, JobStatus
+
+# Sliding window rate limiter. The number of requests in the last window is estimated from the counts in the current
+# and previous fixed windows (weighted by how much of the previous window still overlaps). A request is allowed if
+# the estimate plus its cost does not exceed the limit, in which case its cost is added to the current window's count,
+# so a request that costs more than the limit is always rejected.
+#   KEYS: [per-user limit, per-user counts hash]
+#   ARGV: [default limit, window length in seconds, cost of this request]
+RATE_LIMIT_SCRIPT = """
+local limit = tonumber(redis.call("GET", KEYS[1]) or ARGV[1])
+local window = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local current = math.floor(now / window)
+local overlap = 1 - (now - current * window) / window
+local current_count = tonumber(redis.call("HGET", KEYS[2], tostring(current)) or 0)
+local previous_count = tonumber(redis.call("HGET", KEYS[2], tostring(current - 1)) or 0)
+if current_count + previous_count * overlap + cost > limit then
+    return 0
+end
+if current_count == 0 then
+    for _, field in ipairs(redis.call("HKEYS", KEYS[2])) do
+        if tonumber(field) < current - 1 then
+            redis.call("HDEL", KEYS[2], field)
+        end
+    end
+end
+redis.call("HINCRBY", KEYS[2], tostring(current), cost)
+redis.call("EXPIRE", KEYS[2], window * 2)
+return 1
+"""
+
+JOB_REGISTRIES = {
+    JobStatus.FINISHED: rq.registry.FinishedJobRegistry,
+    JobStatus.FAILED: rq.registry.FailedJobRegistry,
+    JobStatus.STARTED: rq.registry.StartedJobRegistry,
+    JobStatus.DEFERRED: rq.registry.DeferredJobRegistry,
+    JobStatus.SCHEDULED: rq.registry.ScheduledJobRegistry,
+    JobStatus.CANCELED: rq.registry.CanceledJobRegistry,
+}
+JOB_WAITING_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+JOB_DONE_STATUSES = (JobStatus.FINISHED, JobStatus.FAILED)
+
+
+class RequestError(Exception):
+    """Raised to return an error response with a message (and headers)"""
+
+    def __init__(self, code: int, message: str, headers: Optional[Dict[str, str]] = None) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.headers = headers or {}
+
+    def body(self) -> str:
+        return json.dumps({"message": self.message})
+
+
+def rate_limit_keys(api_key: str) -> List[str]:
+    """Return the keys that RATE_LIMIT_SCRIPT is run with for api_key"""
+    return [f"autotest:ratelimit:{api_key}:limit", f"autotest:ratelimit:{api_key}"]
+
+
+def check_rate_limit(allowed: int, window: int) -> None:
+    """Raise a RequestError if RATE_LIMIT_SCRIPT (with a window of window seconds) didn't allow the request"""
+    if not allowed:
+        raise RequestError(429, "Too many requests", {"Retry-After": str(window)})
+
+
+def check_api_key(api_key: Optional[str], exists: bool) -> None:
+    """Raise a RequestError unless api_key was given and is a registered key"""
+    if api_key is None or not exists:
+        raise RequestError(401, "Unauthorized")
+
+
+def check_settings_owner(owner: Optional[str], user: str) -> None:
+    """Raise a RequestError unless the settings exist (their owner is not None) and are owned by user"""
+    if owner is None:
+        raise RequestError(404, "Settings not found")
+    if owner != user:
+        raise RequestError(401, "Unauthorized")
+
+
+def check_test_settings(test_setting: Optional[Union[bytes, str]], settings_id: str) -> None:
+    """Raise a RequestError unless the test exists (its settings id is not None) and was run for settings_id"""
+    if test_setting is None:
+        raise RequestError(404, "Test not found")
+    if int(test_setting) != int(settings_id):
+        raise RequestError(401, "Unauthorized")
+
+
+def access_record(url: Optional[str], user: Optional[str], error: Optional[RequestError] = None) -> Dict:
+    """Return the access log record for a request that was authorized, or rejected with error"""
+    record = {"time": datetime.now().isoformat(), "url": url, "user": user}
+    if error is None:
+        return {**record, "event": "authorized"}
+    return {**record, "event": "unauthorized", "status": error.code, "response": error.body()}
+
+
+def error_record(url: Optional[str], api_key: Optional[str], code: int, traceback: str) -> Dict:
+    """Return the error log record for a request that failed with status code"""
+    return {
+        "time": datetime.now().isoformat(),
+        "event": "error",
+        "url": url,
+        "user": api_key,
+        "status": code,
+        "traceback": traceback,
+    }
+
+
+def redact(message: str, api_key: Optional[str]) -> str:
+    """Return message with the client's api key hidden"""
+    return message.replace(api_key, "[client-api-key]") if api_key else message
+
+
+def chunks(test_ids: Sequence, size: int) -> Iterable[Sequence]:
+    """Yield test_ids in chunks of at most size ids"""
+    for start in range(0, len(test_ids), size):
+        end = start + size
+        yield test_ids[start:end]
+
+
+def owned(test_settings: Sequence[Optional[bytes]], settings_id: str) -> List[bool]:
+    """Return whether each test, with the settings ids in test_settings (read from autotest:tests), is settings_id's"""
+    return [s is not None and int(s) == int(settings_id) for s in test_settings]
+
+
+def result_keys(test_id: Union[int, str]) -> List[str]:
+    """Return the keys of the result and the result stream of test_id"""
+    return [f"autotest:test_result:{test_id}", f"autotest:test_stream:{test_id}"]
+
+
+def finished(chunk: Iterable[Tuple[str, Optional[Job]]]) -> List[str]:
+    """Return the ids of the finished tests in chunk (a list of (test_id, job) tuples)"""
+    return [id_ for id_, job in chunk if job is not None and job.get_status(refresh=False) == JobStatus.FINISHED]
+
+
+def remove_from_registries(job: Job, pipeline: redis.client.Pipeline, connection: redis.Redis) -> None:
+    """
+    Remove job from its queue and from the registry for its current status.
+
+    This is equivalent to rq's Job._remove_from_registries except that it uses the status loaded when the job
+    was fetched (instead of querying it again) so that no reads are done outside of the pipeline.
+    """
+    rq.Queue(job.origin, connection=connection).remove(job, pipeline=pipeline)
+    registry = JOB_REGISTRIES.get(job.get_status(refresh=False))
+    if registry is not None:
+        registry(job.origin, connection=connection).remove(job, pipeline=pipeline)
+
+
+def delete_job(job: Job, pipeline: redis.client.Pipeline, connection: redis.Redis) -> None:
+    """Delete job and its associated data using pipeline"""
+    remove_from_registries(job, pipeline, connection)
+    pipeline.delete(job.key, job.dependents_key, job.dependencies_key, job.execution_registry.key)
+
+
+def job_result(job: Job, test_result: Optional[bytes], exc_info: Optional[str] = None) -> Dict:
+    """
+    Return a result dictionary for job where test_result is the raw value stored at autotest:test_result:<id> and
+    exc_info is the error of a failed job (the job's exc_info if not given).
+    """
+    job_status = job.get_status(refresh=False)
+    result = {"status": job_status}
+    if job_status == JobStatus.FINISHED:
+        # the result of a test run that was stopped by cancel_tests overrides the status with "canceled"
+        try:
+            result.update(json.loads(test_result))
+        except (json.JSONDecodeError, TypeError):
+            result.update({"error": f"invalid json: {test_result}"})
+    elif job_status == JobStatus.FAILED:
+        result.update({"error": str(exc_info if exc_info is not None else job.exc_info)})
+    return result
+
+
+def cancelled(test_ids: Sequence[str], cancel_keys: Sequence[Optional[bytes]]) -> List[str]:
+    """Return the ids of the tests in test_ids whose cancel key (the values of which are in cancel_keys) is set"""
+    return [id_ for id_, value in zip(test_ids, cancel_keys) if value is not None]
+
+
+def statuses(chunk: Iterable[Tuple[str, Optional[Job]]], cancelled_ids: Container[str] = ()) -> Dict:
+    """
+    Return the status of each test in chunk (None if it doesn't exist). Finished tests in cancelled_ids were stopped
+    by cancel_tests while they were running (rq marks them as finished when the worker returns) so they are reported
+    as canceled.
+    """
+    result = {}
+    for id_, job in chunk:
+        status = None if job is None else job.get_status(refresh=False)
+        result[id_] = JobStatus.CANCELED if status == JobStatus.FINISHED and id_ in cancelled_ids else status
+    return result
+
+
+def status_summary(result: Dict) -> Dict:
+    """Return the number of tests in result (as returned by statuses) with each status"""
+    return dict(Counter("missing" if status is None else status for status in result.values()))
+
+
+def stream_response(entries: List, cursor: str) -> Dict:
+    """Return the response for the result stream entries (as returned by XREAD) read after cursor"""
+    test_groups, done = [], False
+    for entry_id, fields in entries[0][1] if entries else []:
+        cursor = entry_id.decode()
+        if b"result" in fields:
+            test_groups.append(json.loads(fields[b"result"]))
+        else:
+            done = True
+    return {"test_groups": test_groups, "cursor": cursor, "done": done}
@@ -1,11 +1,20 @@
-from jsonschema import Draft7Validator, validators, ValidationError
+from jsonschema import Draft7Validator, FormatChecker, validators, ValidationError
 from jsonschema.exceptions import best_match
 from copy import deepcopy
-from typing import Type, Generator, Dict, Union, List, Optional
+from functools import lru_cache
+from typing import Type, Generator, Dict, Union, List, Optional, Hashable, Iterable
 
 ValidatorType = type(Draft7Validator)
 
+# keywords that fill in defaults, these are moved to the front of each subschema so that defaults are filled in
+# before any other keywords (ex: 'required', 'minItems') are validated.
+DEFAULT_KEYWORDS = ("properties", "items", "dependencies", "oneOf")
+UPLOADED_FILE_FORMAT = "uploaded_file"
 
+_COMPILED_VALIDATORS: Dict[Hashable, ValidatorType] = {}
+
+
+@lru_cache(maxsize=None)
 def _extend_with_default(
     validator_class: Type[ValidatorType] = Draft7Validator,
 ) -> ValidatorType:
@@ -78,9 +87,6 @@ def _extend_with_default(
 
         for i, subschema in enumerate(properties):
             new_instance = deepcopy(instance)
-            # first time to fill in defaults since validating 'required', 'minProperties',
-            # etc. can't be done until the instance has been properly filled with defaults.
-            list(validator.descend(new_instance, subschema, schema_path=i))
             errs = list(validator.descend(new_instance, subschema, schema_path=i))
             if errs:
                 all_errors.extend(errs)
@@ -107,34 +113,96 @@ def _extend_with_default(
     return validators.extend(validator_class, custom_validators)
 
 
+def _order_default_keywords(schema: Union[Dict, List]) -> Union[Dict, List]:
+    """
+    Return a copy of schema where the keywords in DEFAULT_KEYWORDS come first in every subschema.
+
+    Keywords are validated in the order they appear in a schema so this ensures that an instance is filled with
+    defaults before keywords like 'required' or 'minProperties' are checked. This allows defaults to be filled
+    and the instance to be validated in a single pass.
+    """
+    if isinstance(schema, list):
+        return [_order_default_keywords(v) for v in schema]
+    if not isinstance(schema, dict):
+        return deepcopy(schema)
+    keys = [k for k in DEFAULT_KEYWORDS if k in schema] + [k for k in schema if k not in DEFAULT_KEYWORDS]
+    return {k: _order_default_keywords(schema[k]) for k in keys}
+
+
+def _compile_schema(schema: Dict) -> Dict:
+    """
+    Return a copy of schema prepared for validating test settings:
+
+    - uploaded file names are checked with the UPLOADED_FILE_FORMAT format instead of an enum listing every file
+    - test categories are not validated
+    - keywords that fill defaults are ordered first (see _order_default_keywords)
+    """
+    schema = _order_default_keywords(schema)
+    definitions = schema.get("definitions", {})
+    if "files_list" in definitions:
+        definitions["files_list"] = {"type": "string", "format": UPLOADED_FILE_FORMAT}
+    # don't validate based on categories
+    definitions.get("test_data_categories", {}).pop("enum", None)
+    definitions.get("test_data_categories", {}).pop("enumNames", None)
+    return schema
+
+
+def _get_validator(
+    schema: Dict, version: Optional[Hashable] = None, validator_class: ValidatorType = Draft7Validator
+) -> ValidatorType:
+    """
+    Return a validator that fills in defaults while validating against schema.
+
+    If version is not None, the validator is compiled once and cached. Only the validator for the most recently
+    requested version is kept.
+    """
+    if version is None:
+        return _extend_with_default(validator_class)(_compile_schema(schema))
+    key = (version, validator_class)
+    validator = _COMPILED_VALIDATORS.get(key)
+    if validator is None:
+        validator = _extend_with_default(validator_class)(_compile_schema(schema))
+        _COMPILED_VALIDATORS.clear()
+        _COMPILED_VALIDATORS[key] = validator
+    return validator
+
+
+def _uploaded_files_checker(filenames: Iterable[str]) -> FormatChecker:
+    """Return a format checker that checks whether a file name is one of filenames"""
+    filenames = frozenset(filenames)
+    checker = FormatChecker(formats=())
+    checker.checks(UPLOADED_FILE_FORMAT)(lambda instance: not isinstance(instance, str) or instance in filenames)
+    return checker
+
+
 def _validate_with_defaults(
     schema: Dict,
     obj: Union[Dict, List],
     validator_class: ValidatorType = Draft7Validator,
     best_only: bool = True,
+    filenames: Iterable[str] = (),
+    version: Optional[Hashable] = None,
 ) -> Union[ValidationError, List[ValidationError]]:
     """
-    Return an iterator that yields errors from validating obj on schema
-    after first filling in defaults on obj.
+    Return errors from validating obj on schema while filling in defaults on obj.
     """
-    validator = _extend_with_default(validator_class)(schema)
-    # first time to fill in defaults since validating 'required', 'minProperties',
-    # etc. can't be done until the instance has been properly filled with defaults.
-    list(validator.iter_errors(obj))
+    validator = _get_validator(schema, version, validator_class).evolve(
+        format_checker=_uploaded_files_checker(filenames)
+    )
     errors = list(validator.iter_errors(obj))
     if best_only:
         return best_match(errors)
     return errors
 
 
-def validate_against_schema(test_specs: Dict, schema: Dict, filenames: List[str]) -> Optional[str]:
+def validate_against_schema(
+    test_specs: Dict, schema: Dict, filenames: List[str], version: Optional[Hashable] = None
+) -> Optional[str]:
     """
     Check if test_specs is valid according to the schema.
-    Raise an error if it is not valid.
+    Return an error message if it is not valid.
+
+    If version is not None, it should uniquely identify the schema so that the compiled validator can be reused.
     """
-    schema["definitions"]["files_list"]["enum"] = filenames
-    # don't validate based on categories
-    schema["definitions"]["test_data_categories"].pop("enum")
-    schema["definitions"]["test_data_categories"].pop("enumNames")
-    error = _validate_with_defaults(schema, test_specs, best_only=True)
+    error = _validate_with_defaults(schema, test_specs, best_only=True, filenames=filenames, version=version)
     return str(error) if error else None
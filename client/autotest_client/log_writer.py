@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import queue
+import atexit
+import threading
+import traceback
+from datetime import datetime
+from typing import Dict, List, Optional, TextIO
+
+# added to the queue to make the writer thread write the current batch without waiting for more records
+_FLUSH = object()
+
+
+class LogWriter:
+    """
+    Write log records as JSON lines from a background thread.
+
+    Records are added to a bounded in-memory queue so that writing a record never blocks on disk I/O. If the queue
+    is full the record is dropped and counted; the number of dropped records is written to the log with the next
+    batch. The background thread writes records in batches and rotates the log file when it reaches max_bytes or
+    when it has been open for rotate_interval seconds (both are disabled when 0), keeping backup_count old files.
+
+    Several processes (for example gunicorn workers) can write to the same path. Each batch is written while holding
+    an exclusive lock on <path>.lock, and a process reopens the log file if another process has rotated it.
+
+    If path is empty, records are written to fallback instead and are never rotated.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        fallback: TextIO = sys.stdout,
+        queue_size: int = 10000,
+        batch_size: int = 500,
+        flush_interval: float = 1,
+        max_bytes: int = 0,
+        rotate_interval: float = 0,
+        backup_count: int = 5,
+    ) -> None:
+        self.path = path or None
+        self.fallback = fallback
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._unreported = 0
+        self._pid = None
+        self._file = None
+        self._lock_file = None
+        self._opened_at = None
+        atexit.register(self.flush, timeout=5)
+
+    def write(self, record: Dict) -> None:
+        """Add record to the queue of records to write"""
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += 1
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Wait up to timeout seconds for all queued records to be written"""
+        if self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(_FLUSH, timeout=timeout)
+        except queue.Full:
+            return
+        with self._queue.all_tasks_done:
+            self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
+
+    def _ensure_thread(self) -> None:
+        # the writer thread is started lazily (and restarted in forked processes, which don't inherit threads)
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                    self._file = None
+                    self._lock_file = None
+                    threading.Thread(target=self._run, daemon=True, name="autotest-log-writer").start()
+                    self._pid = os.getpid()
+
+    def _next_batch(self) -> List[Dict]:
+        records = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(records) < self.batch_size and records[-1] is not _FLUSH:
+            try:
+                records.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return records
+
+    def _run(self) -> None:
+        while True:
+            records = self._next_batch()
+            try:
+                self._write_batch(records)
+            except Exception:
+                # never let a bad record or a full disk stop the writer
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+    def _write_batch(self, records: List[Dict]) -> None:
+        records = [record for record in records if record is not _FLUSH]
+        with self._lock:
+            dropped, self._unreported = self._unreported, 0
+        if dropped:
+            records = [*records, {"time": datetime.now().isoformat(), "event": "dropped", "count": dropped}]
+        if not records:
+            return
+        data = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        if self.path is None:
+            self.fallback.write(data)
+            self.fallback.flush()
+            return
+        if self._lock_file is None:
+            self._lock_file = open(f"{self.path}.lock", "a")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            if self._file is None or self._replaced():
+                self._open()
+            if self._should_rotate(len(data)):
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _open(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "a")
+        self._opened_at = time.monotonic()
+
+    def _replaced(self) -> bool:
+        """Return True if the log file was rotated (or removed) by another process since it was opened"""
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        opened = os.fstat(self._file.fileno())
+        return (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino)
+
+    def _should_rotate(self, size: int) -> bool:
+        # other processes may have written to the file so its size is checked instead of this process' position
+        position = os.fstat(self._file.fileno()).st_size
+        if self.max_bytes and position and position + size > self.max_bytes:
+            return True
+        return bool(self.rotate_interval and time.monotonic() - self._opened_at >= self.rotate_interval)
+
+    def _rotate(self) -> None:
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
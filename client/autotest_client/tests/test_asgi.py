@@ -0,0 +1,293 @@
+import asyncio
+import io
+import json
+import threading
+import autotest_client
+import fakeredis
+import fakeredis.aioredis
+import pytest
+import rq
+from rq.job import JobStatus
+from autotest_client import asgi
+
+
+@pytest.fixture
+def fake_redis_server():
+    yield fakeredis.FakeServer()
+
+
+@pytest.fixture
+def fake_redis_conn(fake_redis_server):
+    yield fakeredis.FakeStrictRedis(server=fake_redis_server)
+
+
+@pytest.fixture(autouse=True)
+def fake_redis_db(monkeypatch, fake_redis_server, fake_redis_conn):
+    monkeypatch.setattr(autotest_client, "REDIS_CONNECTION", fake_redis_conn)
+    monkeypatch.setattr(asgi, "ASYNC_REDIS_CONNECTION", fakeredis.aioredis.FakeRedis(server=fake_redis_server))
+    monkeypatch.setattr(asgi, "_STREAM_WAITER", asgi._StreamWaiter(block=100))
+
+
+@pytest.fixture(autouse=True)
+def logs(monkeypatch):
+    monkeypatch.setattr(autotest_client.ACCESS_LOGGER, "fallback", io.StringIO())
+    monkeypatch.setattr(autotest_client.ERROR_LOGGER, "fallback", io.StringIO())
+    yield
+    autotest_client.ACCESS_LOGGER.flush()
+    autotest_client.ERROR_LOGGER.flush()
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    autotest_client.API_KEY_CACHE.clear()
+    autotest_client.SETTINGS_OWNER_CACHE.clear()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    for task in asyncio.all_tasks(loop):
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+    loop.close()
+
+
+class _Response:
+    def __init__(self, messages):
+        start, *body = messages
+        self.status_code = start["status"]
+        self.headers = {k.decode(): v.decode() for k, v in start["headers"]}
+        self.data = b"".join(m.get("body", b"") for m in body)
+
+    @property
+    def json(self):
+        return json.loads(self.data)
+
+
+class _Client:
+    """Send requests directly to the ASGI app"""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    async def _request(self, method, path, headers, json_):
+        path, _, query = path.partition("?")
+        body = json.dumps(json_).encode() if json_ is not None else b""
+        request_headers = [(b"host", b"localhost"), (b"content-length", str(len(body)).encode())]
+        if json_ is not None:
+            request_headers.append((b"content-type", b"application/json"))
+        request_headers.extend((k.lower().encode(), v.encode()) for k, v in (headers or {}).items())
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": query.encode(),
+            "headers": request_headers,
+            "server": ("localhost", 80),
+            "client": ("127.0.0.1", 12345),
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        await asgi.app(scope, receive, send)
+        return _Response(messages)
+
+    def get(self, path, headers=None, json=None):
+        return self.loop.run_until_complete(self._request("GET", path, headers, json))
+
+    def put(self, path, headers=None, json=None):
+        return self.loop.run_until_complete(self._request("PUT", path, headers, json))
+
+    def delete(self, path, headers=None, json=None):
+        return self.loop.run_until_complete(self._request("DELETE", path, headers, json))
+
+
+@pytest.fixture
+def client(loop):
+    return _Client(loop)
+
+
+@pytest.fixture
+def api_key(fake_redis_conn):
+    key = "test-api-key"
+    fake_redis_conn.hset(
+        "autotest:user_credentials", key=key, value=json.dumps({"auth_type": "test", "credentials": ""})
+    )
+    return key
+
+
+@pytest.fixture
+def settings_id(fake_redis_conn, api_key):
+    fake_redis_conn.hset("autotest:settings:1", mapping={"user": api_key, "status": "ready", "settings": "{}"})
+    return 1
+
+
+def _enqueue_test(conn, test_id, settings_id, status=None, result=None):
+    conn.hset("autotest:tests", key=test_id, value=settings_id)
+    job = rq.Queue("batch", connection=conn).enqueue_call("autotest_server.run_test", job_id=str(test_id))
+    if status is not None:
+        job.set_status(status)
+    if result is not None:
+        conn.set(f"autotest:test_result:{test_id}", json.dumps(result))
+    return job
+
+
+def _finish_job(conn, job, result):
+    conn.set(f"autotest:test_result:{job.id}", json.dumps(result))
+    with conn.pipeline() as pipe:
+        job._handle_success(result_ttl=3600, pipeline=pipe)
+        pipe.execute()
+
+
+class TestStatus:
+    def test_success(self, client):
+        assert client.get("/status").json == {"success": True}
+
+
+class TestAuthorization:
+    def test_no_api_key(self, client, settings_id):
+        assert client.get("/settings/1/tests/status", json={"test_ids": []}).status_code == 401
+
+    def test_other_users_settings(self, client, api_key, settings_id, fake_redis_conn):
+        fake_redis_conn.hset("autotest:user_credentials", key="other", value="{}")
+        response = client.get("/settings/1/tests/status", headers={"Api-Key": "other"}, json={"test_ids": []})
+        assert response.status_code == 401
+
+    def test_settings_not_found(self, client, api_key):
+        response = client.get("/settings/2/tests/status", headers={"Api-Key": api_key}, json={"test_ids": []})
+        assert response.status_code == 404
+
+    def test_test_not_found(self, client, api_key, settings_id):
+        assert client.get("/settings/1/test/1", headers={"Api-Key": api_key}).status_code == 404
+
+    def test_rate_limited(self, client, api_key, settings_id, monkeypatch):
+        monkeypatch.setattr(autotest_client, "RATE_LIMIT", 1)
+        client.get("/settings/1/tests/status", headers={"Api-Key": api_key}, json={"test_ids": []})
+        response = client.get("/settings/1/tests/status", headers={"Api-Key": api_key}, json={"test_ids": []})
+        assert response.status_code == 429
+        assert response.headers["retry-after"]
+
+
+class TestGetStatuses:
+    def test_statuses(self, client, api_key, settings_id, fake_redis_conn):
+        _enqueue_test(fake_redis_conn, 1, settings_id, status=JobStatus.STARTED)
+        response = client.get("/settings/1/tests/status", headers={"Api-Key": api_key}, json={"test_ids": [1, 2]})
+        assert response.json == {"1": "started", "2": None}
+
+    def test_summary(self, client, api_key, settings_id, fake_redis_conn):
+        _enqueue_test(fake_redis_conn, 1, settings_id, status=JobStatus.STARTED)
+        response = client.get(
+            "/settings/1/tests/status", headers={"Api-Key": api_key}, json={"test_ids": [1, 2], "summary": True}
+        )
+        assert response.json == {"started": 1, "missing": 1}
+
+    def test_cancelled_while_running(self, client, api_key, settings_id, fake_redis_conn):
+        job = _enqueue_test(fake_redis_conn, 1, settings_id)
+        fake_redis_conn.set("autotest:cancel:1", 1)
+        _finish_job(fake_redis_conn, job, {"test_groups": [], "error": "Test run was cancelled", "status": "canceled"})
+        response = client.get("/settings/1/tests/status", headers={"Api-Key": api_key}, json={"test_ids": [1]})
+        assert response.json == {"1": "canceled"}
+
+
+class TestGetResults:
+    def test_results(self, client, api_key, settings_id, fake_redis_conn):
+        _enqueue_test(fake_redis_conn, 1, settings_id, status=JobStatus.FINISHED, result={"test_groups": []})
+        _enqueue_test(fake_redis_conn, 2, settings_id, status=JobStatus.STARTED)
+        response = client.get("/settings/1/tests/results", headers={"Api-Key": api_key}, json={"test_ids": [1, 2]})
+        assert response.json == {"1": {"status": "finished", "test_groups": []}, "2": {"status": "started"}}
+        assert not fake_redis_conn.exists("rq:job:1")
+        assert fake_redis_conn.exists("rq:job:2")
+
+
+class TestGetResult:
+    @pytest.fixture
+    def test_result(self):
+        return {"test_groups": [], "error": None}
+
+    @pytest.fixture
+    def job(self, fake_redis_conn, settings_id):
+        return _enqueue_test(fake_redis_conn, 1, settings_id)
+
+    def test_finished(self, client, api_key, job, fake_redis_conn, test_result):
+        _finish_job(fake_redis_conn, job, test_result)
+        response = client.get("/settings/1/test/1", headers={"Api-Key": api_key})
+        assert response.json == {"status": "finished", **test_result}
+        assert not fake_redis_conn.exists("rq:job:1")
+
+    def test_failed(self, client, api_key, job, fake_redis_conn):
+        with fake_redis_conn.pipeline() as pipe:
+            job.set_status(JobStatus.FAILED, pipeline=pipe)
+            job._handle_failure("Traceback: oops", pipeline=pipe)
+            pipe.execute()
+        response = client.get("/settings/1/test/1", headers={"Api-Key": api_key})
+        assert response.json == {"status": "failed", "error": "Traceback: oops"}
+
+    def test_wait_for_result(self, client, api_key, job, fake_redis_conn, test_result):
+        timer = threading.Timer(0.2, _finish_job, args=(fake_redis_conn, job, test_result))
+        timer.start()
+        response = client.get("/settings/1/test/1?wait=5", headers={"Api-Key": api_key})
+        timer.join()
+        assert response.json == {"status": "finished", **test_result}
+
+    def test_wait_timeout(self, client, api_key, job, fake_redis_conn):
+        response = client.get("/settings/1/test/1?wait=1", headers={"Api-Key": api_key})
+        assert response.json == {"status": "queued"}
+        assert fake_redis_conn.exists("rq:job:1")
+
+    def test_concurrent_waits(self, client, api_key, fake_redis_conn, settings_id, test_result, loop):
+        jobs = [_enqueue_test(fake_redis_conn, i, settings_id) for i in range(3)]
+        timers = [threading.Timer(0.2, _finish_job, args=(fake_redis_conn, job, test_result)) for job in jobs]
+        for timer in timers:
+            timer.start()
+
+        async def wait_for_all():
+            headers = {"Api-Key": api_key}
+            return await asyncio.gather(
+                *(client._request("GET", f"/settings/1/test/{i}?wait=5", headers, None) for i in range(3))
+            )
+
+        responses = loop.run_until_complete(wait_for_all())
+        for timer in timers:
+            timer.join()
+        assert [r.json for r in responses] == [{"status": "finished", **test_result}] * 3
+
+
+class TestGetResultStream:
+    @pytest.fixture
+    def stream(self, fake_redis_conn, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id, status=JobStatus.STARTED)
+        fake_redis_conn.xadd("autotest:test_stream:1", {"result": json.dumps({"time": 1})})
+
+    def test_results(self, client, api_key, stream):
+        response = client.get("/settings/1/test/1/stream", headers={"Api-Key": api_key})
+        assert response.json["test_groups"] == [{"time": 1}]
+        assert response.json["done"] is False
+
+    def test_wait_for_new_results(self, client, api_key, stream, fake_redis_conn):
+        cursor = client.get("/settings/1/test/1/stream", headers={"Api-Key": api_key}).json["cursor"]
+        timer = threading.Timer(
+            0.2, fake_redis_conn.xadd, args=("autotest:test_stream:1", {"done": json.dumps({"error": None})})
+        )
+        timer.start()
+        response = client.get(f"/settings/1/test/1/stream?cursor={cursor}&wait=5", headers={"Api-Key": api_key})
+        timer.join()
+        assert response.json["done"] is True
+
+
+class TestFlaskRoutes:
+    def test_delegated(self, client, api_key, settings_id, fake_redis_conn):
+        _enqueue_test(fake_redis_conn, 1, settings_id)
+        response = client.delete("/settings/1/tests/cancel", headers={"Api-Key": api_key}, json={"test_ids": [1]})
+        assert response.status_code == 200
+        assert rq.job.Job.fetch("1", connection=fake_redis_conn).get_status() == JobStatus.CANCELED
@@ -0,0 +1,69 @@
+import pytest
+from rq.job import JobStatus
+
+from autotest_client import core
+
+
+class _Job:
+    def __init__(self, status):
+        self.status = status
+
+    def get_status(self, refresh=True):
+        return self.status
+
+
+class TestChecks:
+    def test_rate_limited(self):
+        with pytest.raises(core.RequestError) as e:
+            core.check_rate_limit(0, 60)
+        assert (e.value.code, e.value.headers) == (429, {"Retry-After": "60"})
+
+    @pytest.mark.parametrize("owner, code", [(None, 404), ("other", 401)])
+    def test_settings_owner(self, owner, code):
+        with pytest.raises(core.RequestError) as e:
+            core.check_settings_owner(owner, "user")
+        assert e.value.code == code
+
+    @pytest.mark.parametrize("test_setting, code", [(None, 404), (b"2", 401)])
+    def test_test_settings(self, test_setting, code):
+        with pytest.raises(core.RequestError) as e:
+            core.check_test_settings(test_setting, "1")
+        assert e.value.code == code
+
+    def test_allowed(self):
+        core.check_rate_limit(1, 60)
+        core.check_api_key("key", True)
+        core.check_settings_owner("user", "user")
+        core.check_test_settings(b"1", "1")
+
+
+def test_access_record_unauthorized():
+    record = core.access_record("http://localhost/", None, core.RequestError(401, "Unauthorized"))
+    assert record["event"] == "unauthorized"
+    assert record["response"] == '{"message": "Unauthorized"}'
+
+
+def test_redact():
+    assert core.redact("bad key abc", "abc") == "bad key [client-api-key]"
+    assert core.redact("no key", None) == "no key"
+
+
+def test_chunks():
+    assert list(core.chunks([1, 2, 3], 2)) == [[1, 2], [3]]
+
+
+def test_status_summary():
+    result = core.statuses([("1", _Job(JobStatus.QUEUED)), ("2", None), ("3", _Job(JobStatus.QUEUED))])
+    assert core.status_summary(result) == {JobStatus.QUEUED: 2, "missing": 1}
+
+
+def test_cancelled_statuses():
+    chunk = [("1", _Job(JobStatus.FINISHED)), ("2", _Job(JobStatus.FINISHED)), ("3", _Job(JobStatus.STARTED))]
+    cancelled = core.cancelled(["1", "2"], [b"1", None])
+    assert core.statuses(chunk, cancelled) == {"1": "canceled", "2": "finished", "3": "started"}
+
+
+def test_stream_response():
+    entries = [(b"key", [(b"1-0", {b"result": b'{"a": 1}'}), (b"2-0", {b"done": b"{}"})])]
+    assert core.stream_response(entries, "0-0") == {"test_groups": [{"a": 1}], "cursor": "2-0", "done": True}
+    assert core.stream_response([], "1-0") == {"test_groups": [], "cursor": "1-0", "done": False}
@@ -1,7 +1,14 @@
 import autotest_client
+import io
 import pytest
 import fakeredis
 import json
+import threading
+import time
+import zipfile
+import gzip
+import rq
+from rq.job import JobStatus
 
 
 @pytest.fixture
@@ -21,6 +28,28 @@ def fake_redis_db(monkeypatch, fake_redis_conn):
     monkeypatch.setattr(autotest_client, "REDIS_CONNECTION", fake_redis_conn)
 
 
+@pytest.fixture(autouse=True)
+def clear_caches(monkeypatch):
+    autotest_client.API_KEY_CACHE.clear()
+    autotest_client.SETTINGS_OWNER_CACHE.clear()
+    monkeypatch.setattr(autotest_client, "_SCHEMA_CACHE", (None, {}))
+
+
+@pytest.fixture(autouse=True)
+def logs(monkeypatch):
+    logs = {"access": io.StringIO(), "error": io.StringIO()}
+    monkeypatch.setattr(autotest_client.ACCESS_LOGGER, "fallback", logs["access"])
+    monkeypatch.setattr(autotest_client.ERROR_LOGGER, "fallback", logs["error"])
+    yield logs
+    autotest_client.ACCESS_LOGGER.flush()
+    autotest_client.ERROR_LOGGER.flush()
+
+
+def _log_records(logger, log):
+    logger.flush()
+    return [json.loads(line) for line in log.getvalue().splitlines()]
+
+
 class TestRegister:
     @pytest.fixture
     def credentials(self):
@@ -51,3 +80,699 @@ class TestStatus:
 
     def test_success(self, response):
         assert response.json["success"] is True
+
+
+@pytest.fixture
+def api_key(fake_redis_conn):
+    key = "test-api-key"
+    fake_redis_conn.hset(
+        "autotest:user_credentials", key=key, value=json.dumps({"auth_type": "test", "credentials": ""})
+    )
+    return key
+
+
+def _create_settings(conn, settings_id, user, test_settings=None, status="ready"):
+    conn.hset(
+        f"autotest:settings:{settings_id}",
+        mapping={"user": user, "status": status, "settings": json.dumps(test_settings or {})},
+    )
+
+
+@pytest.fixture
+def settings_id(fake_redis_conn, api_key):
+    _create_settings(fake_redis_conn, 1, api_key)
+    return 1
+
+
+def _enqueue_test(conn, test_id, settings_id, status=None, result=None):
+    conn.hset("autotest:tests", key=test_id, value=settings_id)
+    job = rq.Queue("batch", connection=conn).enqueue_call("autotest_server.run_test", job_id=str(test_id))
+    if status is not None:
+        job.set_status(status)
+    if result is not None:
+        conn.set(f"autotest:test_result:{test_id}", json.dumps(result))
+    return job
+
+
+class TestGetResults:
+    @pytest.fixture
+    def test_result(self):
+        return {"test_groups": [], "error": None}
+
+    @pytest.fixture
+    def jobs(self, fake_redis_conn, settings_id, test_result):
+        _enqueue_test(fake_redis_conn, 1, settings_id, status=JobStatus.FINISHED, result=test_result)
+        _enqueue_test(fake_redis_conn, 2, settings_id)
+        _enqueue_test(fake_redis_conn, 3, settings_id + 1, status=JobStatus.FINISHED, result=test_result)
+
+    @pytest.fixture
+    def response(self, client, api_key, jobs):
+        return client.get("/settings/1/tests/results", json={"test_ids": [1, 2, 3, 4]}, headers={"Api-Key": api_key})
+
+    def test_status_code(self, response):
+        assert response.status_code == 200
+
+    def test_finished_result(self, response, test_result):
+        assert response.json["1"] == {"status": "finished", **test_result}
+
+    def test_queued_result(self, response):
+        assert response.json["2"] == {"status": "queued"}
+
+    def test_other_settings_hidden(self, response):
+        assert response.json["3"] is None
+
+    def test_missing_job(self, response):
+        assert response.json["4"] is None
+
+    def test_finished_deleted(self, response, fake_redis_conn):
+        assert not fake_redis_conn.exists("rq:job:1", "autotest:test_result:1")
+
+    def test_queued_kept(self, response, fake_redis_conn):
+        assert fake_redis_conn.exists("rq:job:2")
+
+    def test_cancelled_while_running(self, client, api_key, settings_id, fake_redis_conn):
+        result = {"test_groups": [], "error": "Test run was cancelled", "status": "canceled"}
+        _enqueue_test(fake_redis_conn, 5, settings_id, status=JobStatus.FINISHED, result=result)
+        response = client.get("/settings/1/tests/results", json={"test_ids": [5]}, headers={"Api-Key": api_key})
+        assert response.json["5"] == result
+        assert not fake_redis_conn.exists("rq:job:5")
+
+
+class TestGetStatuses:
+    @pytest.fixture
+    def jobs(self, fake_redis_conn, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id, status=JobStatus.FINISHED)
+        _enqueue_test(fake_redis_conn, 2, settings_id)
+        _enqueue_test(fake_redis_conn, 3, settings_id)
+        _enqueue_test(fake_redis_conn, 4, settings_id + 1)
+
+    @pytest.fixture(autouse=True)
+    def small_chunks(self, monkeypatch):
+        monkeypatch.setattr(autotest_client, "BULK_CHUNK_SIZE", 2)
+
+    def test_statuses(self, client, api_key, jobs):
+        response = client.get("/settings/1/tests/status", json={"test_ids": [1, 2, 3, 4]}, headers={"Api-Key": api_key})
+        assert response.json == {"1": "finished", "2": "queued", "3": "queued", "4": None}
+
+    def test_summary(self, client, api_key, jobs):
+        response = client.get(
+            "/settings/1/tests/status", json={"test_ids": [1, 2, 3, 4], "summary": True}, headers={"Api-Key": api_key}
+        )
+        assert response.json == {"finished": 1, "queued": 2, "missing": 1}
+
+    def test_cancelled_while_running(self, client, api_key, settings_id, fake_redis_conn):
+        job = _enqueue_test(fake_redis_conn, 5, settings_id, status=JobStatus.STARTED)
+        client.delete("/settings/1/tests/cancel", json={"test_ids": [5]}, headers={"Api-Key": api_key})
+        # rq marks the job as finished when the worker returns after stopping the tests
+        job.set_status(JobStatus.FINISHED)
+        response = client.get("/settings/1/tests/status", json={"test_ids": [5]}, headers={"Api-Key": api_key})
+        assert response.json == {"5": "canceled"}
+        response = client.get(
+            "/settings/1/tests/status", json={"test_ids": [5], "summary": True}, headers={"Api-Key": api_key}
+        )
+        assert response.json == {"canceled": 1}
+
+
+class TestCancelTests:
+    @pytest.fixture
+    def jobs(self, fake_redis_conn, settings_id):
+        return [_enqueue_test(fake_redis_conn, i, settings_id) for i in range(1, 4)]
+
+    @pytest.fixture
+    def response(self, client, api_key, jobs):
+        return client.delete("/settings/1/tests/cancel", json={"test_ids": [1, 2]}, headers={"Api-Key": api_key})
+
+    def test_success(self, response):
+        assert response.json["success"] is True
+
+    def test_cancelled(self, response, jobs):
+        assert [job.get_status() for job in jobs] == [JobStatus.CANCELED, JobStatus.CANCELED, JobStatus.QUEUED]
+
+    def test_removed_from_queue(self, response, fake_redis_conn):
+        assert rq.Queue("batch", connection=fake_redis_conn).job_ids == ["3"]
+
+    def test_cancel_twice(self, client, api_key, response):
+        response = client.delete("/settings/1/tests/cancel", json={"test_ids": [1, 2]}, headers={"Api-Key": api_key})
+        assert response.status_code == 200
+
+    def test_cancel_key_set(self, response, fake_redis_conn):
+        assert fake_redis_conn.exists("autotest:cancel:1", "autotest:cancel:2") == 2
+        assert not fake_redis_conn.exists("autotest:cancel:3")
+        assert fake_redis_conn.ttl("autotest:cancel:1") > 0
+
+    def test_running_job_signalled(self, client, api_key, jobs, fake_redis_conn):
+        jobs[2].set_status(JobStatus.STARTED)
+        client.delete("/settings/1/tests/cancel", json={"test_ids": [3]}, headers={"Api-Key": api_key})
+        assert fake_redis_conn.exists("autotest:cancel:3")
+        assert jobs[2].get_status() == JobStatus.CANCELED
+
+
+class TestCreateSettings:
+    @pytest.fixture
+    def response(self, client, api_key):
+        return client.post("/settings", json={"settings": {"testers": []}}, headers={"Api-Key": api_key})
+
+    def test_settings_stored(self, response, api_key, fake_redis_conn):
+        settings_id = response.json["settings_id"]
+        assert fake_redis_conn.hgetall(f"autotest:settings:{settings_id}") == {
+            b"user": api_key.encode(),
+            b"status": b"setup",
+            b"settings": b'{"testers": []}',
+        }
+
+    def test_last_access(self, response, fake_redis_conn):
+        assert fake_redis_conn.zscore("autotest:settings_last_access", response.json["settings_id"])
+
+    def test_update_clears_error(self, client, api_key, settings_id, fake_redis_conn):
+        fake_redis_conn.hset(f"autotest:settings:{settings_id}", "error", "expired")
+        client.put(f"/settings/{settings_id}", json={"settings": {"testers": []}}, headers={"Api-Key": api_key})
+        assert not fake_redis_conn.hexists(f"autotest:settings:{settings_id}", "error")
+
+
+class TestRunTests:
+    @pytest.fixture
+    def settings_id(self, fake_redis_conn, api_key):
+        test_data = [
+            {"timeout": 10, "category": ["instructor"]},
+            {"timeout": 20, "category": ["instructor", "student"]},
+            {"timeout": 40, "category": ["student"]},
+        ]
+        test_settings = {"testers": [{"tester_type": "py", "test_data": test_data}]}
+        _create_settings(fake_redis_conn, 1, api_key, test_settings)
+        return 1
+
+    @pytest.fixture
+    def test_data(self):
+        return [{"file_url": f"http://localhost/{i}", "env_vars": {"VAR": str(i)}} for i in range(3)]
+
+    @pytest.fixture
+    def response(self, client, api_key, settings_id, test_data):
+        return client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": ["instructor"]},
+            headers={"Api-Key": api_key},
+        )
+
+    def test_test_ids(self, response):
+        assert response.json["test_ids"] == [1, 2, 3]
+
+    def test_ids_reserved(self, response, client, api_key, settings_id, test_data):
+        response = client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": ["instructor"]},
+            headers={"Api-Key": api_key},
+        )
+        assert response.json["test_ids"] == [4, 5, 6]
+
+    def test_tests_settings(self, response, fake_redis_conn, settings_id):
+        assert fake_redis_conn.hgetall("autotest:tests") == {
+            str(i).encode(): str(settings_id).encode() for i in (1, 2, 3)
+        }
+
+    def test_batch_left_for_scheduler(self, response, fake_redis_conn, api_key):
+        assert rq.Queue("batch", connection=fake_redis_conn).job_ids == []
+        assert fake_redis_conn.zrange(f"autotest:fair_share:pending:{api_key}", 0, -1) == [b"1", b"2", b"3"]
+        assert fake_redis_conn.smembers("autotest:fair_share:owners") == {api_key.encode()}
+        assert rq.job.Job.fetch("1", connection=fake_redis_conn).get_status() == JobStatus.QUEUED
+
+    def test_fair_share_by_settings(self, client, api_key, settings_id, test_data, fake_redis_conn, monkeypatch):
+        monkeypatch.setattr(autotest_client, "FAIR_SHARE_BY_SETTINGS", True)
+        client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": ["instructor"]},
+            headers={"Api-Key": api_key},
+        )
+        assert fake_redis_conn.smembers("autotest:fair_share:owners") == {f"{api_key}:{settings_id}".encode()}
+
+    def test_single_test_enqueued(self, client, api_key, settings_id, test_data, fake_redis_conn):
+        client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data[:1], "categories": ["instructor"], "request_high_priority": True},
+            headers={"Api-Key": api_key},
+        )
+        assert rq.Queue("high", connection=fake_redis_conn).job_ids == ["1"]
+        assert not fake_redis_conn.exists("autotest:fair_share:owners")
+
+    def test_job_kwargs(self, response, fake_redis_conn, test_data):
+        job = rq.job.Job.fetch("2", connection=fake_redis_conn)
+        assert job.kwargs["files_url"] == test_data[1]["file_url"]
+        assert job.kwargs["test_env_vars"] == test_data[1]["env_vars"]
+        assert job.timeout == 50
+
+    def test_job_timeout_min(self, client, api_key, settings_id, test_data, fake_redis_conn):
+        client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": ["other"]},
+            headers={"Api-Key": api_key},
+        )
+        assert rq.job.Job.fetch("1", connection=fake_redis_conn).timeout == autotest_client.MIN_JOB_TIMEOUT
+
+    @pytest.mark.parametrize("samples, expected", [(list(range(10)), 45), (list(range(20)), 45), ([0.2] * 20, 12)])
+    def test_job_timeout_from_runtimes(self, settings_id, fake_redis_conn, monkeypatch, samples, expected):
+        monkeypatch.setattr(autotest_client, "RUNTIME_PERCENTILE", 0.9)
+        monkeypatch.setattr(autotest_client, "MIN_JOB_TIMEOUT", 0)
+        monkeypatch.setattr(autotest_client, "JOB_SETUP_TIME", 0)
+        fake_redis_conn.rpush(f"autotest:settings:{settings_id}:runtimes", *samples)
+        assert autotest_client._job_timeout(settings_id, 30) == expected
+
+    def test_job_timeout_percentile(self, settings_id, fake_redis_conn, monkeypatch):
+        monkeypatch.setattr(autotest_client, "RUNTIME_PERCENTILE", 0.9)
+        fake_redis_conn.rpush(f"autotest:settings:{settings_id}:runtimes", *([0.1] * 18 + [0.5] * 2))
+        assert autotest_client._job_timeout(settings_id, 300) == 60
+
+    def test_job_timeout_longest_tests(self, settings_id, fake_redis_conn, monkeypatch):
+        monkeypatch.setattr(autotest_client, "RUNTIME_PERCENTILE", 0.9)
+        fake_redis_conn.rpush(f"autotest:settings:{settings_id}:runtimes", *([0.1] * 20))
+        assert autotest_client._job_timeout(settings_id, 300, 100) == 100 + autotest_client.JOB_SETUP_TIME
+
+    def test_callback_url(self, client, api_key, settings_id, test_data, fake_redis_conn):
+        response = client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": ["instructor"], "callback_url": "http://localhost/done"},
+            headers={"Api-Key": api_key},
+        )
+        job = rq.job.Job.fetch(str(response.json["test_ids"][0]), connection=fake_redis_conn)
+        assert job.kwargs["callback_url"] == "http://localhost/done"
+
+    def test_invalid_callback_url(self, client, api_key, settings_id, test_data):
+        response = client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": ["instructor"], "callback_url": "file:///etc/passwd"},
+            headers={"Api-Key": api_key},
+        )
+        assert response.status_code == 422
+
+
+class TestAdmission:
+    @pytest.fixture
+    def settings_id(self, fake_redis_conn, api_key):
+        test_data = [
+            {"timeout": 10, "category": ["instructor"]},
+            {"timeout": 20, "category": ["instructor", "student"]},
+            {"timeout": 40, "category": ["student"]},
+        ]
+        test_settings = {"testers": [{"tester_type": "py", "test_data": test_data}]}
+        _create_settings(fake_redis_conn, 1, api_key, test_settings)
+        return 1
+
+    @pytest.fixture
+    def run(self, client, api_key, settings_id):
+        def _run(n_tests):
+            test_data = [{"file_url": f"http://localhost/{i}"} for i in range(n_tests)]
+            return client.put(
+                f"/settings/{settings_id}/test",
+                json={"test_data": test_data, "categories": ["instructor"]},
+                headers={"Api-Key": api_key},
+            )
+
+        return _run
+
+    @pytest.fixture
+    def worker(self, fake_redis_conn):
+        fake_redis_conn.sadd("rq:workers:low", "rq:worker:1")
+        fake_redis_conn.sadd("rq:workers:batch", "rq:worker:1")
+
+    def test_no_workers(self, run):
+        assert run(1).json["estimated_wait"] is None
+
+    def test_estimate_from_runtime(self, run, worker):
+        run(1)
+        response = run(1)
+        assert response.json["estimated_wait"] == 30
+        assert response.json["estimated_start"]
+
+    def test_estimate_from_throughput(self, run, worker, fake_redis_conn, monkeypatch):
+        monkeypatch.setattr(autotest_client, "THROUGHPUT_WINDOW", 1)
+        fake_redis_conn.set(f"autotest:throughput:{int(time.time()) // 60 - 1}", 6)
+        run(1)
+        assert run(1).json["estimated_wait"] == 10
+
+    def test_batch_estimate_counts_other_owners(self, run, worker, fake_redis_conn):
+        fake_redis_conn.zadd("autotest:fair_share:pending:other", {100: 100, 101: 101, 102: 102})
+        fake_redis_conn.sadd("autotest:fair_share:owners", "other")
+        assert run(2).json["estimated_wait"] == 30
+
+    def test_max_queued(self, run, worker, fake_redis_conn, monkeypatch):
+        monkeypatch.setattr(autotest_client, "ADMISSION_MAX_QUEUED", 2)
+        response = run(3)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == str(autotest_client.ADMISSION_RETRY_AFTER)
+        assert not fake_redis_conn.exists("autotest:tests")
+
+    def test_max_wait(self, run, worker, monkeypatch):
+        monkeypatch.setattr(autotest_client, "ADMISSION_MAX_WAIT", 40)
+        run(1)
+        assert run(1).status_code == 200
+        response = run(1)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "20"
+
+    def test_max_wait_no_workers(self, run, monkeypatch):
+        monkeypatch.setattr(autotest_client, "ADMISSION_MAX_WAIT", 40)
+        assert run(1).status_code == 503
+
+    def test_memory(self, run, fake_redis_conn, monkeypatch):
+        monkeypatch.setattr(fake_redis_conn, "info", lambda *a: {"used_memory": 95, "maxmemory": 100}, raising=False)
+        response = run(1)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"]
+
+
+class TestGetPositions:
+    @pytest.fixture
+    def settings_id(self, fake_redis_conn, api_key):
+        test_settings = {"testers": [{"tester_type": "py", "test_data": [{"timeout": 10, "category": ["student"]}]}]}
+        _create_settings(fake_redis_conn, 1, api_key, test_settings)
+        return 1
+
+    @pytest.fixture
+    def run(self, client, api_key, settings_id):
+        def _run(n_tests, high_priority=False):
+            return client.put(
+                f"/settings/{settings_id}/test",
+                json={
+                    "test_data": [{"file_url": "http://localhost/"}] * n_tests,
+                    "categories": ["student"],
+                    "request_high_priority": high_priority,
+                },
+                headers={"Api-Key": api_key},
+            ).json["test_ids"]
+
+        return _run
+
+    @pytest.fixture
+    def get_positions(self, client, api_key, settings_id):
+        def _get(test_ids):
+            return client.get(
+                f"/settings/{settings_id}/tests/position", json={"test_ids": test_ids}, headers={"Api-Key": api_key}
+            ).json
+
+        return _get
+
+    @pytest.fixture(autouse=True)
+    def workers(self, fake_redis_conn):
+        fake_redis_conn.sadd("rq:workers:low", "rq:worker:1", "rq:worker:2")
+        fake_redis_conn.sadd("rq:workers:batch", "rq:worker:1")
+        fake_redis_conn.rpush("autotest:durations", 10, 20)
+
+    def test_position(self, run, get_positions):
+        ids = [run(1)[0] for _ in range(3)]
+        assert get_positions(ids)[str(ids[2])] == {
+            "status": "queued",
+            "queue": "low",
+            "position": 2,
+            "workers": 2,
+            "eta": 15,
+        }
+
+    def test_higher_priority_queues_ahead(self, run, get_positions):
+        (test_id,) = run(1)
+        run(1, high_priority=True)
+        assert get_positions([test_id])[str(test_id)]["eta"] == 7
+
+    def test_pending_batch(self, run, get_positions, fake_redis_conn):
+        fake_redis_conn.zadd("autotest:fair_share:pending:other", {100: 100, 101: 101})
+        fake_redis_conn.sadd("autotest:fair_share:owners", "other")
+        ids = run(3)
+        positions = get_positions(ids)
+        assert [positions[str(id_)]["position"] for id_ in ids] == [1, 3, 4]
+        assert positions[str(ids[2])]["eta"] == 60
+
+    def test_cancelled(self, run, get_positions, client, api_key, fake_redis_conn):
+        ids = [run(1)[0] for _ in range(2)]
+        client.delete("/settings/1/tests/cancel", json={"test_ids": ids[:1]}, headers={"Api-Key": api_key})
+        positions = get_positions(ids)
+        assert positions[str(ids[0])] == {"status": "canceled"}
+        assert positions[str(ids[1])]["position"] == 0
+
+    def test_started_and_missing(self, run, get_positions, fake_redis_conn):
+        (test_id,) = run(1)
+        rq.job.Job.fetch(str(test_id), connection=fake_redis_conn).set_status(JobStatus.STARTED)
+        assert get_positions([test_id, 99]) == {str(test_id): {"status": "started"}, "99": None}
+
+
+class TestAuthorization:
+    @pytest.fixture
+    def other_settings_id(self, fake_redis_conn):
+        _create_settings(fake_redis_conn, 2, "other")
+        return 2
+
+    def test_unknown_api_key(self, client, settings_id):
+        response = client.get(f"/settings/{settings_id}", headers={"Api-Key": "unknown"})
+        assert response.status_code == 401
+
+    def test_missing_settings(self, client, api_key):
+        response = client.get("/settings/100", headers={"Api-Key": api_key})
+        assert response.status_code == 404
+
+    def test_other_users_settings(self, client, api_key, other_settings_id):
+        response = client.get(f"/settings/{other_settings_id}", headers={"Api-Key": api_key})
+        assert response.status_code == 401
+
+    def test_access_logged(self, client, api_key, settings_id, logs):
+        client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+        (record,) = _log_records(autotest_client.ACCESS_LOGGER, logs["access"])
+        assert record["event"] == "authorized"
+        assert record["user"] == api_key
+
+    def test_unauthorized_logged(self, client, settings_id, logs):
+        client.get(f"/settings/{settings_id}", headers={"Api-Key": "unknown"})
+        (record,) = _log_records(autotest_client.ACCESS_LOGGER, logs["access"])
+        assert record["event"] == "unauthorized"
+        assert record["status"] == 401
+
+    def test_error_logged(self, client, api_key, settings_id, logs):
+        client.get(f"/settings/{settings_id}/tests/status", headers={"Api-Key": api_key})
+        (record,) = _log_records(autotest_client.ERROR_LOGGER, logs["error"])
+        assert record["status"] == 415
+
+    def test_api_key_cached(self, client, api_key, settings_id, fake_redis_conn):
+        client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+        fake_redis_conn.hdel("autotest:user_credentials", api_key)
+        response = client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+        assert response.status_code == 200
+
+    def test_reset_credentials_invalidates_cache(self, client, api_key, settings_id, fake_redis_conn):
+        client.put("/reset_credentials", json={"auth_type": "test", "credentials": "new"}, headers={"Api-Key": api_key})
+        fake_redis_conn.hdel("autotest:user_credentials", api_key)
+        response = client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+        assert response.status_code == 401
+
+
+class TestRateLimit:
+    @pytest.fixture(autouse=True)
+    def limit(self, monkeypatch):
+        monkeypatch.setattr(autotest_client, "RATE_LIMIT", 3)
+
+    def _get(self, client, api_key, settings_id):
+        return client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+
+    def test_under_limit(self, client, api_key, settings_id):
+        assert all(self._get(client, api_key, settings_id).status_code == 200 for _ in range(3))
+
+    def test_over_limit(self, client, api_key, settings_id):
+        for _ in range(3):
+            self._get(client, api_key, settings_id)
+        response = self._get(client, api_key, settings_id)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == str(autotest_client.RATE_LIMIT_WINDOW)
+
+    def test_user_limit(self, client, api_key, settings_id, fake_redis_conn):
+        fake_redis_conn.set(f"autotest:ratelimit:{api_key}:limit", 5)
+        assert all(self._get(client, api_key, settings_id).status_code == 200 for _ in range(5))
+        assert self._get(client, api_key, settings_id).status_code == 429
+
+    def test_batch_cost(self, client, api_key, settings_id, fake_redis_conn):
+        _create_settings(fake_redis_conn, settings_id, api_key, {"testers": [{"test_data": [{"timeout": 10}]}]})
+        test_data = [{"file_url": f"http://localhost/{i}"} for i in range(3)]
+        response = client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": []},
+            headers={"Api-Key": api_key},
+        )
+        assert response.status_code == 200
+        assert self._get(client, api_key, settings_id).status_code == 429
+
+    def test_batch_over_limit_rejected(self, client, api_key, settings_id, fake_redis_conn):
+        _create_settings(fake_redis_conn, settings_id, api_key, {"testers": [{"test_data": [{"timeout": 10}]}]})
+        test_data = [{"file_url": f"http://localhost/{i}"} for i in range(4)]
+        response = client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": []},
+            headers={"Api-Key": api_key},
+        )
+        assert response.status_code == 429
+        assert self._get(client, api_key, settings_id).status_code == 200
+
+
+class TestSchema:
+    @pytest.fixture
+    def schema(self, fake_redis_conn):
+        schema = {"definitions": {"installed_testers": {"enum": ["py"]}}}
+        fake_redis_conn.set("autotest:schema", json.dumps(schema))
+        fake_redis_conn.set("autotest:schema_version", "v1")
+        return schema
+
+    @pytest.fixture
+    def response(self, client, api_key, schema):
+        return client.get("/schema", headers={"Api-Key": api_key})
+
+    def test_schema(self, response, schema):
+        assert response.json == schema
+
+    def test_etag(self, response):
+        assert response.headers["ETag"] == '"v1"'
+
+    def test_not_modified(self, client, api_key, response):
+        response = client.get("/schema", headers={"Api-Key": api_key, "If-None-Match": response.headers["ETag"]})
+        assert response.status_code == 304
+
+    def test_cached_until_version_changes(self, client, api_key, response, fake_redis_conn):
+        new_schema = {"definitions": {}}
+        fake_redis_conn.set("autotest:schema", json.dumps(new_schema))
+        assert client.get("/schema", headers={"Api-Key": api_key}).json != new_schema
+        fake_redis_conn.set("autotest:schema_version", "v2")
+        assert client.get("/schema", headers={"Api-Key": api_key}).json == new_schema
+
+    def test_unversioned_schema(self, client, api_key, schema, fake_redis_conn):
+        fake_redis_conn.delete("autotest:schema_version")
+        response = client.get("/schema", headers={"Api-Key": api_key})
+        assert response.json == schema
+        assert response.headers["ETag"]
+
+
+def _finish_job(conn, job, result):
+    conn.set(f"autotest:test_result:{job.id}", json.dumps(result))
+    with conn.pipeline() as pipe:
+        job._handle_success(result_ttl=3600, pipeline=pipe)
+        pipe.execute()
+
+
+class TestGetResult:
+    @pytest.fixture
+    def test_result(self):
+        return {"test_groups": [], "error": None}
+
+    @pytest.fixture
+    def job(self, fake_redis_conn, settings_id):
+        return _enqueue_test(fake_redis_conn, 1, settings_id)
+
+    def test_finished(self, client, api_key, job, fake_redis_conn, test_result):
+        _finish_job(fake_redis_conn, job, test_result)
+        response = client.get("/settings/1/test/1", headers={"Api-Key": api_key})
+        assert response.json == {"status": "finished", **test_result}
+
+    def test_wait_for_result(self, client, api_key, job, fake_redis_conn, test_result):
+        timer = threading.Timer(0.2, _finish_job, args=(fake_redis_conn, job, test_result))
+        timer.start()
+        response = client.get("/settings/1/test/1?wait=5", headers={"Api-Key": api_key})
+        timer.join()
+        assert response.json == {"status": "finished", **test_result}
+        assert not fake_redis_conn.exists("rq:job:1")
+
+    def test_wait_timeout(self, client, api_key, job, fake_redis_conn):
+        response = client.get("/settings/1/test/1?wait=1", headers={"Api-Key": api_key})
+        assert response.json == {"status": "queued"}
+        assert fake_redis_conn.exists("rq:job:1")
+
+
+class TestGetResultStream:
+    @pytest.fixture
+    def test_groups(self):
+        return [{"time": i, "tests": []} for i in range(2)]
+
+    @pytest.fixture
+    def stream(self, fake_redis_conn, settings_id, test_groups):
+        _enqueue_test(fake_redis_conn, 1, settings_id, status=JobStatus.STARTED)
+        for group in test_groups:
+            fake_redis_conn.xadd("autotest:test_stream:1", {"result": json.dumps(group)})
+
+    def _get(self, client, api_key, query=""):
+        return client.get(f"/settings/1/test/1/stream{query}", headers={"Api-Key": api_key})
+
+    def test_all_results(self, client, api_key, stream, test_groups):
+        response = self._get(client, api_key)
+        assert response.json["test_groups"] == test_groups
+        assert response.json["done"] is False
+
+    def test_from_cursor(self, client, api_key, stream, test_groups, fake_redis_conn):
+        cursor = self._get(client, api_key).json["cursor"]
+        fake_redis_conn.xadd("autotest:test_stream:1", {"result": json.dumps({"time": 3})})
+        fake_redis_conn.xadd("autotest:test_stream:1", {"done": json.dumps({"error": None})})
+        response = self._get(client, api_key, f"?cursor={cursor}")
+        assert response.json["test_groups"] == [{"time": 3}]
+        assert response.json["done"] is True
+
+    def test_no_new_results(self, client, api_key, stream):
+        cursor = self._get(client, api_key).json["cursor"]
+        response = self._get(client, api_key, f"?cursor={cursor}")
+        assert response.json == {"test_groups": [], "cursor": cursor, "done": False}
+
+
+class TestGetFeedbackFile:
+    @pytest.fixture(autouse=True)
+    def small_chunks(self, monkeypatch):
+        monkeypatch.setattr(autotest_client, "FEEDBACK_CHUNK_SIZE", 4)
+
+    @pytest.fixture
+    def data(self, fake_redis_conn, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id)
+        data = gzip.compress(b"feedback contents")
+        fake_redis_conn.set("autotest:feedback_file:1:5", data)
+        fake_redis_conn.sadd("autotest:feedback_files:1", 5)
+        return data
+
+    def _get(self, client, api_key, headers=None):
+        return client.get("/settings/1/test/1/feedback/5", headers={"Api-Key": api_key, **(headers or {})})
+
+    def test_download(self, client, api_key, data, fake_redis_conn):
+        response = self._get(client, api_key)
+        assert response.data == data
+        assert response.headers["Content-Length"] == str(len(data))
+        assert not fake_redis_conn.exists("autotest:feedback_file:1:5")
+        assert not fake_redis_conn.exists("autotest:feedback_files:1")
+
+    def test_range(self, client, api_key, data, fake_redis_conn):
+        response = self._get(client, api_key, {"Range": "bytes=0-9"})
+        assert response.status_code == 206
+        assert response.data == data[:10]
+        assert response.headers["Content-Range"] == f"bytes 0-9/{len(data)}"
+        assert fake_redis_conn.exists("autotest:feedback_file:1:5")
+
+    def test_resume_range(self, client, api_key, data, fake_redis_conn):
+        response = self._get(client, api_key, {"Range": "bytes=10-"})
+        assert response.data == data[10:]
+        assert not fake_redis_conn.exists("autotest:feedback_file:1:5")
+
+    def test_unsatisfiable_range(self, client, api_key, data):
+        response = self._get(client, api_key, {"Range": f"bytes={len(data)}-"})
+        assert response.status_code == 416
+
+    def test_missing(self, client, api_key, settings_id, fake_redis_conn):
+        _enqueue_test(fake_redis_conn, 1, settings_id)
+        assert self._get(client, api_key).status_code == 404
+
+
+class TestGetFeedbackFiles:
+    @pytest.fixture
+    def files(self, fake_redis_conn, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id)
+        files = {str(i): gzip.compress(f"feedback {i}".encode()) for i in (2, 10)}
+        for id_, data in files.items():
+            fake_redis_conn.set(f"autotest:feedback_file:1:{id_}", data)
+            fake_redis_conn.sadd("autotest:feedback_files:1", id_)
+        return files
+
+    def test_archive(self, client, api_key, files):
+        response = client.get("/settings/1/test/1/feedback", headers={"Api-Key": api_key})
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zip_file:
+            assert zip_file.namelist() == ["2", "10"]
+            assert {name: zip_file.read(name) for name in zip_file.namelist()} == files
+
+    def test_deleted(self, client, api_key, files, fake_redis_conn):
+        assert client.get("/settings/1/test/1/feedback", headers={"Api-Key": api_key}).data
+        assert not fake_redis_conn.keys("autotest:feedback_file*")
+
+    def test_missing(self, client, api_key, settings_id, fake_redis_conn):
+        _enqueue_test(fake_redis_conn, 1, settings_id)
+        assert client.get("/settings/1/test/1/feedback", headers={"Api-Key": api_key}).status_code == 404
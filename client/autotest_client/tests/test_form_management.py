@@ -0,0 +1,95 @@
+import copy
+import pytest
+from autotest_client import form_management
+
+
+@pytest.fixture
+def schema():
+    def tester_schema(tester_type, default_timeout):
+        return {
+            "type": "object",
+            "properties": {
+                "tester_type": {"type": "string", "enum": [tester_type]},
+                "test_data": {
+                    "type": "array",
+                    "minItems": 1,
+                    "items": {
+                        "type": "object",
+                        "required": ["script_files", "timeout"],
+                        "properties": {
+                            "script_files": {
+                                "type": "array",
+                                "minItems": 1,
+                                "items": {"$ref": "#/definitions/files_list"},
+                            },
+                            "category": {"type": "array", "items": {"$ref": "#/definitions/test_data_categories"}},
+                            "timeout": {"type": "integer", "default": default_timeout},
+                        },
+                    },
+                },
+            },
+        }
+
+    return {
+        "definitions": {
+            "files_list": {"type": "string", "enum": []},
+            "test_data_categories": {"type": "string", "enum": ["instructor"], "enumNames": ["instructor"]},
+            "installed_testers": {"type": "string", "enum": ["py", "java"]},
+            "tester_schemas": {"oneOf": [tester_schema("py", 30), tester_schema("java", 60)]},
+        },
+        "type": "object",
+        "required": ["testers"],
+        "properties": {
+            "testers": {
+                "type": "array",
+                "minItems": 1,
+                "items": {
+                    "type": "object",
+                    "required": ["tester_type", "test_data"],
+                    "properties": {"tester_type": {"$ref": "#/definitions/installed_testers"}},
+                    "dependencies": {"tester_type": {"$ref": "#/definitions/tester_schemas"}},
+                },
+            }
+        },
+    }
+
+
+@pytest.fixture
+def test_specs():
+    return {"testers": [{"tester_type": "java", "test_data": [{"script_files": ["test.java"], "category": ["a"]}]}]}
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    form_management._COMPILED_VALIDATORS.clear()
+
+
+class TestValidateAgainstSchema:
+    def test_valid(self, schema, test_specs):
+        assert form_management.validate_against_schema(test_specs, schema, ["test.java"]) is None
+
+    def test_defaults_from_matching_subschema(self, schema, test_specs):
+        form_management.validate_against_schema(test_specs, schema, ["test.java"])
+        assert test_specs["testers"][0]["test_data"][0]["timeout"] == 60
+
+    def test_missing_file(self, schema, test_specs):
+        assert form_management.validate_against_schema(test_specs, schema, ["other.java"]) is not None
+
+    def test_missing_required_without_default(self, schema):
+        test_specs = {"testers": [{"tester_type": "py", "test_data": [{"timeout": 10}]}]}
+        assert form_management.validate_against_schema(test_specs, schema, []) is not None
+
+    def test_schema_not_modified(self, schema, test_specs):
+        original = copy.deepcopy(schema)
+        form_management.validate_against_schema(test_specs, schema, ["test.java"], version="v1")
+        assert schema == original
+
+    def test_validator_cached(self, schema, test_specs):
+        form_management.validate_against_schema(test_specs, schema, ["test.java"], version="v1")
+        validator = form_management._COMPILED_VALIDATORS[("v1", form_management.Draft7Validator)]
+        form_management.validate_against_schema(test_specs, schema, ["test.java"], version="v1")
+        assert form_management._COMPILED_VALIDATORS[("v1", form_management.Draft7Validator)] is validator
+
+    def test_cached_validator_uses_new_files(self, schema, test_specs):
+        form_management.validate_against_schema(copy.deepcopy(test_specs), schema, ["test.java"], version="v1")
+        assert form_management.validate_against_schema(test_specs, schema, ["other.java"], version="v1") is not None
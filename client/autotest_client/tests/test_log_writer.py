@@ -0,0 +1,84 @@
+import io
+import json
+import threading
+import pytest
+from autotest_client.log_writer import LogWriter
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "access.log"
+
+
+class _BlockingStream(io.StringIO):
+    """A stream that blocks writes until unblock is set"""
+
+    def __init__(self):
+        super().__init__()
+        self.writing = threading.Event()
+        self.unblock = threading.Event()
+
+    def write(self, data):
+        self.writing.set()
+        self.unblock.wait(5)
+        return super().write(data)
+
+
+def _records(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+class TestLogWriter:
+    def test_writes_json_lines(self, path):
+        writer = LogWriter(str(path), flush_interval=0)
+        writer.write({"event": "a"})
+        writer.write({"event": "b"})
+        writer.flush()
+        assert _records(path) == [{"event": "a"}, {"event": "b"}]
+
+    def test_rotates_by_size(self, path):
+        writer = LogWriter(str(path), flush_interval=0, batch_size=1, max_bytes=20, backup_count=2)
+        for i in range(4):
+            writer.write({"event": i})
+            writer.flush()
+        assert _records(path) == [{"event": 3}]
+        assert _records(path.with_name("access.log.1")) == [{"event": 2}]
+        assert _records(path.with_name("access.log.2")) == [{"event": 1}]
+        assert not path.with_name("access.log.3").exists()
+
+    def test_rotates_by_time(self, path):
+        writer = LogWriter(str(path), flush_interval=0, rotate_interval=0.01)
+        writer.write({"event": 0})
+        writer.flush()
+        writer._opened_at -= 1
+        writer.write({"event": 1})
+        writer.flush()
+        assert _records(path) == [{"event": 1}]
+        assert _records(path.with_name("access.log.1")) == [{"event": 0}]
+
+    def test_shared_path_rotated_by_one_writer(self, path):
+        # each writer stands in for a separate process writing to the same log file
+        writers = [
+            LogWriter(str(path), flush_interval=0, batch_size=1, max_bytes=30, backup_count=10) for _ in range(2)
+        ]
+        for i in range(6):
+            writers[i % 2].write({"event": i})
+            writers[i % 2].flush()
+        backups = sorted(path.parent.glob("access.log.[0-9]*"), key=lambda p: -int(p.suffix[1:]))
+        records = [record for backup in backups for record in _records(backup)] + _records(path)
+        assert records == [{"event": i} for i in range(6)]
+        assert all(len(p.read_text()) <= 30 for p in [*backups, path])
+
+    def test_drops_when_full(self):
+        stream = _BlockingStream()
+        writer = LogWriter(fallback=stream, queue_size=1, flush_interval=0)
+        writer.write({"event": 0})
+        stream.writing.wait(5)
+        writer.write({"event": 1})
+        writer.write({"event": 2})
+        assert writer.dropped == 1
+        stream.unblock.set()
+        writer.flush()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [r["event"] for r in records] == [0, 1, "dropped"]
+        assert records[-1]["count"] == 1
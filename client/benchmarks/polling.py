@@ -0,0 +1,125 @@
+"""
+Benchmark for clients waiting for test results from a running API.
+
+This enqueues test jobs directly in redis, starts a fake worker that finishes each job after a delay and starts one
+client thread per test that waits for the test's result. It reports how long clients waited after their test
+finished before receiving the result, and how many requests were made.
+
+Start the API using the same redis database first, for example either of:
+
+    flask --app autotest_client run --with-threads
+    uvicorn autotest_client.asgi:app
+
+then run:
+
+    python benchmarks/polling.py --url http://localhost:5000 --tests 1000 --wait 30
+"""
+
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+import redis
+import rq
+from rq.job import JobStatus
+from rq.results import Result
+
+
+def _setup(conn, n_tests):
+    api_key = f"benchmark-{uuid.uuid4()}"
+    settings_id = conn.incr("autotest:settings_id")
+    test_ids = [conn.incr("autotest:tests_id") for _ in range(n_tests)]
+    conn.hset("autotest:user_credentials", api_key, json.dumps({"auth_type": "benchmark", "credentials": ""}))
+    conn.hset(f"autotest:settings:{settings_id}", mapping={"user": api_key, "status": "ready", "settings": "{}"})
+    conn.hset("autotest:tests", mapping={test_id: settings_id for test_id in test_ids})
+    queue = rq.Queue(f"benchmark-{uuid.uuid4()}", connection=conn)
+    jobs = [queue.enqueue_call("autotest_server.run_test", job_id=str(test_id)) for test_id in test_ids]
+    return api_key, settings_id, jobs
+
+
+def _finish(conn, jobs, delay, finished_at):
+    """Finish each job delay seconds after the benchmark starts, spreading them over a second"""
+    start = time.monotonic()
+    for i, job in enumerate(jobs):
+        time.sleep(max(0, start + delay + i / len(jobs) - time.monotonic()))
+        with conn.pipeline() as pipe:
+            pipe.set(f"autotest:test_result:{job.id}", json.dumps({"test_groups": [], "error": None}))
+            job.set_status(JobStatus.FINISHED, pipeline=pipe)
+            Result.create(job, Result.Type.SUCCESSFUL, ttl=3600, return_value=None, pipeline=pipe)
+            finished_at[job.id] = time.monotonic()
+            pipe.execute()
+
+
+def _client(url, api_key, settings_id, test_id, wait, interval, stats):
+    parsed = urlparse(url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=wait + 30)
+    path = f"/settings/{settings_id}/test/{test_id}" + (f"?wait={wait}" if wait else "")
+    requests = 0
+    try:
+        while True:
+            conn.request("GET", path, headers={"Api-Key": api_key})
+            response = conn.getresponse()
+            body = json.loads(response.read())
+            requests += 1
+            if response.status != 200:
+                stats["errors"].append(f"{response.status}: {body}")
+                return
+            if body["status"] not in ("queued", "started", "deferred", "scheduled"):
+                stats["received_at"][str(test_id)] = time.monotonic()
+                return
+            if not wait:
+                time.sleep(interval)
+    except Exception as e:
+        stats["errors"].append(repr(e))
+    finally:
+        stats["requests"].append(requests)
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--redis-url", default="redis://localhost:6379")
+    parser.add_argument("--tests", type=int, default=200, help="number of concurrent clients (one test each)")
+    parser.add_argument("--delay", type=float, default=2, help="seconds before tests start finishing")
+    parser.add_argument("--wait", type=int, default=30, help="long-poll wait in seconds, 0 to poll instead")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between polls when --wait is 0")
+    args = parser.parse_args()
+
+    conn = redis.Redis.from_url(args.redis_url)
+    api_key, settings_id, jobs = _setup(conn, args.tests)
+    stats = {"received_at": {}, "requests": [], "errors": []}
+    finished_at = {}
+
+    start = time.monotonic()
+    threads = [
+        threading.Thread(target=_client, args=(args.url, api_key, settings_id, job.id, args.wait, args.interval, stats))
+        for job in jobs
+    ]
+    for thread in threads:
+        thread.start()
+    _finish(conn, jobs, args.delay, finished_at)
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(stats["received_at"][id_] - finished_at[id_] for id_ in stats["received_at"])
+    print(f"clients: {args.tests}, mode: {f'wait={args.wait}' if args.wait else f'poll every {args.interval}s'}")
+    print(f"elapsed: {elapsed:.2f}s, requests: {sum(stats['requests'])}, errors: {len(stats['errors'])}")
+    if latencies:
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0]
+        print(
+            f"latency after finish: median {statistics.median(latencies) * 1000:.1f}ms, "
+            f"p95 {p95 * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms"
+        )
+    for error in stats["errors"][:5]:
+        print(f"error: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,24 +8,42 @@ import subprocess
 import signal
 import socket
 import getpass
-import requests
 import gzip
+import uuid
+import logging
 import redis
 import importlib
 import psycopg2
 import mimetypes
 import rq
+from rq.job import JobStatus
+from rq.timeouts import JobTimeoutException
 from typing import Optional, Dict, Union, List, Tuple, Callable, Type
 from types import TracebackType
 
 from .config import config
-from .utils import loads_partial_json, set_rlimits_before_test, extract_zip_stream, recursive_iglob, copy_tree
+from .callbacks import enqueue_callback
+from . import prefetch, scheduler, settings_store, templates
+from .sandbox_agent import AgentClient, AgentError, ForkserverClient, process_start_time
+from .utils import loads_partial_json, set_rlimits_before_test, rlimits_for_tests, recursive_iglob
 
 DEFAULT_ENV_DIR = "defaultvenv"
+DURATIONS_KEY = "autotest:durations"
+MAX_DURATION_SAMPLES = 100
+CANCEL_KEY = "autotest:cancel:{}"
+CANCEL_POLL_INTERVAL = 1
+CANCELLED_MESSAGE = "Test run was cancelled"
 TEST_SCRIPT_DIR = os.path.join(config["workspace"], "scripts")
+AGENT_DIR = os.path.join(config["workspace"], "agents")
+FORKSERVER_DIR = os.path.join(config["workspace"], "forkservers")
 
 ResultData = Dict[str, Union[str, int, type(None), Dict]]
 
+logger = logging.getLogger(__name__)
+
+_AGENTS: Dict[str, AgentClient] = {}
+_FORKSERVERS: Dict[str, ForkserverClient] = {}
+
 
 def redis_connection() -> redis.Redis:
     return rq.get_current_job().connection
@@ -78,18 +96,208 @@ def _create_test_group_result(
     return result
 
 
+def _publish_test_stream(test_id: Union[int, str], fields: Dict[str, str]) -> None:
+    """
+    Add an entry containing fields to the stream for test_id so that clients can read results
+    while the test is still running.
+    """
+    key = f"autotest:test_stream:{test_id}"
+    with redis_connection().pipeline() as pipe:
+        pipe.xadd(key, fields)
+        pipe.expire(key, config["results", "expiry"])
+        pipe.execute()
+
+
+def _record_started(test_id: Union[int, str]) -> None:
+    """
+    Remove test_id from the sets the API uses to look up the positions of tests waiting in a queue and let the
+    scheduler know that there may be room for another job in its queue.
+    """
+    with redis_connection().pipeline() as pipe:
+        for queue_name in scheduler.QUEUE_NAMES:
+            pipe.zrem(scheduler.position_key(queue_name), test_id)
+        pipe.lpush(scheduler.STARTED_KEY, test_id)
+        pipe.ltrim(scheduler.STARTED_KEY, 0, 0)
+        pipe.execute()
+
+
+def _record_finished(duration: float) -> None:
+    """
+    Count a finished test in the current minute's throughput count and add its duration to the list of recent
+    durations so that the API can estimate how long new tests will wait before they start.
+    """
+    key = f"autotest:throughput:{int(time.time()) // 60}"
+    with redis_connection().pipeline() as pipe:
+        pipe.incr(key)
+        pipe.expire(key, 3600)
+        pipe.lpush(DURATIONS_KEY, duration)
+        pipe.ltrim(DURATIONS_KEY, 0, MAX_DURATION_SAMPLES - 1)
+        pipe.execute()
+
+
+def _agent(test_username: str) -> Optional[AgentClient]:
+    """
+    Return a connection to the agent that runs commands as test_username (see sandbox_agent), starting the agent
+    if it isn't running yet. Return None if test_username is the current user or if the agent could not be
+    started, in which case commands are run with sudo instead.
+    """
+    if test_username == getpass.getuser():
+        return None
+    agent = _AGENTS.get(test_username)
+    if agent is None:
+        agent = AgentClient(test_username, os.path.join(AGENT_DIR, f"{test_username}.sock"))
+        _AGENTS[test_username] = agent
+    try:
+        agent.connect()
+    except AgentError as e:
+        logger.warning(f"running commands as {test_username} with sudo: {e}")
+        return None
+    return agent
+
+
+def _forkserver(test_username: str, key: str, python: str, tester_type: str) -> Optional[ForkserverClient]:
+    """
+    Return a connection to the forkserver identified by key that runs tests with the tester_type tester and python
+    as test_username (see sandbox_agent), starting it if it isn't running yet. Return None if forkservers are disabled
+    or the forkserver could not be started.
+    """
+    if not config["forkserver", "enabled"]:
+        return None
+    socket_path = os.path.join(FORKSERVER_DIR, test_username, f"{key}.sock")
+    server = _FORKSERVERS.get(socket_path)
+    if server is None:
+        server = ForkserverClient(
+            test_username,
+            socket_path,
+            python,
+            tester_type,
+            preload=config["forkserver", "preload"],
+            idle_timeout=config["forkserver", "idle_timeout"],
+            command_prefix=[] if test_username == getpass.getuser() else None,
+        )
+        _FORKSERVERS[socket_path] = server
+    try:
+        server.connect()
+    except AgentError as e:
+        logger.warning(f"running tests without a forkserver: {e}")
+        return None
+    # so that the forkserver isn't killed with the test user's other processes
+    with open(f"{os.path.splitext(socket_path)[0]}.pid", "w") as f:
+        f.write("{} {}".format(*server.identity))
+    return server
+
+
+def _shadows_forkserver_modules(server: ForkserverClient, path: str) -> bool:
+    """
+    Return True if a module or package at the top level of path has the same name as a module that server imported
+    before running any tests. A test script run without the forkserver would import the file in path instead, so the
+    tests must be run without the forkserver to behave the same.
+    """
+    names = set()
+    try:
+        modules = server.modules()
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.isfile(os.path.join(entry.path, "__init__.py")):
+                    names.add(entry.name)
+            elif entry.name.endswith((".py", ".pyc", ".so")):
+                names.add(entry.name.partition(".")[0])
+    except (AgentError, OSError):
+        return True
+    return not names.isdisjoint(modules)
+
+
+def _running_forkservers(test_username: str) -> List[Tuple[int, int]]:
+    """
+    Return the pid and start time of each forkserver for test_username that is still running and remove the files
+    of the forkservers that are not.
+    """
+    directory = os.path.join(FORKSERVER_DIR, test_username)
+    running = []
+    if not os.path.isdir(directory):
+        return running
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(".pid"):
+            continue
+        with open(entry.path) as f:
+            try:
+                pid, start = (int(value) for value in f.read().split())
+            except ValueError:
+                pid, start = None, None
+        if pid is not None and process_start_time(pid) == start:
+            running.append((pid, start))
+        else:
+            for path in (entry.path, f"{os.path.splitext(entry.path)[0]}.sock"):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+    return running
+
+
 def _kill_user_processes(test_username: str) -> None:
     """
-    Kill all processes that test_username is able to kill
+    Kill all processes that test_username is able to kill (except forkservers when they are killed by the agent)
     """
+    agent = _agent(test_username)
+    if agent is not None:
+        try:
+            agent.kill_all(keep=_running_forkservers(test_username))
+            return
+        except AgentError as e:
+            logger.warning(f"killing processes of {test_username} with sudo: {e}")
     kill_cmd = f"sudo -u {test_username} -- bash -c 'kill -KILL -1'"
     subprocess.run(kill_cmd, shell=True)
 
 
-def _create_test_script_command(tester_type: str) -> str:
+def _kill_test_processes(proc: subprocess.Popen, test_username: str) -> None:
     """
-    Return string representing a command line command to
-    run tests.
+    Kill the test process proc and any processes it started
+    """
+    if test_username == getpass.getuser():
+        pgrp = os.getpgid(proc.pid)
+        os.killpg(pgrp, signal.SIGKILL)
+    else:
+        _kill_user_processes(test_username)
+
+
+def _cancelled(test_id: Union[int, str]) -> bool:
+    """Return True if the API has been asked to cancel the test with id test_id"""
+    return bool(redis_connection().exists(CANCEL_KEY.format(test_id)))
+
+
+class TestRunCancelled(Exception):
+    """Raised while waiting for a test process if the test run is cancelled"""
+
+
+def _wait_for_test(
+    proc: subprocess.Popen, input_: str, timeout: Optional[int], test_id: Union[int, str]
+) -> Tuple[str, str]:
+    """
+    Send input_ to proc and wait at most timeout seconds for it to finish, checking every CANCEL_POLL_INTERVAL seconds
+    whether the test run has been cancelled. Return proc's stdout and stderr.
+
+    Raises subprocess.TimeoutExpired if proc does not finish in time and TestRunCancelled if the test run is cancelled.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        interval = CANCEL_POLL_INTERVAL
+        if deadline is not None:
+            interval = max(0.0, min(interval, deadline - time.monotonic()))
+        try:
+            return proc.communicate(input=input_, timeout=interval)
+        except subprocess.TimeoutExpired:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(proc.args, timeout)
+            if _cancelled(test_id):
+                raise TestRunCancelled(CANCELLED_MESSAGE)
+        # the input has been sent (or is still being sent) and must not be passed to communicate again
+        input_ = None
+
+
+def _create_test_script(tester_type: str) -> str:
+    """
+    Return the python code that runs tests with the tester_type tester.
     """
     import_line = f"from testers.{tester_type}.{tester_type}_tester import {tester_type.capitalize()}Tester as Tester"
     python_lines = [
@@ -99,8 +307,15 @@ def _create_test_script_command(tester_type: str) -> str:
         "from testers.specs import TestSpecs",
         "Tester(specs=TestSpecs.from_json(sys.stdin.read())).run()",
     ]
-    python_str = "; ".join(python_lines)
-    return f"\"${{PYTHON}}\" -c '{python_str}'"
+    return "; ".join(python_lines)
+
+
+def _create_test_script_command(tester_type: str) -> str:
+    """
+    Return string representing a command line command to
+    run tests.
+    """
+    return f"\"${{PYTHON}}\" -c '{_create_test_script(tester_type)}'"
 
 
 def get_available_port(min_, max_, host: str = "localhost") -> str:
@@ -145,8 +360,14 @@ def _get_feedback(test_data, tests_path, test_id) -> tuple[dict, str]:
                 conn = redis_connection()
                 id_ = conn.incr("autotest:feedback_files_id")
                 key = f"autotest:feedback_file:{test_id}:{id_}"
-                conn.set(key, gzip.compress(f.read()))
-                conn.expire(key, 3600)  # TODO: make this configurable
+                # the ids of each test's feedback files are indexed so that clients can find them without a scan
+                index_key = f"autotest:feedback_files:{test_id}"
+                with conn.pipeline() as pipe:
+                    pipe.set(key, gzip.compress(f.read()))
+                    pipe.expire(key, 3600)  # TODO: make this configurable
+                    pipe.sadd(index_key, id_)
+                    pipe.expire(index_key, 3600)
+                    pipe.execute()
                 feedback.append(
                     {
                         "filename": feedback_file,
@@ -183,60 +404,94 @@ def _run_test_specs(
     test_username: str,
     test_id: Union[int, str],
     test_env_vars: Dict[str, str],
+    forkserver_key: Optional[str] = None,
+    results: Optional[List[ResultData]] = None,
 ) -> List[ResultData]:
     """
     Run each test script in test_scripts in the tests_path directory using the
     command cmd. Return the results.
+
+    The result of each test script is appended to results (if given) as soon
+    as it finishes, so the results of the test scripts that finished are kept
+    if the job times out.
+
+    If forkservers are enabled, the test scripts are run by the forkserver for
+    each tester instead (identified by forkserver_key and the tester's index).
+
+    If the test run is cancelled, the test script that is running is killed and
+    the remaining test scripts are skipped.
     """
-    results = []
+    results = [] if results is None else results
+    agent = _agent(test_username)
 
-    for settings in test_settings["testers"]:
+    for i, settings in enumerate(test_settings["testers"]):
         tester_type = settings["tester_type"]
+        server = None
+        if forkserver_key is not None and "PYTHON" in settings.get("_env", {}):
+            server = _forkserver(test_username, f"{forkserver_key}-{i}", settings["_env"]["PYTHON"], tester_type)
 
         cmd_str = _create_test_script_command(tester_type)
         args = cmd.format(cmd_str)
+        script = _create_test_script(tester_type)
 
         for test_data in settings["test_data"]:
             test_category = test_data.get("category", [])
             if set(test_category) & set(categories):
+                if _cancelled(test_id):
+                    return results
                 start = time.time()
                 out, err = "", ""
                 timeout_expired = None
+                cancelled = False
                 timeout = test_data.get("timeout")
                 try:
                     env = settings.get("_env", {})
                     env_vars = {**os.environ, **_get_env_vars(test_username), **env}
                     env_vars = _update_env_vars(env_vars, test_env_vars)
-                    proc = subprocess.Popen(
-                        args,
-                        start_new_session=True,
-                        cwd=tests_path,
-                        shell=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        stdin=subprocess.PIPE,
-                        preexec_fn=set_rlimits_before_test,
-                        universal_newlines=True,
-                        env={**os.environ, **env_vars, **env},
-                        executable="/bin/bash",
-                    )
+                    if server is not None and not _shadows_forkserver_modules(server, tests_path):
+                        proc = server.run(tests_path, {**os.environ, **env_vars, **env}, rlimits_for_tests())
+                    elif agent is not None:
+                        proc_env = {**os.environ, **env_vars, **env}
+                        proc = agent.spawn(
+                            [proc_env["PYTHON"], "-c", script], tests_path, proc_env, rlimits_for_tests()
+                        )
+                    else:
+                        proc = subprocess.Popen(
+                            args,
+                            start_new_session=True,
+                            cwd=tests_path,
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            stdin=subprocess.PIPE,
+                            preexec_fn=set_rlimits_before_test,
+                            universal_newlines=True,
+                            env={**os.environ, **env_vars, **env},
+                            executable="/bin/bash",
+                        )
                     try:
                         settings_json = json.dumps({**settings, "test_data": test_data})
-                        out, err = proc.communicate(input=settings_json, timeout=timeout)
+                        out, err = _wait_for_test(proc, settings_json, timeout, test_id)
                     except subprocess.TimeoutExpired:
-                        if test_username == getpass.getuser():
-                            pgrp = os.getpgid(proc.pid)
-                            os.killpg(pgrp, signal.SIGKILL)
-                        else:
-                            _kill_user_processes(test_username)
+                        _kill_test_processes(proc, test_username)
                         out, err = proc.communicate()
-                        if err == "Killed\n":  # Default message from shell
+                        # Default message from shell (processes started by the agent aren't run by a shell)
+                        if err in ("Killed\n", ""):
                             test_group_name = test_data.get("extra_info", {}).get("name", "").strip()
                             if test_group_name:
                                 err = f"Tests for {test_group_name} did not complete within time limit ({timeout}s)\n"
                             else:
                                 err = f"Tests did not complete within time limit ({timeout}s)\n"
                         timeout_expired = timeout
+                    except TestRunCancelled as e:
+                        _kill_test_processes(proc, test_username)
+                        out, _ = proc.communicate()
+                        err = f"{e}\n"
+                        cancelled = True
+                except JobTimeoutException as e:
+                    # the result of this test script is still recorded (below) before the job is stopped
+                    err += f"{e}\n"
+                    raise
                 except Exception as e:
                     err += "\n\n{}".format(e)
                 finally:
@@ -246,15 +501,42 @@ def _run_test_specs(
                     if feedback_errors:
                         msg = "Cannot find feedback file(s): " + ", ".join(feedback_errors)
                         err = err + "\n\n" + msg if err else msg
-                    results.append(_create_test_group_result(out, err, duration, extra_info, feedback, timeout_expired))
+                    result = _create_test_group_result(out, err, duration, extra_info, feedback, timeout_expired)
+                    results.append(result)
+                    _publish_test_stream(test_id, {"result": json.dumps(result)})
+                if cancelled:
+                    return results
     return results
 
 
+def _remove_contents(path: str) -> None:
+    """
+    Remove everything in the path directory. The directory itself is not removed since its group
+    ownership has to be set with sudo (and that is only done in ../install.sh)
+    """
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+
 def _clear_working_directory(tests_path: str, test_username: str) -> None:
     """
     Run commands that clear the tests_path working directory, as well
     as clearing any files or directories owned by test_username in the /tmp directory
     """
+    agent = _agent(test_username)
+    if agent is not None:
+        try:
+            agent.clean(tests_path)
+            _remove_contents(tests_path)
+            return
+        except AgentError as e:
+            logger.warning(f"clearing files of {test_username} with sudo: {e}")
     if test_username != getpass.getuser():
         sticky_cmd = f"sudo -u {test_username} -- bash -c 'chmod -Rf -t {tests_path}'"
         chmod_cmd = f"sudo -u {test_username} -- bash -c 'chmod -Rf ugo+rwX {tests_path}'"
@@ -286,10 +568,15 @@ def _stop_tester_processes(test_username: str) -> None:
         _kill_user_processes(test_username)
 
 
-def _setup_files(settings_id: int, user: str, files_url: str, tests_path: str, test_username: str) -> None:
+def _setup_files(
+    settings_id: int, test_id: Union[int, str], user: str, files_url: str, tests_path: str, test_username: str
+) -> None:
     """
-    Copy test script files and student files to the working directory tests_path,
-    then make it the current working directory.
+    Add test script files and student files to the working directory tests_path,
+    then make it the current working directory. Student files that have already
+    been downloaded by the prefetch process are moved instead of downloaded again.
+    Test script files are linked from the settings' template (see templates),
+    which is created the first time it is needed.
     The following permissions are also set:
         - tests_path directory:     rwxrwx--T
         - test subdirectories:      rwxrwx--T
@@ -297,23 +584,19 @@ def _setup_files(settings_id: int, user: str, files_url: str, tests_path: str, t
         - student subdirectories:   rwxrwx---
         - student files:            rw-rw----
     """
-    creds = json.loads(redis_connection().hget("autotest:user_credentials", key=user))
-    r = requests.get(files_url, headers={"Authorization": f"{creds['auth_type']} {creds['credentials']}"})
-    extract_zip_stream(r.content, tests_path)
-    for fd, file_or_dir in recursive_iglob(tests_path):
-        if fd == "d":
+    if prefetch.claim(test_id, tests_path):
+        for fd, file_or_dir in recursive_iglob(tests_path):
             os.chmod(file_or_dir, 0o770)
-        else:
-            os.chmod(file_or_dir, 0o770)
-        shutil.chown(file_or_dir, group=test_username)
-    test_script_dir = json.loads(redis_connection().hget("autotest:settings", settings_id))["_files"]
-    script_files = copy_tree(test_script_dir, tests_path)
-    for fd, file_or_dir in script_files:
-        if fd == "d":
-            os.chmod(file_or_dir, 0o1770)
-        else:
-            os.chmod(file_or_dir, 0o750)
-        shutil.chown(file_or_dir, group=test_username)
+            shutil.chown(file_or_dir, group=test_username)
+    else:
+        prefetch.fetch_files(redis_connection(), user, files_url, tests_path, mode=0o770, group=test_username)
+    test_script_dir, files_version = settings_store.get_fields(
+        redis_connection(), settings_id, "files", "files_version"
+    )
+    # settings whose files were last updated before templates were added don't have a version
+    template = templates.template_dir(test_script_dir, files_version or templates.DEFAULT_VERSION, test_username)
+    templates.build(test_script_dir, template, test_username)
+    templates.populate(template, tests_path, test_username, hardlink=test_username != getpass.getuser())
 
 
 def tester_user() -> Tuple[str, str]:
@@ -340,28 +623,70 @@ def tester_user() -> Tuple[str, str]:
     return user_name, user_workspace
 
 
-def run_test(settings_id, test_id, files_url, categories, user, test_env_vars):
+def run_test(settings_id, test_id, files_url, categories, user, test_env_vars, callback_url=None):
     results = []
     error = None
+    cancelled = False
+    start = time.time()
+    timeout = 0
+    _record_started(test_id)
     try:
-        settings = json.loads(redis_connection().hget("autotest:settings", key=settings_id))
-        settings["_last_access"] = int(time.time())
-        redis_connection().hset("autotest:settings", key=settings_id, value=json.dumps(settings))
+        settings, files_version = settings_store.get_fields(
+            redis_connection(), settings_id, "settings", "files_version"
+        )
+        settings = json.loads(settings)
+        # a new forkserver is started when the settings are updated since its tester environment may have changed
+        forkserver_key = f"{settings_id}-{(files_version or templates.DEFAULT_VERSION)[:12]}"
+        timeout = settings_store.category_timeout(settings, categories)
+        settings_store.touch(redis_connection(), settings_id)
         test_username, tests_path = tester_user()
         try:
             _clear_working_directory(tests_path, test_username)
-            _setup_files(settings_id, user, files_url, tests_path, test_username)
-            cmd = run_test_command(test_username=test_username)
-            results = _run_test_specs(cmd, settings, categories, tests_path, test_username, test_id, test_env_vars)
+            if not _cancelled(test_id):
+                _setup_files(settings_id, test_id, user, files_url, tests_path, test_username)
+                cmd = run_test_command(test_username=test_username)
+                _run_test_specs(
+                    cmd,
+                    settings,
+                    categories,
+                    tests_path,
+                    test_username,
+                    test_id,
+                    test_env_vars,
+                    forkserver_key,
+                    results,
+                )
         finally:
             _stop_tester_processes(test_username)
             _clear_working_directory(tests_path, test_username)
+        # cancelled runs are not recorded since they say nothing about how long the tests take
+        cancelled = _cancelled(test_id)
+        if cancelled:
+            error = CANCELLED_MESSAGE
+        else:
+            settings_store.record_runtime(redis_connection(), settings_id, time.time() - start, timeout)
+    except JobTimeoutException as e:
+        # runs that are stopped by the job timeout are recorded as well so that a timeout based on recorded runtimes
+        # that turns out to be too short can grow again
+        settings_store.record_runtime(redis_connection(), settings_id, time.time() - start, timeout)
+        error = str(e)
     except Exception as e:
         error = str(e)
     finally:
         key = f"autotest:test_result:{test_id}"
-        redis_connection().set(key, json.dumps({"test_groups": results, "error": error}))
-        redis_connection().expire(key, 3600)  # TODO: make this configurable
+        test_result = {"test_groups": results, "error": error}
+        if cancelled:
+            # rq marks the job as finished when this function returns, this tells the API that it was cancelled
+            test_result["status"] = JobStatus.CANCELED
+        redis_connection().set(key, json.dumps(test_result))
+        redis_connection().expire(key, config["results", "expiry"])
+        if not cancelled:
+            # the cancel key of a cancelled run is kept (until it expires) so that the API reports it as canceled
+            redis_connection().delete(CANCEL_KEY.format(test_id))
+        _publish_test_stream(test_id, {"done": json.dumps({"error": error})})
+        _record_finished(time.time() - start)
+        if callback_url:
+            enqueue_callback(redis_connection(), callback_url, test_id)
 
 
 def ignore_missing_dir_error(
@@ -377,6 +702,7 @@ def ignore_missing_dir_error(
 
 
 def update_test_settings(user, settings_id, test_settings, file_url):
+    fields = {"user": user}
     try:
         settings_dir = os.path.join(TEST_SCRIPT_DIR, str(settings_id))
 
@@ -384,11 +710,10 @@ def update_test_settings(user, settings_id, test_settings, file_url):
         os.chmod(TEST_SCRIPT_DIR, 0o755)
 
         files_dir = os.path.join(settings_dir, "files")
+        templates.remove_all(files_dir)
         shutil.rmtree(files_dir, onerror=ignore_missing_dir_error)
         os.makedirs(files_dir, exist_ok=True)
-        creds = json.loads(redis_connection().hget("autotest:user_credentials", key=user))
-        r = requests.get(file_url, headers={"Authorization": f"{creds['auth_type']} {creds['credentials']}"})
-        extract_zip_stream(r.content, files_dir)
+        prefetch.fetch_files(redis_connection(), user, file_url, files_dir)
 
         schema = json.loads(redis_connection().get("autotest:schema"))
         installed_testers = schema["definitions"]["installed_testers"]["enum"]
@@ -410,14 +735,13 @@ def update_test_settings(user, settings_id, test_settings, file_url):
                     error_message += f"\nDetails (captured stderr):\n{e.stderr}"
                 raise Exception(error_message) from e
             test_settings["testers"][i] = tester_settings
-        test_settings["_files"] = files_dir
-        test_settings.pop("_error", None)
-        test_settings["_env_status"] = "ready"
+        fields["files"] = files_dir
+        fields["files_version"] = uuid.uuid4().hex
+        fields["status"] = "ready"
     except Exception as e:
-        test_settings["_error"] = str(e)
-        test_settings["_env_status"] = "error"
+        fields["error"] = str(e)
+        fields["status"] = "error"
         raise
     finally:
-        test_settings["_user"] = user
-        test_settings["_last_access"] = int(time.time())
-        redis_connection().hset("autotest:settings", key=settings_id, value=json.dumps(test_settings))
+        fields["settings"] = json.dumps(test_settings)
+        settings_store.update(redis_connection(), settings_id, fields)
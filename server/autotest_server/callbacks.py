@@ -0,0 +1,130 @@
+"""
+Delivery of test completion notifications to callback urls supplied by clients.
+
+When a test run finishes, run_test adds a notification to the autotest:callbacks list. The delivery process (started
+by start_stop.py) pops notifications in batches, combines notifications sent to the same url into a single request
+and POSTs the ids of the finished tests to that url. Failed deliveries are retried with exponential backoff.
+
+Notifications only contain test ids, clients should use the API to get the results themselves.
+"""
+
+import json
+import time
+import logging
+import requests
+import redis
+import rq
+from collections import defaultdict
+from typing import Dict, List, Optional, Union
+
+from .config import config
+
+CALLBACK_QUEUE = "autotest:callbacks"
+RETRY_QUEUE = "autotest:callbacks:retry"
+PENDING_JOB_DELAY = 1
+# notifications for jobs that still aren't done after this many seconds are sent anyway (see deliver)
+MAX_PENDING_AGE = 60
+
+_PENDING_STATUSES = ("queued", "started", "deferred", "scheduled")
+
+logger = logging.getLogger(__name__)
+
+Notification = Dict[str, Union[str, int]]
+
+
+def enqueue_callback(conn: redis.Redis, callback_url: str, test_id: Union[int, str]) -> None:
+    """Add a notification that test_id has finished to the queue of notifications to send to callback_url"""
+    notification = {"url": callback_url, "test_id": test_id, "attempts": 0, "enqueued_at": time.time()}
+    conn.rpush(CALLBACK_QUEUE, json.dumps(notification))
+
+
+def _backoff(attempts: int) -> float:
+    """Return the number of seconds to wait before retrying a notification that has failed attempts times"""
+    return min(config["callbacks", "backoff"] * 2 ** (attempts - 1), config["callbacks", "max_backoff"])
+
+
+def _schedule_retry(conn: redis.Redis, notifications: List[Notification], delay: float) -> None:
+    """Schedule notifications to be sent again in delay seconds"""
+    if notifications:
+        retry_at = time.time() + delay
+        conn.zadd(RETRY_QUEUE, {json.dumps(n): retry_at for n in notifications})
+
+
+def _requeue_due(conn: redis.Redis) -> None:
+    """Move notifications that are due to be retried back to the notification queue"""
+    due = conn.zrangebyscore(RETRY_QUEUE, 0, time.time())
+    if due:
+        with conn.pipeline() as pipe:
+            pipe.zrem(RETRY_QUEUE, *due)
+            pipe.rpush(CALLBACK_QUEUE, *due)
+            pipe.execute()
+
+
+def _pop_batch(conn: redis.Redis, batch_size: int, timeout: int) -> List[Notification]:
+    """
+    Return up to batch_size notifications from the queue, waiting up to timeout seconds for at least one
+    notification to be available.
+    """
+    first = conn.blpop([CALLBACK_QUEUE], timeout=timeout)
+    if first is None:
+        return []
+    rest = conn.lpop(CALLBACK_QUEUE, batch_size - 1) if batch_size > 1 else None
+    return [json.loads(n) for n in [first[1], *(rest or [])]]
+
+
+def deliver(conn: redis.Redis, session: requests.Session, notifications: List[Notification]) -> None:
+    """
+    Send notifications, combining all notifications for the same url into a single request.
+
+    Notifications for jobs that rq has not marked as done yet (run_test returns before the job's status is updated)
+    are delayed briefly so that clients don't request results before they are available. Since the test's result is
+    saved before the notification is added, notifications for jobs that are still not done after MAX_PENDING_AGE
+    seconds (for example because the job's worker was killed before rq updated its status) are sent anyway.
+    """
+    jobs = rq.job.Job.fetch_many([str(n["test_id"]) for n in notifications], connection=conn)
+    pending, by_url = [], defaultdict(list)
+    now = time.time()
+    for notification, job in zip(notifications, jobs):
+        # notifications added before enqueued_at was recorded are timed from now
+        enqueued_at = notification.setdefault("enqueued_at", now)
+        pending_job = job is not None and job.get_status(refresh=False) in _PENDING_STATUSES
+        if pending_job and now - enqueued_at < MAX_PENDING_AGE:
+            pending.append(notification)
+        else:
+            by_url[notification["url"]].append(notification)
+    _schedule_retry(conn, pending, PENDING_JOB_DELAY)
+
+    for url, url_notifications in by_url.items():
+        try:
+            response = session.post(
+                url,
+                json={"test_ids": [n["test_id"] for n in url_notifications]},
+                timeout=config["callbacks", "timeout"],
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            retries = []
+            for notification in url_notifications:
+                notification["attempts"] += 1
+                if notification["attempts"] < config["callbacks", "max_attempts"]:
+                    retries.append(notification)
+                else:
+                    logger.error(f"giving up on notifying {url} that test {notification['test_id']} finished: {e}")
+            if retries:
+                conn.zadd(RETRY_QUEUE, {json.dumps(n): time.time() + _backoff(n["attempts"]) for n in retries})
+
+
+def run(conn: Optional[redis.Redis] = None, poll_interval: int = 1) -> None:
+    """Deliver notifications until interrupted"""
+    conn = conn or redis.Redis.from_url(config["redis_url"])
+    with requests.Session() as session:
+        while True:
+            _requeue_due(conn)
+            notifications = _pop_batch(conn, config["callbacks", "batch_size"], poll_interval)
+            if notifications:
+                deliver(conn, session, notifications)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    run()
@@ -0,0 +1,197 @@
+"""
+Downloading of student files and test files from the client (MarkUs).
+
+Each process uses a single requests session (see client()) so that connections to the client are kept alive and reused
+between downloads, with the connect and read timeouts from the fetch settings.
+
+Downloads are cached on disk in <workspace>/fetch_cache so that files that haven't changed since they were last
+downloaded (for example when tests are run again for the same submission) are not downloaded again. When a url that
+is in the cache is requested again, the request includes the ETag and Last-Modified values of the cached response and
+the cached file is used if the client responds with 304 Not Modified. For each url, the cache contains a small json
+file (named after a hash of the url) with those values and the name of the file containing the response body. A new
+body file is written for each response, and the json file is replaced once it is complete, so processes sharing the
+cache never read a partial file. When the cache grows larger than the configured size, the least recently used body
+files are removed.
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import tempfile
+import requests
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from typing import BinaryIO, Dict, Iterator, Optional
+
+from .config import config
+from .utils import ExtractionError
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+META_SUFFIX = ".json"
+STALE_TMP_AGE = 86400
+
+_CLIENT = None
+
+
+def _touch(fd: int) -> None:
+    """
+    Set the modification time of fd to now, which marks a cached body as recently used. The time is set explicitly
+    since file systems may otherwise only update it every few milliseconds.
+    """
+    now = time.time_ns()
+    os.utime(fd, ns=(now, now))
+
+
+def cache_dir() -> str:
+    """Return the directory that downloads are cached in"""
+    return os.path.join(config["workspace"], "fetch_cache")
+
+
+class FetchClient:
+    """
+    Download files over a pooled session, caching responses that have an ETag or Last-Modified header in cache_dir
+    (up to cache_size bytes, 0 to disable caching).
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        cache_size: Optional[int] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        pool_size: Optional[int] = None,
+    ) -> None:
+        self.cache_dir = directory if directory is not None else cache_dir()
+        self.cache_size = cache_size if cache_size is not None else config["fetch", "cache_size"]
+        self.timeout = (
+            connect_timeout if connect_timeout is not None else config["fetch", "connect_timeout"],
+            read_timeout if read_timeout is not None else config["fetch", "read_timeout"],
+        )
+        pool_size = pool_size if pool_size is not None else config["fetch", "pool_size"]
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _meta_path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest() + META_SUFFIX)
+
+    def _cached(self, url: str) -> Optional[Dict[str, str]]:
+        try:
+            with open(self._meta_path(url)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _evict(self) -> None:
+        """Remove the least recently used body files until the cache is no larger than cache_size bytes"""
+        bodies = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+                if entry.name.startswith("."):
+                    # temporary files left behind by a process that was killed while downloading
+                    if stat.st_mtime < time.time() - STALE_TMP_AGE:
+                        os.unlink(entry.path)
+                elif not entry.name.endswith(META_SUFFIX):
+                    bodies.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in bodies)
+        for _, size, path in sorted(bodies):
+            if total <= self.cache_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _download(self, url: str, response: requests.Response, max_size: int) -> BinaryIO:
+        """Write the body of response to a file and return it (open and positioned at the start)"""
+        fd, path = tempfile.mkstemp(dir=self.cache_dir, prefix=".")
+        f = os.fdopen(fd, "w+b")
+        try:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                if f.tell() > max_size:
+                    raise ExtractionError(f"zip archive at {url} is larger than {max_size} bytes")
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            f.flush()
+            if (etag or last_modified) and f.tell() <= self.cache_size:
+                body = uuid.uuid4().hex
+                _touch(f.fileno())
+                os.rename(path, os.path.join(self.cache_dir, body))
+                meta_fd, meta_tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=".")
+                with os.fdopen(meta_fd, "w") as meta:
+                    json.dump({"url": url, "etag": etag, "last_modified": last_modified, "body": body}, meta)
+                previous = self._cached(url)
+                os.replace(meta_tmp, self._meta_path(url))
+                if previous is not None:
+                    try:
+                        os.unlink(os.path.join(self.cache_dir, previous["body"]))
+                    except FileNotFoundError:
+                        pass
+                self._evict()
+            else:
+                os.unlink(path)
+        except BaseException:
+            f.close()
+            if os.path.exists(path):
+                os.unlink(path)
+            raise
+        f.seek(0)
+        return f
+
+    def _open_body(self, cached: Optional[Dict[str, str]]) -> Optional[BinaryIO]:
+        """Return the cached body described by cached, or None if it has been evicted"""
+        if cached is None:
+            return None
+        body = os.path.join(self.cache_dir, cached["body"])
+        try:
+            f = open(body, "rb")
+        except FileNotFoundError:
+            return None
+        _touch(f.fileno())
+        return f
+
+    @contextmanager
+    def open(
+        self, url: str, headers: Optional[Dict[str, str]] = None, max_size: Optional[int] = None
+    ) -> Iterator[BinaryIO]:
+        """
+        Yield a file object containing the content at url (from the cache if it hasn't changed). Raise an
+        ExtractionError if the content is larger than max_size (which defaults to the extraction max_size setting).
+        """
+        max_size = max_size if max_size is not None else config["extraction", "max_size"]
+        headers = headers or {}
+        cached = self._cached(url) if self.cache_size else None
+        conditional = dict(headers)
+        if cached is not None and cached["etag"]:
+            conditional["If-None-Match"] = cached["etag"]
+        if cached is not None and cached["last_modified"]:
+            conditional["If-Modified-Since"] = cached["last_modified"]
+        with self.session.get(url, headers=conditional, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                f = self._open_body(cached)
+            else:
+                response.raise_for_status()
+                f = self._download(url, response, max_size)
+        if f is None:
+            # the cached body was evicted by another process after its metadata was read
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                f = self._download(url, response, max_size)
+        with f:
+            yield f
+
+
+def client() -> FetchClient:
+    """Return the fetch client for this process"""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = FetchClient()
+    return _CLIENT
@@ -0,0 +1,185 @@
+"""
+Prefetching of the student files for tests that are waiting to run.
+
+Without prefetching, a worker downloads and extracts the student files for a test after the test starts so the worker
+is idle while it waits for the network. The prefetch process (started by start_stop.py) looks at the next few tests
+waiting in each rq queue and at the next few tests each owner has waiting to be dispatched to the batch queue (see
+scheduler.py). It downloads and extracts their files into a staging directory (<workspace>/prefetch/<test id>) ahead
+of time. When a worker starts a test whose files are staged, it moves them into its workspace instead of downloading
+them. The staging directory and the staged files are only accessible by the server user, the worker sets the
+permissions the tests need when it claims them.
+
+Files are extracted into a temporary directory that is renamed once it is complete, so a worker either finds all of a
+test's files or none of them (in which case it downloads them itself). Staged files for tests that are no longer
+waiting or running (because they finished, were cancelled or were deleted) are removed by the prefetch process.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import redis
+import rq
+from concurrent.futures import ThreadPoolExecutor
+from rq.job import Job, JobStatus
+from typing import List, Optional, Set, Union
+
+from .config import config
+from . import fetch, scheduler
+from .utils import extract_zip_stream
+
+TMP_PREFIX = "."
+# staged files are only accessible by the server user until a worker claims them
+STAGING_MODE = 0o700
+_ACTIVE_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+
+logger = logging.getLogger(__name__)
+
+
+def staging_dir() -> str:
+    """Return the directory that prefetched files are staged in"""
+    return os.path.join(config["workspace"], "prefetch")
+
+
+def staged_path(test_id: Union[int, str]) -> str:
+    """Return the directory that the files for test_id are staged in once they have been prefetched"""
+    return os.path.join(staging_dir(), str(test_id))
+
+
+def fetch_files(
+    conn: redis.Redis,
+    user: str,
+    files_url: str,
+    destination: str,
+    mode: Optional[int] = None,
+    group: Optional[str] = None,
+) -> None:
+    """
+    Download the zip file at files_url with the credentials of user and extract it to destination, setting the mode
+    and group of the extracted files if given (see utils.extract_zip_stream).
+
+    The download is written to a file (see fetch.py) instead of being read into memory.
+    """
+    creds = json.loads(conn.hget("autotest:user_credentials", key=user))
+    headers = {"Authorization": f"{creds['auth_type']} {creds['credentials']}"}
+    with fetch.client().open(files_url, headers=headers) as f:
+        extract_zip_stream(f, destination, mode=mode, group=group)
+
+
+def claim(test_id: Union[int, str], destination: str) -> bool:
+    """
+    Move the prefetched files for test_id into destination. Return False if the files for test_id have not been
+    prefetched (or are not complete yet).
+    """
+    staged = staged_path(test_id)
+    try:
+        names = os.listdir(staged)
+    except FileNotFoundError:
+        return False
+    for name in names:
+        shutil.move(os.path.join(staged, name), os.path.join(destination, name))
+    shutil.rmtree(staged, ignore_errors=True)
+    return True
+
+
+def _decode(value: Union[bytes, str]) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class Prefetcher:
+    """
+    Download and extract the files for the next lookahead tests in each queue (and for each owner of batch tests) into
+    the staging directory, keeping at most max_staged tests staged at a time.
+    """
+
+    def __init__(
+        self,
+        conn: redis.Redis,
+        lookahead: Optional[int] = None,
+        max_staged: Optional[int] = None,
+        concurrency: Optional[int] = None,
+    ) -> None:
+        self.conn = conn
+        self.lookahead = lookahead if lookahead is not None else config["prefetch", "lookahead"]
+        self.max_staged = max_staged if max_staged is not None else config["prefetch", "max_staged"]
+        self.concurrency = concurrency if concurrency is not None else config["prefetch", "concurrency"]
+        self.queues = [rq.Queue(name, connection=conn) for name in scheduler.QUEUE_NAMES]
+        os.makedirs(staging_dir(), mode=STAGING_MODE, exist_ok=True)
+        os.chmod(staging_dir(), STAGING_MODE)
+        # remove files left half extracted by a previous prefetch process that was stopped
+        for name in os.listdir(staging_dir()):
+            if name.startswith(TMP_PREFIX):
+                shutil.rmtree(os.path.join(staging_dir(), name), ignore_errors=True)
+
+    def _candidates(self) -> List[str]:
+        """Return the ids of the tests that should be prefetched, tests that will start sooner first"""
+        with self.conn.pipeline() as pipe:
+            for queue in self.queues:
+                pipe.lrange(queue.key, 0, self.lookahead - 1)
+            for owner in sorted(_decode(o) for o in self.conn.smembers(scheduler.OWNERS_KEY)):
+                pipe.zrange(scheduler.pending_key(owner), 0, self.lookahead - 1)
+            job_ids = [_decode(id_) for ids in pipe.execute() for id_ in ids]
+        return list(dict.fromkeys(job_ids))
+
+    def _staged(self) -> Set[str]:
+        return {name for name in os.listdir(staging_dir()) if not name.startswith(TMP_PREFIX)}
+
+    def _fetch(self, job: Job) -> bool:
+        """Prefetch the files for job. Return False if they could not be downloaded or the job started meanwhile."""
+        tmp_dir = os.path.join(staging_dir(), f"{TMP_PREFIX}{job.id}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            os.makedirs(tmp_dir, mode=STAGING_MODE)
+            fetch_files(self.conn, job.kwargs["user"], job.kwargs["files_url"], tmp_dir, mode=STAGING_MODE)
+            if job.get_status(refresh=True) != JobStatus.QUEUED:
+                # the worker has already downloaded the files itself
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return False
+            os.rename(tmp_dir, staged_path(job.id))
+        except Exception as e:
+            logger.error(f"failed to prefetch files for test {job.id}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+        return True
+
+    def prefetch(self) -> int:
+        """Prefetch the files for tests that are waiting to run. Return the number of tests prefetched."""
+        staged = self._staged()
+        job_ids = [id_ for id_ in self._candidates() if id_ not in staged][: max(0, self.max_staged - len(staged))]
+        jobs = [
+            job
+            for job in Job.fetch_many(job_ids, connection=self.conn)
+            if job is not None and job.get_status(refresh=False) == JobStatus.QUEUED and "files_url" in job.kwargs
+        ]
+        if not jobs:
+            return 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return sum(executor.map(self._fetch, jobs))
+
+    def prune(self) -> int:
+        """Remove staged files for tests that are no longer waiting or running. Return the number of tests removed."""
+        staged = sorted(self._staged())
+        jobs = Job.fetch_many(staged, connection=self.conn)
+        removed = 0
+        for id_, job in zip(staged, jobs):
+            if job is None or job.get_status(refresh=False) not in _ACTIVE_STATUSES:
+                shutil.rmtree(staged_path(id_), ignore_errors=True)
+                removed += 1
+        return removed
+
+    def run(self, poll_interval: Optional[float] = None) -> None:
+        """Prefetch files until interrupted"""
+        poll_interval = poll_interval if poll_interval is not None else config["prefetch", "poll_interval"]
+        while True:
+            try:
+                self.prune()
+                self.prefetch()
+            except redis.ConnectionError as e:
+                logger.error(f"lost connection to redis: {e}")
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    Prefetcher(redis.Redis.from_url(config["redis_url"])).run()
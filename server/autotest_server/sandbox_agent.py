@@ -0,0 +1,647 @@
+"""
+Agent that runs test processes, kills processes and cleans up files as a test user.
+
+Without the agent, each test run starts a new sudo (and bash) process every time a command has to be run as the test
+user: to run each test script, to kill the test user's processes and to clean up the working directory and /tmp.
+Instead, the worker starts one agent process per test user (with sudo, the first time it is needed) that carries out
+these commands with system calls directly and keeps running between test runs.
+
+The worker creates a unix socket at <workspace>/agents/<user>.sock in a directory that only the worker's user can
+access and starts the agent with the listening socket as its standard input, so that the agent can accept
+connections without the test user (or the tests) being able to connect to it. Requests and responses are json
+objects sent as single packets. The pipes for a test process's standard input, output and error are sent along with
+the request to run it, so the test process's output is read directly by the worker.
+
+The same script also runs forkservers (with the forkserver argument). A forkserver runs with the python of a tester's
+environment as the test user and imports the tester (along with any other modules that should be preloaded) once
+when it starts. It then runs each test script in a forked process instead of starting a new python process that has
+to import them again. Forkservers keep running between test runs, so the agent doesn't kill them when it kills the
+test user's other processes. The agent and forkservers are not dumpable, so tests can't trace them or access their
+memory.
+
+This file must not import anything from the autotest_server package since it is run as a script by the test user.
+"""
+
+import os
+import sys
+import pwd
+import ctypes
+import atexit
+import argparse
+import importlib
+import traceback
+import json
+import stat
+import time
+import shutil
+import signal
+import socket
+import resource
+import selectors
+import subprocess
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+VERSION = 1
+MAX_MESSAGE_SIZE = 1024 * 1024
+START_TIMEOUT = 30
+START_POLL_INTERVAL = 0.1
+REQUEST_TIMEOUT = 60
+IDLE_TIMEOUT = 3600
+READ_SIZE = 32768
+PR_SET_DUMPABLE = 4
+
+
+class AgentError(Exception):
+    """Raised when an agent cannot be started or returns an error"""
+
+
+class AgentTimeout(AgentError):
+    """Raised when an agent doesn't respond to a request within REQUEST_TIMEOUT seconds"""
+
+
+def _send(sock: socket.socket, message: Dict, fds: Sequence[int] = ()) -> None:
+    socket.send_fds(sock, [json.dumps(message).encode()], list(fds))
+
+
+def _receive(sock: socket.socket) -> Tuple[Optional[Dict], List[int]]:
+    """Return the next message (None if the connection was closed) and any file descriptors sent with it"""
+    data, fds, _flags, _addr = socket.recv_fds(sock, MAX_MESSAGE_SIZE, 3)
+    return (json.loads(data) if data else None), fds
+
+
+# agent (runs as the test user)
+
+
+def _setup_child(cwd: str, env: Dict[str, str], rlimits: List[Tuple[int, int, int]], fds: List[int]) -> Dict[str, str]:
+    """
+    Prepare a newly forked process to run tests: start a new session, use fds as its standard input, output and error,
+    close every other file descriptor and set rlimits and the working directory. Return the environment to run with.
+    """
+    # the agent ignores SIGCHLD, which would otherwise be inherited by the test process
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    os.setsid()
+    for i, fd in enumerate(fds):
+        os.dup2(fd, i)
+    os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+    for limit, soft, hard in rlimits:
+        resource.setrlimit(limit, (soft, hard))
+    os.chdir(cwd)
+    user = pwd.getpwuid(os.getuid())
+    return {**env, "USER": user.pw_name, "LOGNAME": user.pw_name, "HOME": user.pw_dir}
+
+
+def _spawn(args: List[str], cwd: str, env: Dict[str, str], rlimits: List[Tuple[int, int, int]], fds: List[int]) -> int:
+    """Start args in a new session with fds as its standard input, output and error. Return its pid."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.execvpe(args[0], args, _setup_child(cwd, env, rlimits, fds))
+        except BaseException as e:
+            os.write(2, f"{e}\n".encode())
+        finally:
+            os._exit(127)
+    return pid
+
+
+def process_start_time(pid: int) -> Optional[int]:
+    """Return the time (in clock ticks after boot) that process pid started, or None if there is no such process"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat_line = f.read()
+    except OSError:
+        return None
+    # the fields following the command name (which may contain spaces), starting at the third field
+    return int(stat_line.rsplit(")", 1)[1].split()[19])
+
+
+def _user_pids(uid: int) -> Set[int]:
+    """Return the pids of the processes that a process with real and effective user id uid can kill"""
+    pids = set()
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/status") as f:
+                for line in f:
+                    if line.startswith("Uid:"):
+                        real, _effective, saved, _fs = (int(id_) for id_ in line.split()[1:])
+                        if uid in (real, saved):
+                            pids.add(int(name))
+                        break
+        except OSError:
+            continue
+    return pids
+
+
+def _kill_all(keep: Sequence[Tuple[int, int]] = ()) -> None:
+    """
+    Kill every process owned by this user except this one and the processes in keep (pid and start time pairs, see
+    process_start_time, so that a process that reuses the pid of a process in keep that has exited is killed).
+    """
+    if not keep:
+        try:
+            os.kill(-1, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        return
+    keep = {pid for pid, start in keep if process_start_time(pid) == start} | {os.getpid()}
+    # stop processes until there are none left running so that they can't start new processes before being killed
+    stopped = set()
+    while True:
+        pids = _user_pids(os.getuid()) - keep - stopped
+        if not pids:
+            break
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGSTOP)
+            except OSError:
+                pass
+        stopped |= pids
+    for pid in stopped:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def _set_dumpable(dumpable: bool) -> None:
+    """
+    Set whether this process is dumpable. Processes that are not dumpable can't be traced or have their memory read or
+    written through /proc by other processes of the same user, so that tests can't tamper with the agent.
+    """
+    ctypes.CDLL(None, use_errno=True).prctl(PR_SET_DUMPABLE, int(dumpable), 0, 0, 0)
+
+
+def _ping() -> Dict:
+    pid = os.getpid()
+    return {"version": VERSION, "pid": pid, "start": process_start_time(pid)}
+
+
+def _remove(path: str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _clean(path: str, tmp_dir: str = "/tmp") -> None:
+    """
+    Remove the sticky bit from and give everyone read and write permissions to (and execute permissions to directories
+    and executable files) every file owned by this user in the path directory so that the worker can remove them.
+    Then remove every file in tmp_dir owned by this user.
+    """
+    uid = os.getuid()
+    for root, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            file_path = os.path.join(root, name)
+            try:
+                st = os.lstat(file_path)
+                if st.st_uid != uid or stat.S_ISLNK(st.st_mode):
+                    continue
+                mode = stat.S_IMODE(st.st_mode) & ~stat.S_ISVTX | 0o666
+                if stat.S_ISDIR(st.st_mode) or st.st_mode & 0o111:
+                    mode |= 0o111
+                os.chmod(file_path, mode)
+            except OSError:
+                pass
+    for entry in os.scandir(tmp_dir):
+        try:
+            if entry.stat(follow_symlinks=False).st_uid == uid:
+                _remove(entry.path)
+        except OSError:
+            pass
+
+
+def _handle(message: Dict, fds: List[int]) -> Dict:
+    command = message["cmd"]
+    if command == "ping":
+        return _ping()
+    if command == "spawn":
+        try:
+            return {"pid": _spawn(message["args"], message["cwd"], message["env"], message["rlimits"], fds)}
+        finally:
+            for fd in fds:
+                os.close(fd)
+    if command == "kill":
+        _kill_all([tuple(process) for process in message.get("keep", [])])
+        return {}
+    if command == "clean":
+        _clean(message["path"])
+        return {}
+    raise ValueError(f"unknown command: {command}")
+
+
+class Forkserver:
+    """
+    Runs tests with a tester that is imported (along with the modules in preload) once when the forkserver starts,
+    instead of once for every test script. This must be run with the tester's python.
+    """
+
+    def __init__(self, tester_type: str, preload: Sequence[str] = ()) -> None:
+        # the modules are imported with the same path as the test script (see _create_test_script) except that the
+        # working directory is only added once the tests are run
+        server_dir = os.path.dirname(os.path.abspath(__file__))
+        if sys.path and sys.path[0] == server_dir:
+            del sys.path[0]
+        sys.path.append(server_dir)
+        module = importlib.import_module(f"testers.{tester_type}.{tester_type}_tester")
+        self.tester = getattr(module, f"{tester_type.capitalize()}Tester")
+        self.specs = importlib.import_module("testers.specs").TestSpecs
+        for name in preload:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                # not installed in this tester's environment
+                pass
+        # modules that were imported before the working directory was added to the path, the test script would
+        # import files in the working directory with the same names instead (except for builtin modules)
+        self.modules = sorted(
+            {name.partition(".")[0] for name in sys.modules} - set(sys.builtin_module_names) - {"__main__"}
+        )
+
+    def _run_tests(self) -> int:
+        """Run the tests with the specs read from stdin and return the exit status, like the test script would"""
+        try:
+            self.tester(specs=self.specs.from_json(sys.stdin.read())).run()
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            print(e.code, file=sys.stderr)
+            return 1
+        except BaseException:
+            traceback.print_exc()
+            return 1
+
+    def run(self, cwd: str, env: Dict[str, str], rlimits: List[Tuple[int, int, int]], fds: List[int]) -> int:
+        """Run the tests in a new process (see _setup_child) and return its pid"""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                _set_dumpable(True)
+                env = _setup_child(cwd, env, rlimits, fds)
+                os.environ.clear()
+                os.environ.update(env)
+                sys.argv = ["-c"]
+                sys.path.insert(0, "")
+                status = self._run_tests()
+                atexit._run_exitfuncs()
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(status)
+        return pid
+
+    def handle(self, message: Dict, fds: List[int]) -> Dict:
+        command = message["cmd"]
+        if command == "ping":
+            return _ping()
+        if command == "run":
+            try:
+                return {"pid": self.run(message["cwd"], message["env"], message["rlimits"], fds)}
+            finally:
+                for fd in fds:
+                    os.close(fd)
+        if command == "modules":
+            return {"modules": self.modules}
+        raise ValueError(f"unknown command: {command}")
+
+
+def serve(
+    listener: socket.socket,
+    idle_timeout: float = IDLE_TIMEOUT,
+    handle: Callable[[Dict, List[int]], Dict] = _handle,
+) -> None:
+    """
+    Handle requests from one connection at a time with handle until no connection is made for idle_timeout seconds
+    """
+    # test processes are not waited for, let the kernel reap them
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    _set_dumpable(False)
+    listener.settimeout(idle_timeout)
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except socket.timeout:
+            return
+        with conn:
+            conn.settimeout(None)
+            while True:
+                try:
+                    message, fds = _receive(conn)
+                except (ConnectionError, ValueError):
+                    break
+                if message is None:
+                    break
+                if message["cmd"] == "exit":
+                    return
+                try:
+                    response = handle(message, fds)
+                except Exception as e:
+                    response = {"error": str(e)}
+                try:
+                    _send(conn, response)
+                except ConnectionError:
+                    break
+
+
+# worker
+
+
+class AgentProcess:
+    """
+    A test process started by an agent. Implements the parts of subprocess.Popen's interface used to run tests:
+    communicate (with text input and output) and the args and pid attributes.
+    """
+
+    def __init__(self, args: List[str], pid: int, stdin: int, stdout: int, stderr: int) -> None:
+        self.args = args
+        self.pid = pid
+        self._stdin = stdin
+        self._input = None
+        self._input_offset = 0
+        self._outputs = {stdout: [], stderr: []}
+        self._stdout, self._stderr = stdout, stderr
+        self._open = {stdout, stderr}
+
+    def _close_stdin(self) -> None:
+        if self._stdin is not None:
+            os.close(self._stdin)
+            self._stdin = None
+
+    def communicate(self, input: Optional[str] = None, timeout: Optional[float] = None) -> Tuple[str, str]:
+        """
+        Send input to the process and read its output until it is closed. Raise subprocess.TimeoutExpired if that
+        takes longer than timeout seconds, in which case communicate can be called again (without input) to continue.
+        """
+        if self._input is None:
+            self._input = (input or "").encode()
+            if self._stdin is not None:
+                os.set_blocking(self._stdin, False)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            if self._stdin is not None and self._input_offset < len(self._input):
+                selector.register(self._stdin, selectors.EVENT_WRITE)
+            else:
+                self._close_stdin()
+            for fd in self._open:
+                selector.register(fd, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+                for key, _ in selector.select(remaining):
+                    if key.fd == self._stdin:
+                        offset = self._input_offset
+                        try:
+                            self._input_offset += os.write(key.fd, memoryview(self._input)[offset:][:READ_SIZE])
+                        except BrokenPipeError:
+                            self._input_offset = len(self._input)
+                        if self._input_offset >= len(self._input):
+                            selector.unregister(key.fd)
+                            self._close_stdin()
+                    else:
+                        data = os.read(key.fd, READ_SIZE)
+                        if data:
+                            self._outputs[key.fd].append(data)
+                        else:
+                            selector.unregister(key.fd)
+                            os.close(key.fd)
+                            self._open.discard(key.fd)
+        return self._decode(self._stdout), self._decode(self._stderr)
+
+    def _decode(self, fd: int) -> str:
+        text = b"".join(self._outputs[fd]).decode(errors="replace")
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+class AgentClient:
+    """
+    Connection to the agent for user listening at socket_path, which is started (with command_prefix + command) if
+    it isn't running yet.
+    """
+
+    def __init__(self, user: str, socket_path: str, command_prefix: Optional[Sequence[str]] = None) -> None:
+        self.user = user
+        self.socket_path = socket_path
+        self.command_prefix = list(command_prefix) if command_prefix is not None else ["sudo", "-n", "-u", user, "--"]
+        self.command = [sys.executable, os.path.abspath(__file__)]
+        self.process = None
+        self.identity = None
+        self._sock = None
+        self._unresponsive = False
+
+    def _connect(self, agent: Optional[subprocess.Popen] = None) -> Optional[socket.socket]:
+        """
+        Return a connection to a running agent of the current version, or None if there isn't one. If agent is the
+        process of an agent that was just started, wait for it to respond unless it exits first.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        deadline = time.monotonic() + START_TIMEOUT
+        sock.settimeout(START_TIMEOUT if agent is None else START_POLL_INTERVAL)
+        try:
+            sock.connect(self.socket_path)
+            _send(sock, {"cmd": "ping"})
+            while True:
+                try:
+                    response, _ = _receive(sock)
+                    break
+                except socket.timeout:
+                    if agent is None or agent.poll() is not None or time.monotonic() >= deadline:
+                        raise
+        except OSError:
+            sock.close()
+            return None
+        if response is None or response.get("version") != VERSION:
+            # an agent left running by an older version of the autotester
+            try:
+                _send(sock, {"cmd": "exit"})
+            except OSError:
+                pass
+            sock.close()
+            return None
+        sock.settimeout(REQUEST_TIMEOUT)
+        self.identity = (response["pid"], response["start"])
+        return sock
+
+    def _start(self) -> subprocess.Popen:
+        """Start a new agent listening at socket_path and return its process"""
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            listener.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+            listener.listen()
+            return subprocess.Popen(
+                [*self.command_prefix, *self.command],
+                stdin=listener.fileno(),
+                stdout=subprocess.DEVNULL,
+                cwd="/",
+                start_new_session=True,
+            )
+        except OSError as e:
+            raise AgentError(f"could not start agent for {self.user}: {e}") from e
+        finally:
+            listener.close()
+
+    def connect(self) -> None:
+        """
+        Connect to the agent, starting it if necessary. If the running agent stopped responding, a new agent is
+        started instead (the old one is killed by the new agent's kill_all).
+        """
+        if self._sock is not None:
+            return
+        if not self._unresponsive:
+            self._sock = self._connect()
+        if self._sock is None:
+            self.process = self._start()
+            self._sock = self._connect(self.process)
+        if self._sock is None:
+            raise AgentError(f"agent for {self.user} did not start")
+        self._unresponsive = False
+
+    def stop(self) -> None:
+        """Ask the agent to exit"""
+        self.connect()
+        try:
+            _send(self._sock, {"cmd": "exit"})
+        except OSError:
+            pass
+        self.close()
+
+    def close(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _request(self, message: Dict, fds: Sequence[int] = ()) -> Dict:
+        """
+        Send message (and fds) to the agent and return its response. If the connection to the agent was lost since
+        the last request, reconnect (restarting the agent if it exited) and try again once.
+
+        If the agent doesn't respond within REQUEST_TIMEOUT seconds (for example because a test stopped it with
+        SIGSTOP), a new agent is started and the request is tried again once. Requests that send fds raise an
+        AgentTimeout instead since the unresponsive agent may still be holding the fds, the caller must send new ones.
+        """
+        for retry in (True, False):
+            self.connect()
+            try:
+                _send(self._sock, message, fds)
+                response, _ = _receive(self._sock)
+            except socket.timeout as e:
+                self.close()
+                self._unresponsive = True
+                if retry and not fds:
+                    continue
+                raise AgentTimeout(f"agent for {self.user} did not respond within {REQUEST_TIMEOUT} seconds") from e
+            except OSError as e:
+                self.close()
+                if retry:
+                    continue
+                raise AgentError(f"lost connection to agent for {self.user}: {e}") from e
+            if response is None:
+                self.close()
+                if retry:
+                    continue
+                raise AgentError(f"agent for {self.user} closed the connection")
+            if "error" in response:
+                raise AgentError(response["error"])
+            return response
+
+    def _start_process(self, message: Dict, args: List[str]) -> AgentProcess:
+        """
+        Send message with pipes for the standard input, output and error of the process it starts. If the agent
+        doesn't respond, message is sent again once with new pipes to the agent that replaces it.
+        """
+        for retry in (True, False):
+            stdin_r, stdin_w = os.pipe()
+            stdout_r, stdout_w = os.pipe()
+            stderr_r, stderr_w = os.pipe()
+            try:
+                response = self._request(message, [stdin_r, stdout_w, stderr_w])
+            except BaseException as e:
+                for fd in (stdin_w, stdout_r, stderr_r):
+                    os.close(fd)
+                if retry and isinstance(e, AgentTimeout):
+                    continue
+                raise
+            finally:
+                for fd in (stdin_r, stdout_w, stderr_w):
+                    os.close(fd)
+            return AgentProcess(args, response["pid"], stdin_w, stdout_r, stderr_r)
+
+    def spawn(
+        self, args: List[str], cwd: str, env: Dict[str, str], rlimits: List[Tuple[int, int, int]]
+    ) -> AgentProcess:
+        """Start args as the agent's user and return the new process"""
+        return self._start_process({"cmd": "spawn", "args": args, "cwd": cwd, "env": env, "rlimits": rlimits}, args)
+
+    def kill_all(self, keep: Sequence[Tuple[int, int]] = ()) -> None:
+        """Kill all processes owned by the agent's user except the processes in keep (see _kill_all)"""
+        self._request({"cmd": "kill", "keep": list(keep)})
+
+    def clean(self, path: str) -> None:
+        """Make the agent's user's files in path removable and remove the agent's user's files in /tmp"""
+        self._request({"cmd": "clean", "path": path})
+
+
+class ForkserverClient(AgentClient):
+    """
+    Connection to the forkserver for user that runs tests with the tester_type tester with the python executable,
+    listening at socket_path, which is started if it isn't running yet.
+    """
+
+    def __init__(
+        self,
+        user: str,
+        socket_path: str,
+        python: str,
+        tester_type: str,
+        preload: Sequence[str] = (),
+        idle_timeout: float = IDLE_TIMEOUT,
+        command_prefix: Optional[Sequence[str]] = None,
+    ) -> None:
+        super().__init__(user, socket_path, command_prefix)
+        self.command = [
+            python,
+            os.path.abspath(__file__),
+            "forkserver",
+            f"--idle-timeout={idle_timeout}",
+            tester_type,
+            *preload,
+        ]
+
+    def run(self, cwd: str, env: Dict[str, str], rlimits: List[Tuple[int, int, int]]) -> AgentProcess:
+        """Run the tests (with the specs sent to the process's standard input) and return the new process"""
+        return self._start_process({"cmd": "run", "cwd": cwd, "env": env, "rlimits": rlimits}, self.command)
+
+    def modules(self) -> List[str]:
+        """Return the names of the top level modules that the forkserver imported before running any tests"""
+        return self._request({"cmd": "modules"})["modules"]
+
+
+def _main() -> None:
+    listener = socket.socket(fileno=sys.stdin.fileno())
+    if len(sys.argv) > 1 and sys.argv[1] == "forkserver":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT)
+        parser.add_argument("tester_type")
+        parser.add_argument("preload", nargs="*")
+        args = parser.parse_args(sys.argv[2:])
+        serve(listener, args.idle_timeout, Forkserver(args.tester_type, args.preload).handle)
+    else:
+        serve(listener)
+
+
+if __name__ == "__main__":
+    _main()
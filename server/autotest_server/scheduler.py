@@ -0,0 +1,248 @@
+"""
+Fair-share scheduling of batch test runs.
+
+Batch runs (more than one test) are not added to the rq batch queue by the API. Instead the API saves each job and
+adds its id to a pending sorted set for the owner of the run (autotest:fair_share:pending:<owner>, scored by test id so
+that each owner's tests run in the order they were submitted) and adds the owner to the autotest:fair_share:owners
+set. The owner is the api key of the user who ran the tests, or the api key and the settings id if the API is
+configured to share workers between settings instead of users.
+
+The scheduler process (started by start_stop.py) keeps one job waiting in the rq batch queue for each worker that
+listens on it so that workers are never idle, and chooses which owner's job to add next by weighted deficit round
+robin. Each time an owner's turn comes around, its deficit grows by quantum * weight seconds and it may dispatch jobs
+as long as the estimated cost of its next job (the job's timeout) is no more than its deficit. An owner with a large
+batch therefore only gets its share of the workers while other owners have jobs waiting. Weights default to 1 and can
+be set for an owner in the autotest:fair_share:weights hash.
+
+So that nothing starves (for example an owner with a very small weight), the quantum an owner receives grows with the
+time its oldest pending job has been waiting: it is multiplied by 1 + wait / aging.
+
+The estimated number of worker seconds dispatched for each owner is recorded in the autotest:fair_share:usage hash.
+
+Workers push to the autotest:fair_share:started list when they start a job so that the scheduler can refill the
+queue straight away instead of waiting for its next check.
+
+Jobs waiting in an rq queue are also kept in the autotest:queue_position:<queue> sorted set so that the API can look
+up a job's position in its queue without scanning the queue. The API adds jobs in the high and low queues (scored by
+test id), the scheduler adds the jobs it dispatches (scored in the order they are dispatched, which is the order they
+will start in) and workers remove jobs when they start. The scheduler also
+removes entries for jobs that left the queue some other way (for example when a worker was killed).
+"""
+
+import time
+import logging
+import redis
+import rq
+from collections import deque
+from rq.job import Job, JobStatus
+from typing import Callable, Deque, Dict, Optional, Union
+
+from .config import config
+
+BATCH_QUEUE = "batch"
+OWNERS_KEY = "autotest:fair_share:owners"
+WEIGHTS_KEY = "autotest:fair_share:weights"
+USAGE_KEY = "autotest:fair_share:usage"
+STARTED_KEY = "autotest:fair_share:started"
+QUEUE_NAMES = ("high", "low", "batch")
+PRUNE_BATCH_SIZE = 20
+
+logger = logging.getLogger(__name__)
+
+
+def pending_key(owner: str) -> str:
+    """Return the key of the sorted set of ids of jobs waiting to be dispatched for owner"""
+    return f"autotest:fair_share:pending:{owner}"
+
+
+def position_key(queue_name: str) -> str:
+    """Return the key of the sorted set of ids of jobs waiting in the rq queue named queue_name"""
+    return f"autotest:queue_position:{queue_name}"
+
+
+def _decode(value: Union[bytes, str]) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class FairShareScheduler:
+    """
+    Move jobs from the owners' pending lists to the rq queue named queue_name by weighted deficit round robin.
+
+    Deficits are kept in memory, only one scheduler should run for each queue.
+
+    The queue is kept topped up with max_queued jobs if it is given (or set in the fair_share settings), otherwise with
+    one job for each worker listening on the queue.
+    """
+
+    def __init__(
+        self,
+        conn: redis.Redis,
+        queue_name: str = BATCH_QUEUE,
+        quantum: Optional[float] = None,
+        aging: Optional[float] = None,
+        max_queued: Optional[int] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.conn = conn
+        self.queue = rq.Queue(queue_name, connection=conn)
+        self.quantum = quantum if quantum is not None else config["fair_share", "quantum"]
+        self.aging = aging if aging is not None else config["fair_share", "aging"]
+        self.max_queued = max_queued if max_queued is not None else config.get(("fair_share", "max_queued"))
+        self.clock = clock
+        self.deficits: Dict[str, float] = {}
+        self._round: Deque[str] = deque()
+        self._current: Optional[str] = None
+        self._heads: Dict[str, Job] = {}
+
+    def _refresh_owners(self) -> None:
+        """Add owners that have started waiting since the last call to the end of the round"""
+        waiting = set(self._round)
+        waiting.add(self._current)
+        for owner in sorted(_decode(o) for o in self.conn.smembers(OWNERS_KEY)):
+            if owner not in waiting:
+                self._round.append(owner)
+
+    def _head(self, owner: str) -> Optional[Job]:
+        """Return the next pending job for owner, discarding jobs that have been cancelled or deleted"""
+        if owner in self._heads:
+            return self._heads[owner]
+        key = pending_key(owner)
+        while job_ids := self.conn.zrange(key, 0, 0):
+            job = Job.fetch_many([_decode(job_ids[0])], connection=self.conn)[0]
+            if job is not None and job.get_status(refresh=False) == JobStatus.QUEUED:
+                self._heads[owner] = job
+                return job
+            self.conn.zrem(key, job_ids[0])
+        return None
+
+    def _retire(self, owner: str) -> None:
+        """Forget owner if it has no pending jobs (it will be added again when it has more)"""
+
+        def _remove(pipe: redis.client.Pipeline) -> None:
+            if pipe.zcard(pending_key(owner)) == 0:
+                pipe.multi()
+                pipe.srem(OWNERS_KEY, owner)
+
+        self.conn.transaction(_remove, pending_key(owner))
+        self.deficits.pop(owner, None)
+        self._heads.pop(owner, None)
+
+    def _weight(self, owner: str) -> float:
+        weight = self.conn.hget(WEIGHTS_KEY, owner)
+        return float(weight) if weight is not None else 1.0
+
+    def _cost(self, job: Job) -> float:
+        return job.timeout or self.queue.DEFAULT_TIMEOUT
+
+    def _quantum(self, owner: str, job: Job) -> float:
+        wait = max(0.0, self.clock() - job.created_at.timestamp())
+        return self.quantum * self._weight(owner) * (1 + wait / self.aging)
+
+    def _dispatch(self, owner: str, job: Job, cost: float) -> bool:
+        """
+        Move job from owner's pending list to the rq queue. Return False if the job was changed (for example it was
+        cancelled) while it was being moved, in which case it is left where it is.
+        """
+        self._heads.pop(owner, None)
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(job.key)
+                if _decode(pipe.hget(job.key, "status") or b"") != JobStatus.QUEUED:
+                    return False
+                # only one scheduler runs for each queue so nothing else adds to the position set meanwhile
+                last = pipe.zrange(position_key(self.queue.name), -1, -1, withscores=True)
+                score = last[0][1] + 1 if last else 1
+                # enqueue_job starts the transaction so it must come before the other commands
+                self.queue.enqueue_job(job, pipeline=pipe)
+                pipe.zrem(pending_key(owner), job.id)
+                pipe.zadd(position_key(self.queue.name), {job.id: score})
+                pipe.hincrbyfloat(USAGE_KEY, owner, cost)
+                pipe.execute()
+            except redis.WatchError:
+                return False
+        return True
+
+    def target(self) -> int:
+        """Return the number of jobs to keep waiting in the rq queue"""
+        if self.max_queued is not None:
+            return self.max_queued
+        return max(1, rq.Worker.count(queue=self.queue))
+
+    def prune_positions(self) -> int:
+        """
+        Remove the first few jobs in each queue position set if they are no longer waiting in the queue. Return the
+        number of jobs removed.
+        """
+        removed = 0
+        for queue_name in QUEUE_NAMES:
+            key = position_key(queue_name)
+            job_ids = [_decode(id_) for id_ in self.conn.zrange(key, 0, PRUNE_BATCH_SIZE - 1)]
+            jobs = Job.fetch_many(job_ids, connection=self.conn)
+            done = [
+                id_
+                for id_, job in zip(job_ids, jobs)
+                if job is None or job.get_status(refresh=False) != JobStatus.QUEUED
+            ]
+            if done:
+                removed += self.conn.zrem(key, *done)
+        return removed
+
+    def dispatch(self) -> int:
+        """
+        Add pending jobs to the rq queue until it contains self.target() jobs or there are no more pending jobs.
+        Return the number of jobs added.
+        """
+        self._refresh_owners()
+        free = self.target() - self.queue.count
+        dispatched = 0
+        while free > 0 and (self._current is not None or self._round):
+            if self._current is None:
+                owner = self._round.popleft()
+                job = self._head(owner)
+                if job is None:
+                    self._retire(owner)
+                    continue
+                self.deficits[owner] = self.deficits.get(owner, 0) + self._quantum(owner, job)
+                self._current = owner
+            owner = self._current
+            job = self._head(owner)
+            if job is None:
+                self._current = None
+                self._retire(owner)
+                continue
+            cost = self._cost(job)
+            if cost > self.deficits[owner]:
+                # the owner's turn is over, it keeps its deficit for the next round
+                self._current = None
+                self._round.append(owner)
+                continue
+            if self._dispatch(owner, job, cost):
+                self.deficits[owner] -= cost
+                free -= 1
+                dispatched += 1
+        return dispatched
+
+    def wait(self, poll_interval: float) -> None:
+        """Wait until a worker starts a job or for poll_interval seconds, whichever comes first"""
+        self.conn.blpop(STARTED_KEY, timeout=poll_interval)
+
+    def run(self, poll_interval: Optional[float] = None) -> None:
+        """
+        Dispatch jobs until interrupted. After each check the scheduler waits until a worker starts a job (or for
+        poll_interval seconds) unless the queue still has room, in which case it checks again straight away.
+        """
+        poll_interval = poll_interval if poll_interval is not None else config["fair_share", "poll_interval"]
+        while True:
+            try:
+                if self.dispatch() and self.queue.count < self.target():
+                    continue
+                self.prune_positions()
+                self.wait(poll_interval)
+            except redis.ConnectionError as e:
+                logger.error(f"lost connection to redis: {e}")
+                time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    FairShareScheduler(redis.Redis.from_url(config["redis_url"])).run()
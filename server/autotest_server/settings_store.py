@@ -0,0 +1,145 @@
+"""
+Storage of test settings in redis.
+
+Each test settings is stored in its own hash at autotest:settings:<id> with the fields:
+
+- settings: the tester settings (as JSON)
+- user: the api key of the user who owns the settings
+- status: the status of the settings' environment ("setup", "ready" or "error")
+- error: the reason the settings cannot be used (only set if there is one)
+- files: the directory containing the settings' files (set once the environment is ready)
+- files_version: a new random value each time the settings' files are updated (see templates)
+
+The runtimes of recent test runs for each settings are stored in the autotest:settings:<id>:runtimes list as a
+fraction of the total timeout of the tests that were run, so that samples from runs of different categories can be
+compared. The samples are discarded when the settings are updated.
+
+The time that each settings was last used is stored as its score in the autotest:settings_last_access sorted set
+so that updating it is a single ZADD and finding unused settings is a single ZRANGEBYSCORE.
+
+Settings used to be stored as a single JSON document in the autotest:settings hash. Settings in that layout are moved
+to the current layout by migrate, which is called once when the autotester is started (see start_stop.py).
+
+The API and the autotester each have their own copy of this module (autotest_client.settings_store and
+autotest_server.settings_store) since they are installed separately. The copies must be identical, which
+test_settings_store checks.
+"""
+
+import json
+import time
+import redis
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+LEGACY_SETTINGS_KEY = "autotest:settings"
+LEGACY_OWNER_KEY = "autotest:settings_owner"
+LAST_ACCESS_KEY = "autotest:settings_last_access"
+MAX_RUNTIME_SAMPLES = 200
+
+SettingsId = Union[int, str]
+
+
+def settings_key(settings_id: SettingsId) -> str:
+    """Return the key of the hash containing the settings with id settings_id"""
+    return f"autotest:settings:{settings_id}"
+
+
+def runtimes_key(settings_id: SettingsId) -> str:
+    """Return the key of the list of recent runtimes of the settings with id settings_id"""
+    return f"autotest:settings:{settings_id}:runtimes"
+
+
+def _decode(value: Union[bytes, str, None]) -> Optional[str]:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _split_legacy(settings: Dict) -> Tuple[Dict[str, str], int]:
+    """Return the fields and last access time of settings stored in the legacy layout"""
+    last_access = settings.pop("_last_access", None) or 0
+    fields = {
+        "user": settings.pop("_user", None),
+        "status": settings.pop("_env_status", None),
+        "error": settings.pop("_error", None),
+        "files": settings.pop("_files", None),
+    }
+    fields = {k: v for k, v in fields.items() if v is not None}
+    fields["settings"] = json.dumps(settings)
+    return fields, last_access
+
+
+def migrate(conn: redis.Redis, settings_ids: Optional[Iterable[SettingsId]] = None) -> int:
+    """
+    Move settings from the legacy layout to the current layout. If settings_ids is given, only those settings are
+    moved, otherwise all settings are. Return the number of settings that were moved.
+    """
+    ids = None if settings_ids is None else [str(id_) for id_ in settings_ids]
+    if ids == []:
+        return 0
+
+    def _migrate(pipe: redis.client.Pipeline) -> int:
+        if ids is None:
+            legacy = pipe.hgetall(LEGACY_SETTINGS_KEY)
+        else:
+            legacy = dict(zip(ids, pipe.hmget(LEGACY_SETTINGS_KEY, ids)))
+        legacy = {_decode(id_): value for id_, value in legacy.items() if value is not None}
+        pipe.multi()
+        for settings_id, value in legacy.items():
+            fields, last_access = _split_legacy(json.loads(value))
+            pipe.delete(settings_key(settings_id))
+            pipe.hset(settings_key(settings_id), mapping=fields)
+            pipe.zadd(LAST_ACCESS_KEY, {settings_id: last_access})
+        if legacy:
+            pipe.hdel(LEGACY_SETTINGS_KEY, *legacy)
+            pipe.hdel(LEGACY_OWNER_KEY, *legacy)
+        return len(legacy)
+
+    return conn.transaction(_migrate, LEGACY_SETTINGS_KEY, value_from_callable=True)
+
+
+def get_fields(conn: redis.Redis, settings_id: SettingsId, *fields: str) -> List[Optional[str]]:
+    """Return the values of fields for the settings with id settings_id (None for fields that are not set)"""
+    return [_decode(v) for v in conn.hmget(settings_key(settings_id), fields)]
+
+
+def touch(conn: Union[redis.Redis, redis.client.Pipeline], settings_id: SettingsId) -> None:
+    """Record that the settings with id settings_id were used now"""
+    conn.zadd(LAST_ACCESS_KEY, {str(settings_id): int(time.time())})
+
+
+def update(conn: redis.Redis, settings_id: SettingsId, fields: Dict[str, str]) -> None:
+    """
+    Set fields for the settings with id settings_id and record that they were used now. The error field is removed
+    unless it is one of fields and recorded runtimes are discarded if the settings are changed.
+    """
+    with conn.pipeline() as pipe:
+        pipe.hset(settings_key(settings_id), mapping=fields)
+        if "error" not in fields:
+            pipe.hdel(settings_key(settings_id), "error")
+        if "settings" in fields:
+            pipe.delete(runtimes_key(settings_id))
+        touch(pipe, settings_id)
+        pipe.execute()
+
+
+def category_timeout(test_settings: Dict, categories: Iterable[str]) -> float:
+    """Return the total timeout of the tests in test_settings that are run for any of categories"""
+    categories = set(categories)
+    return sum(
+        data.get("timeout") or 0
+        for tester in test_settings.get("testers", [])
+        for data in tester.get("test_data", [])
+        if categories & set(data.get("category", []))
+    )
+
+
+def record_runtime(conn: redis.Redis, settings_id: SettingsId, runtime: float, timeout: float) -> None:
+    """Record that tests with a total timeout of timeout took runtime seconds to run for settings_id"""
+    if timeout > 0:
+        with conn.pipeline() as pipe:
+            pipe.lpush(runtimes_key(settings_id), runtime / timeout)
+            pipe.ltrim(runtimes_key(settings_id), 0, MAX_RUNTIME_SAMPLES - 1)
+            pipe.execute()
+
+
+def runtime_fractions(conn: redis.Redis, settings_id: SettingsId) -> List[float]:
+    """Return recent runtimes of settings_id as fractions of the timeouts of the tests that were run"""
+    return [float(v) for v in conn.lrange(runtimes_key(settings_id), 0, -1)]
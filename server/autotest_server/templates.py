@@ -0,0 +1,115 @@
+"""
+Templates of each test settings' files that the working directory of each test run is populated from.
+
+Instead of copying a settings' files into the working directory and setting their permissions for every test run,
+the first test run for the settings on each worker copies the files once into a template at
+<workspace>/scripts/<settings id>/templates/<files version>/<test user> with the permissions that the files need in
+the working directory. Each test run then hard links the template's files into the working directory, which takes
+about the same time however large the files are. The tests can't change the template's files through these links
+since the test user can't write to, change the permissions of or remove (from directories with the sticky bit set)
+files that it doesn't own.
+
+Files are not hard linked if the tests are run by the user that owns the template (since the tests could change them)
+or if the template and the working directory are on different file systems. Those files are cloned instead (so that
+the copy shares the template file's data until one of them is changed) on file systems that support it, and copied
+otherwise.
+
+Each time a settings' files are updated they are given a new version (the files_version field, see settings_store)
+and the templates of the previous version are removed.
+"""
+
+import os
+import uuid
+import errno
+import fcntl
+import shutil
+
+from .utils import copy_tree, recursive_iglob
+
+DEFAULT_VERSION = "0"
+DIR_MODE = 0o1770
+FILE_MODE = 0o750
+# ioctl request that makes a file share the data of another file (see ioctl_ficlone(2))
+FICLONE = 0x40049409
+LINK_ERRORS = {errno.EXDEV, errno.EPERM, errno.EMLINK}
+
+
+def templates_dir(files_dir: str) -> str:
+    """Return the directory containing the templates of the settings whose files are in files_dir"""
+    return os.path.join(os.path.dirname(files_dir), "templates")
+
+
+def template_dir(files_dir: str, version: str, test_username: str) -> str:
+    """Return the template of version of the files in files_dir for test_username"""
+    return os.path.join(templates_dir(files_dir), version, test_username)
+
+
+def remove_all(files_dir: str) -> None:
+    """Remove all templates of the files in files_dir"""
+    shutil.rmtree(templates_dir(files_dir), ignore_errors=True)
+
+
+def _set_permissions(fd: str, path: str, group: str) -> None:
+    os.chmod(path, DIR_MODE if fd == "d" else FILE_MODE)
+    shutil.chown(path, group=group)
+
+
+def build(files_dir: str, template: str, group: str) -> None:
+    """
+    Copy the files in files_dir to template (unless it exists already) and set their permissions and group. The
+    template is created under a temporary name and renamed once it is complete.
+    """
+    if os.path.isdir(template):
+        return
+    parent = os.path.dirname(template)
+    os.makedirs(parent, exist_ok=True)
+    tmp = os.path.join(parent, f".{os.path.basename(template)}.{uuid.uuid4().hex}")
+    try:
+        os.makedirs(tmp)
+        for fd, path in copy_tree(files_dir, tmp):
+            _set_permissions(fd, path, group)
+        try:
+            os.rename(tmp, template)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(template):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _clone(src: str, dst: str) -> None:
+    """Copy src to dst, sharing src's data if the file system supports it"""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def populate(template: str, destination: str, group: str, hardlink: bool = True) -> None:
+    """
+    Add the files in template to destination, replacing files that are already there. Files are hard linked if
+    hardlink is True and the file system allows it, and cloned otherwise.
+    """
+    for fd, path in recursive_iglob(template):
+        target = os.path.join(destination, os.path.relpath(path, template))
+        if fd == "d":
+            os.makedirs(target, exist_ok=True)
+            _set_permissions(fd, target, group)
+            continue
+        # unlink first so that a file that is already there isn't written to (it could be linked to a template file)
+        if os.path.lexists(target):
+            os.unlink(target)
+        if hardlink:
+            try:
+                os.link(path, target)
+                continue
+            except OSError as e:
+                if e.errno not in LINK_ERRORS:
+                    raise
+        _clone(path, target)
+        shutil.copystat(path, target)
+        shutil.chown(target, group=group)
@@ -1,4 +1,9 @@
+import getpass
+import json
+import signal
 import subprocess
+import threading
+import time
 
 import pytest
 import fakeredis
@@ -103,3 +108,103 @@ def test_tmp_remove_other_user():
     subprocess.run(touch_cmd, shell=True)
     autotest_server._clear_working_directory(autotest_worker_working_dir, autotest_worker_remover)
     assert os.path.exists(path) is True
+
+
+def test_publish_test_stream(fake_redis_conn):
+    autotest_server._publish_test_stream(1, {"result": "{}"})
+    autotest_server._publish_test_stream(1, {"done": "{}"})
+    entries = fake_redis_conn.xrange("autotest:test_stream:1")
+    assert [fields for _, fields in entries] == [{b"result": b"{}"}, {b"done": b"{}"}]
+    assert fake_redis_conn.ttl("autotest:test_stream:1") > 0
+
+
+def test_record_finished(fake_redis_conn):
+    autotest_server._record_finished(1.5)
+    autotest_server._record_finished(2)
+    keys = fake_redis_conn.keys("autotest:throughput:*")
+    assert sum(int(fake_redis_conn.get(key)) for key in keys) == 2
+    assert all(fake_redis_conn.ttl(key) > 0 for key in keys)
+    assert fake_redis_conn.lrange(autotest_server.DURATIONS_KEY, 0, -1) == [b"2", b"1.5"]
+
+
+def test_record_started(fake_redis_conn):
+    fake_redis_conn.zadd("autotest:queue_position:low", {"1": 1, "2": 2})
+    autotest_server._record_started(1)
+    assert fake_redis_conn.zrange("autotest:queue_position:low", 0, -1) == [b"2"]
+
+
+def test_get_feedback_indexed(fake_redis_conn, tmp_path):
+    (tmp_path / "feedback.txt").write_text("feedback")
+    feedback, errors = autotest_server._get_feedback({"feedback_file_names": ["feedback.txt"]}, str(tmp_path), 1)
+    assert errors == []
+    assert fake_redis_conn.smembers("autotest:feedback_files:1") == {str(feedback[0]["id"]).encode()}
+    assert fake_redis_conn.ttl("autotest:feedback_files:1") > 0
+
+
+def test_results_kept_on_job_timeout(fake_redis_conn, tmp_path, monkeypatch):
+    outputs = iter([(json.dumps({"tests": []}), None), autotest_server.JobTimeoutException("job timed out")])
+
+    def wait_for_test(proc, *_args):
+        proc.kill()
+        output = next(outputs)
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+    monkeypatch.setattr(autotest_server, "_wait_for_test", wait_for_test)
+    monkeypatch.setattr(autotest_server, "_get_env_vars", lambda _user: {})
+    test_data = [{"category": ["student"], "timeout": 5, "extra_info": {"name": name}} for name in ("a", "b", "c")]
+    settings = {"testers": [{"tester_type": "py", "test_data": test_data}]}
+    results = []
+    with pytest.raises(autotest_server.JobTimeoutException):
+        autotest_server._run_test_specs(
+            "true", settings, ["student"], str(tmp_path), getpass.getuser(), 1, {}, results=results
+        )
+    assert [result["extra_info"]["name"] for result in results] == ["a", "b"]
+    assert "job timed out" in results[1]["stderr"]
+
+
+def _sleep_proc():
+    return subprocess.Popen(
+        "cat > /dev/null; sleep 10", shell=True, start_new_session=True, stdin=subprocess.PIPE, text=True
+    )
+
+
+def test_wait_for_test_output():
+    proc = subprocess.Popen("cat", shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    assert autotest_server._wait_for_test(proc, "input", 5, 1) == ("input", None)
+
+
+def test_wait_for_test_cancelled(fake_redis_conn, monkeypatch):
+    monkeypatch.setattr(autotest_server, "CANCEL_POLL_INTERVAL", 0.1)
+    proc = _sleep_proc()
+    threading.Timer(0.2, fake_redis_conn.set, args=("autotest:cancel:1", 1)).start()
+    start = time.monotonic()
+    with pytest.raises(autotest_server.TestRunCancelled):
+        autotest_server._wait_for_test(proc, "input", 5, 1)
+    assert time.monotonic() - start < 2
+    autotest_server._kill_test_processes(proc, getpass.getuser())
+    assert proc.wait(timeout=5) == -signal.SIGKILL
+
+
+def test_wait_for_test_timeout(monkeypatch):
+    monkeypatch.setattr(autotest_server, "CANCEL_POLL_INTERVAL", 0.1)
+    proc = _sleep_proc()
+    with pytest.raises(subprocess.TimeoutExpired):
+        autotest_server._wait_for_test(proc, "input", 0.3, 1)
+    autotest_server._kill_test_processes(proc, getpass.getuser())
+
+
+def test_agent_not_used_for_current_user():
+    assert autotest_server._agent(getpass.getuser()) is None
+
+
+def test_running_forkservers(tmp_path, monkeypatch):
+    monkeypatch.setattr(autotest_server, "FORKSERVER_DIR", str(tmp_path))
+    (tmp_path / "user").mkdir()
+    start = autotest_server.process_start_time(os.getpid())
+    (tmp_path / "user" / "running.pid").write_text(f"{os.getpid()} {start}")
+    (tmp_path / "user" / "exited.pid").write_text(f"{os.getpid()} {start - 1}")
+    (tmp_path / "user" / "exited.sock").write_text("")
+    assert autotest_server._running_forkservers("user") == [(os.getpid(), start)]
+    assert os.listdir(tmp_path / "user") == ["running.pid"]
@@ -0,0 +1,100 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import fakeredis
+import pytest
+import requests
+import rq
+from rq.job import JobStatus
+
+from autotest_server import callbacks
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append((self.path, json.loads(body)))
+        self.send_response(self.server.status_code)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def callback_server():
+    server = HTTPServer(("localhost", 0), _CallbackHandler)
+    server.received = []
+    server.status_code = 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def url(callback_server):
+    return f"http://localhost:{callback_server.server_port}"
+
+
+@pytest.fixture
+def fake_redis_conn():
+    yield fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def session():
+    with requests.Session() as session:
+        yield session
+
+
+def _notifications(conn, url, test_ids, status=JobStatus.FINISHED):
+    queue = rq.Queue("batch", connection=conn)
+    for test_id in test_ids:
+        queue.enqueue_call("autotest_server.run_test", job_id=str(test_id)).set_status(status)
+        callbacks.enqueue_callback(conn, url, test_id)
+    return callbacks._pop_batch(conn, 100, 1)
+
+
+def test_notifications_batched_by_url(fake_redis_conn, session, callback_server, url):
+    notifications = _notifications(fake_redis_conn, f"{url}/a", [1, 2])
+    notifications += _notifications(fake_redis_conn, f"{url}/b", [3])
+    callbacks.deliver(fake_redis_conn, session, notifications)
+    assert sorted(callback_server.received) == [("/a", {"test_ids": [1, 2]}), ("/b", {"test_ids": [3]})]
+
+
+def test_failed_delivery_retried(fake_redis_conn, session, callback_server, url):
+    callback_server.status_code = 500
+    callbacks.deliver(fake_redis_conn, session, _notifications(fake_redis_conn, url, [1]))
+    (retry,) = fake_redis_conn.zrange(callbacks.RETRY_QUEUE, 0, -1)
+    assert json.loads(retry)["attempts"] == 1
+
+
+def test_failed_delivery_gives_up(fake_redis_conn, session, callback_server, url):
+    callback_server.status_code = 500
+    notifications = _notifications(fake_redis_conn, url, [1])
+    notifications[0]["attempts"] = callbacks.config["callbacks", "max_attempts"] - 1
+    callbacks.deliver(fake_redis_conn, session, notifications)
+    assert fake_redis_conn.zcard(callbacks.RETRY_QUEUE) == 0
+
+
+def test_unfinished_job_delayed(fake_redis_conn, session, callback_server, url):
+    callbacks.deliver(fake_redis_conn, session, _notifications(fake_redis_conn, url, [1], status=JobStatus.STARTED))
+    assert callback_server.received == []
+    assert fake_redis_conn.zcard(callbacks.RETRY_QUEUE) == 1
+
+
+def test_unfinished_job_sent_after_max_age(fake_redis_conn, session, callback_server, url):
+    notifications = _notifications(fake_redis_conn, url, [1], status=JobStatus.STARTED)
+    notifications[0]["enqueued_at"] -= callbacks.MAX_PENDING_AGE
+    callbacks.deliver(fake_redis_conn, session, notifications)
+    assert callback_server.received == [("/", {"test_ids": [1]})]
+    assert fake_redis_conn.zcard(callbacks.RETRY_QUEUE) == 0
+
+
+def test_requeue_due(fake_redis_conn, url):
+    callbacks._schedule_retry(fake_redis_conn, [{"url": url, "test_id": 1, "attempts": 1}], delay=0)
+    callbacks._requeue_due(fake_redis_conn)
+    assert callbacks._pop_batch(fake_redis_conn, 100, 1) == [{"url": url, "test_id": 1, "attempts": 1}]
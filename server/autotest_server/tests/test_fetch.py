@@ -0,0 +1,154 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from autotest_server import fetch, utils
+
+
+class _FilesHandler(BaseHTTPRequestHandler):
+    """Serve self.server.files ({path: (content, etag, last modified)}) with support for conditional requests"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        self.server.client_ports.append(self.client_address[1])
+        if self.path not in self.server.files:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        content, etag, last_modified = self.server.files[self.path]
+        not_modified = (etag and self.headers.get("If-None-Match") == etag) or (
+            not etag and last_modified and self.headers.get("If-Modified-Since") == last_modified
+        )
+        self.send_response(304 if not_modified else 200)
+        if etag:
+            self.send_header("ETag", etag)
+        if last_modified:
+            self.send_header("Last-Modified", last_modified)
+        self.send_header("Content-Length", "0" if not_modified else str(len(content)))
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def files_server():
+    server = ThreadingHTTPServer(("localhost", 0), _FilesHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.files = {}
+    server.client_ports = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def url(files_server):
+    return f"http://localhost:{files_server.server_port}"
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = fetch.FetchClient(directory=str(tmp_path), cache_size=100, connect_timeout=5, read_timeout=5, pool_size=1)
+    yield client
+    client.session.close()
+
+
+def _read(client, url, **kwargs):
+    with client.open(url, **kwargs) as f:
+        return f.read()
+
+
+class TestOpen:
+    def test_content(self, client, files_server, url):
+        files_server.files["/a"] = (b"content", None, None)
+        assert _read(client, f"{url}/a") == b"content"
+
+    def test_headers_sent(self, client, files_server, url):
+        files_server.files["/a"] = (b"content", None, None)
+        _read(client, f"{url}/a", headers={"Authorization": "test creds"})
+        assert files_server.requests[0][1]["Authorization"] == "test creds"
+
+    def test_error_status(self, client, url):
+        with pytest.raises(requests.HTTPError):
+            _read(client, f"{url}/missing")
+
+    def test_max_size(self, client, files_server, url, tmp_path):
+        files_server.files["/a"] = (b"content", '"1"', None)
+        with pytest.raises(utils.ExtractionError):
+            _read(client, f"{url}/a", max_size=3)
+        assert os.listdir(tmp_path) == []
+
+    def test_connection_reused(self, client, files_server, url):
+        files_server.files["/a"] = (b"content", None, None)
+        _read(client, f"{url}/a")
+        _read(client, f"{url}/a")
+        assert len(set(files_server.client_ports)) == 1
+
+
+class TestCache:
+    def test_etag_revalidated(self, client, files_server, url):
+        files_server.files["/a"] = (b"content", '"1"', None)
+        _read(client, f"{url}/a")
+        assert _read(client, f"{url}/a") == b"content"
+        assert files_server.requests[1][1]["If-None-Match"] == '"1"'
+
+    def test_last_modified_revalidated(self, client, files_server, url):
+        last_modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+        files_server.files["/a"] = (b"content", None, last_modified)
+        _read(client, f"{url}/a")
+        assert _read(client, f"{url}/a") == b"content"
+        assert files_server.requests[1][1]["If-Modified-Since"] == last_modified
+
+    def test_changed(self, client, files_server, url, tmp_path):
+        files_server.files["/a"] = (b"content", '"1"', None)
+        _read(client, f"{url}/a")
+        files_server.files["/a"] = (b"changed", '"2"', None)
+        assert _read(client, f"{url}/a") == b"changed"
+        assert _read(client, f"{url}/a") == b"changed"
+        assert len(os.listdir(tmp_path)) == 2
+
+    def test_not_cached_without_validators(self, client, files_server, url, tmp_path):
+        files_server.files["/a"] = (b"content", None, None)
+        _read(client, f"{url}/a")
+        _read(client, f"{url}/a")
+        assert "If-None-Match" not in files_server.requests[1][1]
+        assert os.listdir(tmp_path) == []
+
+    def test_disabled(self, files_server, url, tmp_path):
+        client = fetch.FetchClient(directory=str(tmp_path), cache_size=0)
+        files_server.files["/a"] = (b"content", '"1"', None)
+        _read(client, f"{url}/a")
+        _read(client, f"{url}/a")
+        assert "If-None-Match" not in files_server.requests[1][1]
+
+    def test_least_recently_used_evicted(self, client, files_server, url):
+        for path in ("/a", "/b", "/c"):
+            files_server.files[path] = (b"x" * 40, f'"{path}"', None)
+        _read(client, f"{url}/a")
+        _read(client, f"{url}/b")
+        _read(client, f"{url}/a")
+        _read(client, f"{url}/c")
+        files_server.requests.clear()
+        _read(client, f"{url}/a")
+        _read(client, f"{url}/b")
+        assert [path for path, headers in files_server.requests] == ["/a", "/b", "/b"]
+
+    def test_evicted_body_downloaded(self, client, files_server, url, tmp_path):
+        files_server.files["/a"] = (b"content", '"1"', None)
+        _read(client, f"{url}/a")
+        for name in os.listdir(tmp_path):
+            if not name.endswith(fetch.META_SUFFIX):
+                os.unlink(tmp_path / name)
+        assert _read(client, f"{url}/a") == b"content"
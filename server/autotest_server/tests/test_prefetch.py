@@ -0,0 +1,166 @@
+import io
+import json
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import fakeredis
+import pytest
+import rq
+from rq.job import JobStatus
+
+from autotest_server import fetch, prefetch, scheduler, utils
+
+
+class _FilesHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zf:
+            zf.writestr("submission/answer.py", f"# {self.path}\n")
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(buffer.getvalue())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def files_server():
+    server = HTTPServer(("localhost", 0), _FilesHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def conn():
+    conn = fakeredis.FakeStrictRedis()
+    conn.hset("autotest:user_credentials", "user", json.dumps({"auth_type": "test", "credentials": ""}))
+    return conn
+
+
+@pytest.fixture(autouse=True)
+def fetch_client(tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch, "_CLIENT", fetch.FetchClient(directory=str(tmp_path / "cache")))
+
+
+@pytest.fixture(autouse=True)
+def staging(tmp_path, monkeypatch):
+    staging = tmp_path / "prefetch"
+    monkeypatch.setattr(prefetch, "staging_dir", lambda: str(staging))
+    return staging
+
+
+def _enqueue(conn, files_server, test_id, queue_name="low"):
+    url = f"http://localhost:{files_server.server_port}/{test_id}"
+    kwargs = {"settings_id": 1, "test_id": test_id, "files_url": url, "user": "user"}
+    return rq.Queue(queue_name, connection=conn).enqueue_call(
+        "autotest_server.run_test", kwargs=kwargs, job_id=str(test_id)
+    )
+
+
+class TestPrefetch:
+    def test_queued_tests_staged(self, conn, files_server, staging):
+        _enqueue(conn, files_server, 1)
+        _enqueue(conn, files_server, 2, queue_name="high")
+        assert prefetch.Prefetcher(conn, lookahead=2, max_staged=10, concurrency=2).prefetch() == 2
+        assert (staging / "1" / "submission" / "answer.py").read_text() == "# /1\n"
+        assert sorted(os.listdir(staging)) == ["1", "2"]
+
+    def test_staged_files_private(self, conn, files_server, staging):
+        _enqueue(conn, files_server, 1)
+        prefetch.Prefetcher(conn, lookahead=1, max_staged=10, concurrency=1).prefetch()
+        paths = [str(staging)] + [path for _, path in utils.recursive_iglob(str(staging))]
+        assert all(os.stat(path).st_mode & 0o077 == 0 for path in paths)
+
+    def test_lookahead(self, conn, files_server, staging):
+        for i in range(3):
+            _enqueue(conn, files_server, i)
+        prefetch.Prefetcher(conn, lookahead=2, max_staged=10, concurrency=1).prefetch()
+        assert sorted(os.listdir(staging)) == ["0", "1"]
+
+    def test_max_staged(self, conn, files_server, staging):
+        for i in range(3):
+            _enqueue(conn, files_server, i)
+        prefetcher = prefetch.Prefetcher(conn, lookahead=3, max_staged=2, concurrency=1)
+        prefetcher.prefetch()
+        assert prefetcher.prefetch() == 0
+        assert sorted(os.listdir(staging)) == ["0", "1"]
+
+    def test_staged_once(self, conn, files_server):
+        _enqueue(conn, files_server, 1)
+        prefetcher = prefetch.Prefetcher(conn, lookahead=1, max_staged=10, concurrency=1)
+        prefetcher.prefetch()
+        prefetcher.prefetch()
+        assert files_server.requests == ["/1"]
+
+    def test_pending_batch_tests(self, conn, files_server, staging):
+        job = rq.Queue("batch", connection=conn).create_job(
+            "autotest_server.run_test",
+            kwargs={"files_url": f"http://localhost:{files_server.server_port}/7", "user": "user"},
+            job_id="7",
+        )
+        job.save()
+        conn.zadd(scheduler.pending_key("owner"), {"7": 7})
+        conn.sadd(scheduler.OWNERS_KEY, "owner")
+        prefetch.Prefetcher(conn, lookahead=1, max_staged=10, concurrency=1).prefetch()
+        assert os.listdir(staging) == ["7"]
+
+    def test_started_tests_skipped(self, conn, files_server, staging):
+        _enqueue(conn, files_server, 1).set_status(JobStatus.STARTED)
+        assert prefetch.Prefetcher(conn, lookahead=1, max_staged=10, concurrency=1).prefetch() == 0
+
+    def test_failed_download(self, conn, staging):
+        rq.Queue("low", connection=conn).enqueue_call(
+            "autotest_server.run_test", kwargs={"files_url": "http://localhost:1/1", "user": "user"}, job_id="1"
+        )
+        assert prefetch.Prefetcher(conn, lookahead=1, max_staged=10, concurrency=1).prefetch() == 0
+        assert os.listdir(staging) == []
+
+
+class TestPrune:
+    def test_done_tests_removed(self, conn, files_server, staging):
+        jobs = [_enqueue(conn, files_server, i) for i in range(4)]
+        prefetcher = prefetch.Prefetcher(conn, lookahead=4, max_staged=10, concurrency=1)
+        prefetcher.prefetch()
+        jobs[0].set_status(JobStatus.FINISHED)
+        jobs[1].set_status(JobStatus.CANCELED)
+        jobs[2].delete()
+        assert prefetcher.prune() == 3
+        assert os.listdir(staging) == ["3"]
+
+    def test_partial_files_removed(self, conn, staging):
+        (staging / ".1").mkdir(parents=True)
+        prefetch.Prefetcher(conn, lookahead=1, max_staged=10, concurrency=1)
+        assert os.listdir(staging) == []
+
+
+class TestClaim:
+    def test_files_moved(self, conn, files_server, staging, tmp_path):
+        _enqueue(conn, files_server, 1)
+        prefetch.Prefetcher(conn, lookahead=1, max_staged=10, concurrency=1).prefetch()
+        destination = tmp_path / "workspace"
+        destination.mkdir()
+        assert prefetch.claim(1, str(destination))
+        assert (destination / "submission" / "answer.py").read_text() == "# /1\n"
+        assert os.listdir(staging) == []
+
+    def test_not_staged(self, tmp_path):
+        assert not prefetch.claim(1, str(tmp_path))
+
+
+class TestFetchFiles:
+    def test_extracted(self, conn, files_server, tmp_path):
+        prefetch.fetch_files(conn, "user", f"http://localhost:{files_server.server_port}/1", str(tmp_path))
+        assert (tmp_path / "submission" / "answer.py").read_text() == "# /1\n"
+
+    def test_download_too_large(self, conn, files_server, tmp_path, monkeypatch):
+        monkeypatch.setitem(prefetch.config._settings, "extraction", {"max_size": 10})
+        with pytest.raises(utils.ExtractionError):
+            prefetch.fetch_files(conn, "user", f"http://localhost:{files_server.server_port}/1", str(tmp_path))
@@ -0,0 +1,214 @@
+import json
+import os
+import resource
+import signal
+import stat
+import subprocess
+import sys
+
+import pytest
+
+import autotest_server
+from autotest_server import sandbox_agent
+
+
+@pytest.fixture
+def agent(tmp_path):
+    agent = sandbox_agent.AgentClient("test", str(tmp_path / "agents" / "test.sock"), command_prefix=[])
+    yield agent
+    agent.stop()
+    agent.process.wait(timeout=5)
+
+
+def _spawn(agent, code, cwd="/", env=None, rlimits=()):
+    return agent.spawn([sys.executable, "-c", code], cwd, env or {}, list(rlimits))
+
+
+class TestSpawn:
+    def test_input_and_output(self, agent):
+        proc = _spawn(agent, "import sys; print(sys.stdin.read()); print('err', file=sys.stderr)")
+        assert proc.communicate("input", timeout=5) == ("input\n", "err\n")
+
+    def test_large_input(self, agent):
+        proc = _spawn(agent, "import sys; print(len(sys.stdin.read()))")
+        assert proc.communicate("x" * 1000000, timeout=5) == ("1000000\n", "")
+
+    def test_cwd_and_env(self, agent, tmp_path):
+        proc = _spawn(agent, "import os; print(os.getcwd(), os.environ['TEST'])", cwd=str(tmp_path), env={"TEST": "a"})
+        assert proc.communicate(timeout=5)[0] == f"{tmp_path} a\n"
+
+    def test_rlimits(self, agent):
+        limits = [(resource.RLIMIT_NOFILE, 100, 200)]
+        proc = _spawn(agent, "import resource; print(resource.getrlimit(resource.RLIMIT_NOFILE))", rlimits=limits)
+        assert proc.communicate(timeout=5)[0] == "(100, 200)\n"
+
+    def test_new_session(self, agent):
+        proc = _spawn(agent, "import os; print(os.getsid(0))")
+        assert proc.communicate(timeout=5)[0] == f"{proc.pid}\n"
+
+    def test_child_exit_status(self, agent):
+        proc = _spawn(agent, "import subprocess; print(subprocess.run(['false']).returncode)")
+        assert proc.communicate(timeout=5)[0] == "1\n"
+
+    def test_timeout(self, agent):
+        proc = _spawn(agent, "import sys, time; print('a', flush=True); time.sleep(0.5); print(sys.stdin.read())")
+        with pytest.raises(subprocess.TimeoutExpired):
+            proc.communicate("b", timeout=0.1)
+        assert proc.communicate(timeout=5) == ("a\nb\n", "")
+
+    def test_exec_error(self, agent):
+        proc = agent.spawn(["/nonexistent"], "/", {}, [])
+        assert proc.communicate(timeout=5)[1]
+
+
+class TestConnection:
+    def test_running_agent_reused(self, agent, tmp_path):
+        agent.connect()
+        agent.close()
+        other = sandbox_agent.AgentClient("test", agent.socket_path, command_prefix=[])
+        other.connect()
+        assert other.process is None
+        other.close()
+
+    def test_restarted_after_exit(self, agent):
+        agent.stop()
+        agent.process.wait(timeout=5)
+        assert _spawn(agent, "print(1)").communicate(timeout=5)[0] == "1\n"
+
+    def test_restarted_after_stop(self, agent, monkeypatch):
+        monkeypatch.setattr(sandbox_agent, "REQUEST_TIMEOUT", 0.5)
+        agent.connect()
+        stopped = agent.process
+        os.kill(stopped.pid, signal.SIGSTOP)
+        try:
+            assert _spawn(agent, "print(1)").communicate(timeout=5)[0] == "1\n"
+            assert agent.process is not stopped
+        finally:
+            stopped.kill()
+            stopped.wait(timeout=5)
+
+    def test_start_failure(self, tmp_path):
+        agent = sandbox_agent.AgentClient("test", str(tmp_path / "test.sock"), command_prefix=["false"])
+        with pytest.raises(sandbox_agent.AgentError):
+            agent.connect()
+        agent.process.wait()
+
+    def test_socket_private(self, agent):
+        agent.connect()
+        assert stat.S_IMODE(os.stat(agent.socket_path).st_mode) == 0o600
+        assert stat.S_IMODE(os.stat(os.path.dirname(agent.socket_path)).st_mode) == 0o700
+
+
+class TestClean:
+    def test_permissions(self, tmp_path):
+        workspace, tmp = tmp_path / "workspace", tmp_path / "tmp"
+        (workspace / "dir").mkdir(parents=True)
+        tmp.mkdir()
+        (workspace / "dir" / "file").write_text("")
+        (workspace / "dir" / "file").chmod(0o400)
+        (workspace / "dir").chmod(0o1700)
+        sandbox_agent._clean(str(workspace), str(tmp))
+        assert stat.S_IMODE((workspace / "dir").stat().st_mode) == 0o777
+        assert stat.S_IMODE((workspace / "dir" / "file").stat().st_mode) == 0o666
+
+    def test_tmp_files_removed(self, tmp_path):
+        tmp = tmp_path / "tmp"
+        (tmp / "dir").mkdir(parents=True)
+        (tmp / "file").write_text("")
+        sandbox_agent._clean(str(tmp_path / "workspace"), str(tmp))
+        assert os.listdir(tmp) == []
+
+
+@pytest.fixture
+def forkserver(tmp_path):
+    server = sandbox_agent.ForkserverClient(
+        "test", str(tmp_path / "forkservers" / "test.sock"), sys.executable, "custom", ["json"], command_prefix=[]
+    )
+    yield server
+    server.stop()
+    server.process.wait(timeout=5)
+
+
+@pytest.fixture
+def custom_test(tmp_path):
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    script = workspace / "test.sh"
+    script.write_text('#!/bin/sh\necho \'{"name": "test", "output": "\'"$(pwd)"\'", "status": "pass"}\'\n')
+    script.chmod(0o755)
+    return workspace, json.dumps({"test_data": {"script_files": ["test.sh"]}})
+
+
+class TestForkserver:
+    def test_same_output_as_test_script(self, forkserver, custom_test):
+        workspace, specs = custom_test
+        script = autotest_server._create_test_script("custom")
+        expected = subprocess.run(
+            [sys.executable, "-c", script], cwd=workspace, input=specs, capture_output=True, text=True, env={}
+        )
+        proc = forkserver.run(str(workspace), {}, [])
+        assert proc.communicate(specs, timeout=5) == (expected.stdout, expected.stderr)
+        assert json.loads(expected.stdout)["output"] == str(workspace)
+
+    def test_error_output(self, forkserver, tmp_path):
+        out, err = forkserver.run(str(tmp_path), {}, []).communicate("not json", timeout=5)
+        assert "JSONDecodeError" in err
+
+    def test_environment(self, forkserver, custom_test):
+        workspace, specs = custom_test
+        (workspace / "test.sh").write_text('#!/bin/sh\necho "$TEST"\n')
+        assert forkserver.run(str(workspace), {"TEST": "a"}, []).communicate(specs, timeout=5)[0] == "a\n"
+
+    def test_modules(self, forkserver):
+        modules = forkserver.modules()
+        assert {"json", "testers"} <= set(modules)
+        assert "sys" not in modules
+
+    def test_shadowed_modules(self, forkserver, custom_test):
+        workspace, _ = custom_test
+        assert not autotest_server._shadows_forkserver_modules(forkserver, str(workspace))
+        (workspace / "json").mkdir()
+        assert not autotest_server._shadows_forkserver_modules(forkserver, str(workspace))
+        (workspace / "json" / "__init__.py").write_text("")
+        assert autotest_server._shadows_forkserver_modules(forkserver, str(workspace))
+
+    def test_preloaded_once(self, tmp_path, custom_test, monkeypatch):
+        (tmp_path / "preloaded.py").write_text(
+            "import os\nos.mkdir(os.path.join(os.environ['MARKERS'], str(os.getpid())))\n"
+        )
+        (tmp_path / "markers").mkdir()
+        monkeypatch.setenv("PYTHONPATH", str(tmp_path))
+        monkeypatch.setenv("MARKERS", str(tmp_path / "markers"))
+        server = sandbox_agent.ForkserverClient(
+            "test",
+            str(tmp_path / "preload.sock"),
+            sys.executable,
+            "custom",
+            ["preloaded", "missing"],
+            command_prefix=[],
+        )
+        workspace, specs = custom_test
+        for _ in range(2):
+            server.run(str(workspace), {}, []).communicate(specs, timeout=5)
+        assert os.listdir(tmp_path / "markers") == [str(server.identity[0])]
+        server.stop()
+        server.process.wait(timeout=5)
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="processes are killed as a user with no other processes")
+def test_kill_all_keeps_processes():
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setuid(54321)
+            kept, killed = subprocess.Popen(["sleep", "60"]), subprocess.Popen(["sleep", "60"])
+            sandbox_agent._kill_all([(kept.pid, sandbox_agent.process_start_time(kept.pid)), (1, 0)])
+            os.write(w, f"{kept.poll()} {killed.wait()}".encode())
+            kept.kill()
+        finally:
+            os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as f:
+        assert f.read() == f"None {-signal.SIGKILL}"
+    os.waitpid(pid, 0)
@@ -0,0 +1,149 @@
+import time
+
+import fakeredis
+import pytest
+import rq
+from rq.job import JobStatus
+
+from autotest_server import scheduler
+
+
+@pytest.fixture
+def conn():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def queue(conn):
+    return rq.Queue(scheduler.BATCH_QUEUE, connection=conn)
+
+
+def _submit(conn, owner, n, timeout=10):
+    """Save n jobs for owner the same way the API does for a batch run"""
+    queue = rq.Queue(scheduler.BATCH_QUEUE, connection=conn)
+    start = conn.incrby("next_id", n) - n
+    ids = [f"{owner}-{i}" for i in range(start, start + n)]
+    with conn.pipeline() as pipe:
+        for id_ in ids:
+            queue.create_job("autotest_server.run_test", job_id=id_, timeout=timeout).save(pipeline=pipe)
+        pipe.zadd(scheduler.pending_key(owner), {id_: int(id_.split("-")[1]) for id_ in ids})
+        pipe.sadd(scheduler.OWNERS_KEY, owner)
+        pipe.execute()
+    return ids
+
+
+def _owners(queue):
+    return [job_id.split("-")[0] for job_id in queue.job_ids]
+
+
+class TestDispatch:
+    def test_fills_queue(self, conn, queue):
+        _submit(conn, "a", 5)
+        assert scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=3).dispatch() == 3
+        assert queue.job_ids == ["a-0", "a-1", "a-2"]
+
+    def test_does_not_overfill(self, conn, queue):
+        _submit(conn, "a", 5)
+        sched = scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=3)
+        sched.dispatch()
+        assert sched.dispatch() == 0
+
+    def test_interleaves_owners(self, conn, queue):
+        _submit(conn, "a", 10)
+        _submit(conn, "b", 3)
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=8).dispatch()
+        assert _owners(queue) == ["a", "b", "a", "b", "a", "b", "a", "a"]
+
+    def test_weights(self, conn, queue):
+        _submit(conn, "a", 10)
+        _submit(conn, "b", 10)
+        conn.hset(scheduler.WEIGHTS_KEY, "a", 2)
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=6).dispatch()
+        assert _owners(queue) == ["a", "a", "b", "a", "a", "b"]
+
+    def test_cost(self, conn, queue):
+        _submit(conn, "a", 4, timeout=20)
+        _submit(conn, "b", 4, timeout=10)
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=6).dispatch()
+        assert _owners(queue) == ["b", "a", "b", "b", "a", "b"]
+
+    def test_new_owner_served_next(self, conn, queue):
+        _submit(conn, "a", 100)
+        sched = scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=2)
+        sched.dispatch()
+        conn.delete(queue.key)
+        _submit(conn, "b", 1)
+        sched.dispatch()
+        assert "b" in _owners(queue)
+
+    def test_cancelled_jobs_skipped(self, conn, queue):
+        ids = _submit(conn, "a", 3)
+        rq.job.Job.fetch(ids[0], connection=conn).set_status(JobStatus.CANCELED)
+        rq.job.Job.fetch(ids[1], connection=conn).delete()
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=3).dispatch()
+        assert queue.job_ids == [ids[2]]
+
+    def test_dispatched_jobs_queued(self, conn, queue):
+        ids = _submit(conn, "a", 1)
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=1).dispatch()
+        job = rq.job.Job.fetch(ids[0], connection=conn)
+        assert job.get_status() == JobStatus.QUEUED
+        assert job.enqueued_at is not None
+
+    def test_owner_removed_when_done(self, conn, queue):
+        _submit(conn, "a", 2)
+        sched = scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=5)
+        sched.dispatch()
+        sched.dispatch()
+        assert not conn.exists(scheduler.OWNERS_KEY)
+        assert sched.deficits == {}
+
+    def test_usage_recorded(self, conn, queue):
+        _submit(conn, "a", 2, timeout=15)
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=5).dispatch()
+        assert float(conn.hget(scheduler.USAGE_KEY, "a")) == 30
+
+    def test_aging(self, conn, queue):
+        _submit(conn, "a", 10)
+        _submit(conn, "b", 10)
+        conn.hset(scheduler.WEIGHTS_KEY, "a", 0.01)
+        sched = scheduler.FairShareScheduler(conn, quantum=10, aging=1, max_queued=3, clock=lambda: time.time() + 99)
+        sched.dispatch()
+        assert "a" in _owners(queue)
+
+    def test_queues_job_for_each_worker(self, conn, queue):
+        _submit(conn, "a", 5)
+        for i in range(3):
+            rq.Worker([queue], connection=conn, name=f"batch-{i}").register_birth()
+        rq.Worker([rq.Queue("high", connection=conn)], connection=conn, name="high").register_birth()
+        assert scheduler.FairShareScheduler(conn, quantum=10, aging=600).dispatch() == 3
+
+    def test_woken_when_job_started(self, conn, queue):
+        conn.lpush(scheduler.STARTED_KEY, "1")
+        start = time.monotonic()
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600).wait(5)
+        assert time.monotonic() - start < 1
+        assert not conn.exists(scheduler.STARTED_KEY)
+
+
+class TestPositions:
+    def test_dispatched_jobs_added(self, conn, queue):
+        ids = _submit(conn, "a", 2)
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=1).dispatch()
+        assert conn.zrange(scheduler.position_key("batch"), 0, -1, withscores=True) == [(ids[0].encode(), 1)]
+        assert conn.zrange(scheduler.pending_key("a"), 0, -1) == [ids[1].encode()]
+
+    def test_positions_in_dispatch_order(self, conn, queue):
+        _submit(conn, "a", 2)
+        _submit(conn, "b", 2)
+        scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=4).dispatch()
+        assert [id_.decode() for id_ in conn.zrange(scheduler.position_key("batch"), 0, -1)] == queue.job_ids
+
+    def test_prune(self, conn, queue):
+        ids = _submit(conn, "a", 3)
+        sched = scheduler.FairShareScheduler(conn, quantum=10, aging=600, max_queued=3)
+        sched.dispatch()
+        rq.job.Job.fetch(ids[0], connection=conn).set_status(JobStatus.STARTED)
+        rq.job.Job.fetch(ids[1], connection=conn).delete()
+        assert sched.prune_positions() == 2
+        assert conn.zrange(scheduler.position_key("batch"), 0, -1) == [ids[2].encode()]
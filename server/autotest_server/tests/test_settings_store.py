@@ -0,0 +1,87 @@
+import os
+import json
+import fakeredis
+import pytest
+
+from autotest_server import settings_store
+
+
+@pytest.fixture
+def conn():
+    yield fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def legacy(conn):
+    for i in (1, 2):
+        settings = {"_user": f"user{i}", "_env_status": "ready", "_files": f"/files/{i}", "testers": []}
+        if i == 1:
+            settings["_last_access"] = 100
+        conn.hset(settings_store.LEGACY_SETTINGS_KEY, key=i, value=json.dumps(settings))
+        conn.hset(settings_store.LEGACY_OWNER_KEY, key=i, value=f"user{i}")
+
+
+def test_migrate_all(conn, legacy):
+    assert settings_store.migrate(conn) == 2
+    assert conn.hgetall(settings_store.settings_key(1)) == {
+        b"user": b"user1",
+        b"status": b"ready",
+        b"files": b"/files/1",
+        b"settings": b'{"testers": []}',
+    }
+    assert conn.zrange(settings_store.LAST_ACCESS_KEY, 0, -1, withscores=True) == [(b"2", 0), (b"1", 100)]
+    assert not conn.exists(settings_store.LEGACY_SETTINGS_KEY, settings_store.LEGACY_OWNER_KEY)
+
+
+def test_migrate_some(conn, legacy):
+    assert settings_store.migrate(conn, [2, 3]) == 1
+    assert conn.hkeys(settings_store.LEGACY_SETTINGS_KEY) == [b"1"]
+
+
+def test_get_fields_does_not_migrate(conn, legacy):
+    assert settings_store.get_fields(conn, 1, "user") == [None]
+    assert conn.hexists(settings_store.LEGACY_SETTINGS_KEY, 1)
+
+
+def test_get_fields_missing(conn):
+    assert settings_store.get_fields(conn, 1, "user") == [None]
+
+
+def test_update(conn):
+    conn.hset(settings_store.settings_key(1), mapping={"user": "user1", "error": "expired"})
+    settings_store.update(conn, 1, {"status": "ready"})
+    assert conn.hgetall(settings_store.settings_key(1)) == {b"user": b"user1", b"status": b"ready"}
+    assert conn.zscore(settings_store.LAST_ACCESS_KEY, "1")
+
+
+def test_update_settings_discards_runtimes(conn):
+    settings_store.record_runtime(conn, 1, 5, 10)
+    settings_store.update(conn, 1, {"status": "ready"})
+    assert settings_store.runtime_fractions(conn, 1) == [0.5]
+    settings_store.update(conn, 1, {"settings": "{}"})
+    assert settings_store.runtime_fractions(conn, 1) == []
+
+
+def test_category_timeout():
+    test_data = [{"timeout": 10, "category": ["a"]}, {"timeout": 20, "category": ["a", "b"]}, {"timeout": 40}]
+    test_settings = {"testers": [{"test_data": test_data}, {"test_data": [{"timeout": 80, "category": ["b"]}]}]}
+    assert settings_store.category_timeout(test_settings, ["a"]) == 30
+    assert settings_store.category_timeout(test_settings, ["a", "b"]) == 110
+    assert settings_store.category_timeout(test_settings, []) == 0
+
+
+def test_record_runtime(conn, monkeypatch):
+    monkeypatch.setattr(settings_store, "MAX_RUNTIME_SAMPLES", 2)
+    for runtime in (1, 2, 3):
+        settings_store.record_runtime(conn, 1, runtime, 4)
+    settings_store.record_runtime(conn, 1, 1, 0)
+    assert settings_store.runtime_fractions(conn, 1) == [0.75, 0.5]
+
+
+def test_client_copy_identical():
+    repo = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(settings_store.__file__))))
+    client_copy = os.path.join(repo, "client", "autotest_client", "settings_store.py")
+    if not os.path.isfile(client_copy):
+        pytest.skip("the client is not in this checkout")
+    with open(client_copy) as f, open(settings_store.__file__) as g:
+        assert f.read() == g.read()
@@ -0,0 +1,79 @@
+import grp
+import os
+import stat
+
+import pytest
+
+from autotest_server import templates
+
+
+@pytest.fixture
+def group():
+    return grp.getgrgid(os.getgid()).gr_name
+
+
+@pytest.fixture
+def files_dir(tmp_path):
+    files_dir = tmp_path / "settings" / "files"
+    (files_dir / "data").mkdir(parents=True)
+    (files_dir / "test.py").write_text("test")
+    (files_dir / "data" / "input.txt").write_text("input")
+    return files_dir
+
+
+@pytest.fixture
+def template(files_dir, group):
+    template = templates.template_dir(str(files_dir), "1", "user")
+    templates.build(str(files_dir), template, group)
+    return template
+
+
+class TestBuild:
+    def test_files_copied(self, template):
+        assert open(os.path.join(template, "data", "input.txt")).read() == "input"
+
+    def test_permissions(self, template):
+        assert stat.S_IMODE(os.stat(os.path.join(template, "data")).st_mode) == templates.DIR_MODE
+        assert stat.S_IMODE(os.stat(os.path.join(template, "test.py")).st_mode) == templates.FILE_MODE
+
+    def test_existing_template_kept(self, files_dir, template, group):
+        (files_dir / "test.py").write_text("changed")
+        templates.build(str(files_dir), template, group)
+        assert open(os.path.join(template, "test.py")).read() == "test"
+        assert os.listdir(os.path.dirname(template)) == ["user"]
+
+    def test_empty_files_dir(self, tmp_path, group):
+        (tmp_path / "files").mkdir()
+        template = templates.template_dir(str(tmp_path / "files"), "1", "user")
+        templates.build(str(tmp_path / "files"), template, group)
+        assert os.listdir(template) == []
+
+    def test_remove_all(self, files_dir, template):
+        templates.remove_all(str(files_dir))
+        assert not os.path.exists(templates.templates_dir(str(files_dir)))
+        assert files_dir.exists()
+
+
+class TestPopulate:
+    @pytest.mark.parametrize("hardlink", [True, False])
+    def test_files_added(self, template, group, tmp_path, hardlink):
+        destination = tmp_path / "workspace"
+        destination.mkdir()
+        templates.populate(template, str(destination), group, hardlink=hardlink)
+        assert (destination / "data" / "input.txt").read_text() == "input"
+        assert stat.S_IMODE((destination / "data").stat().st_mode) == templates.DIR_MODE
+        assert stat.S_IMODE((destination / "test.py").stat().st_mode) == templates.FILE_MODE
+
+    def test_hardlinked(self, template, group, tmp_path):
+        templates.populate(template, str(tmp_path), group)
+        assert os.path.samefile(tmp_path / "test.py", os.path.join(template, "test.py"))
+
+    def test_copied(self, template, group, tmp_path):
+        templates.populate(template, str(tmp_path), group, hardlink=False)
+        assert not os.path.samefile(tmp_path / "test.py", os.path.join(template, "test.py"))
+
+    def test_existing_file_replaced(self, template, group, tmp_path):
+        os.link(os.path.join(template, "test.py"), tmp_path / "test.py")
+        templates.populate(template, str(tmp_path), group, hardlink=False)
+        (tmp_path / "test.py").write_text("changed")
+        assert open(os.path.join(template, "test.py")).read() == "test"
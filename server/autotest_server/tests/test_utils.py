@@ -0,0 +1,66 @@
+import grp
+import io
+import os
+import stat
+import zipfile
+
+import pytest
+
+from autotest_server import utils
+
+
+def _zip(files, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=compression) as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    buffer.seek(0)
+    return buffer
+
+
+class TestExtractZipStream:
+    def test_extracts_files(self, tmp_path):
+        utils.extract_zip_stream(_zip({"a.txt": "a", "dir/b.txt": "b", "empty/": ""}), str(tmp_path))
+        assert (tmp_path / "a.txt").read_text() == "a"
+        assert (tmp_path / "dir" / "b.txt").read_text() == "b"
+        assert (tmp_path / "empty").is_dir()
+
+    def test_accepts_bytes(self, tmp_path):
+        utils.extract_zip_stream(_zip({"a.txt": "a"}).getvalue(), str(tmp_path))
+        assert (tmp_path / "a.txt").read_text() == "a"
+
+    def test_sets_mode_and_group(self, tmp_path):
+        group = grp.getgrgid(os.getgid()).gr_name
+        utils.extract_zip_stream(_zip({"dir/b.txt": "b"}), str(tmp_path), mode=0o750, group=group)
+        for path in (tmp_path / "dir", tmp_path / "dir" / "b.txt"):
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o750
+            assert os.stat(path).st_gid == os.getgid()
+
+    def test_max_files(self, tmp_path):
+        with pytest.raises(utils.ExtractionError):
+            utils.extract_zip_stream(_zip({"a": "a", "b": "b"}), str(tmp_path), max_files=1)
+        assert os.listdir(tmp_path) == []
+
+    def test_max_size(self, tmp_path):
+        with pytest.raises(utils.ExtractionError):
+            utils.extract_zip_stream(_zip({"a": "a" * 10, "b": "b" * 10}), str(tmp_path), max_size=15)
+
+    def test_max_ratio(self, tmp_path):
+        content = b"\0" * (utils.RATIO_CHECK_MIN_SIZE + 1)
+        with pytest.raises(utils.ExtractionError):
+            utils.extract_zip_stream(_zip({"bomb": content}), str(tmp_path), max_ratio=100)
+
+    def test_small_files_ratio_ignored(self, tmp_path):
+        utils.extract_zip_stream(_zip({"a": b"\0" * 1000}), str(tmp_path), max_ratio=2)
+        assert (tmp_path / "a").stat().st_size == 1000
+
+    def test_path_outside_destination(self, tmp_path):
+        destination = tmp_path / "destination"
+        destination.mkdir()
+        with pytest.raises(utils.ExtractionError):
+            utils.extract_zip_stream(_zip({"../escaped": "a"}), str(destination))
+        assert not (tmp_path / "escaped").exists()
+
+    def test_invalid_zip(self, tmp_path):
+        with pytest.raises(utils.ExtractionError):
+            utils.extract_zip_stream(b"not a zip file", str(tmp_path))
@@ -1,13 +1,16 @@
+import grp
 import json
 import resource
 import os
 import zipfile
 import shutil
 from io import BytesIO
-from typing import Type, Optional, Tuple, List, Generator
+from typing import Type, Optional, Tuple, List, Generator, Union, BinaryIO
 from .config import config
 
 RLIMIT_ADJUSTMENTS = {"nproc": 10}
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+RATIO_CHECK_MIN_SIZE = 1024 * 1024
 
 
 def loads_partial_json(json_string: str, expected_type: Optional[Type] = None) -> Tuple[List, bool]:
@@ -45,14 +48,15 @@ def _rlimit_str2int(rlimit_string):
     return getattr(resource, f"RLIMIT_{rlimit_string.upper()}")
 
 
-def set_rlimits_before_test() -> None:
+def rlimits_for_tests() -> List[Tuple[int, int, int]]:
     """
-    Sets rlimit settings specified in config file
+    Return the (limit, soft, hard) rlimit settings for test processes from the settings specified in config file
     This function ensures that for specific limits (defined in RLIMIT_ADJUSTMENTS),
     there are at least n=RLIMIT_ADJUSTMENTS[limit] resources available for cleanup
     processes that are not available for test processes.  This ensures that cleanup
     processes will always be able to run.
     """
+    rlimits = []
     for limit_str in config.get("rlimit_settings", {}).keys() | RLIMIT_ADJUSTMENTS.keys():
         limit = _rlimit_str2int(limit_str)
         config_soft, config_hard = config.get("rlimit_settings", {}).get(limit_str, resource.getrlimit(limit))
@@ -69,24 +73,94 @@ def set_rlimits_before_test() -> None:
             hard -= adj
         # make sure the soft limit doesn't exceed the hard limit
         soft = min(hard, soft)
+        rlimits.append((limit, soft, hard))
+    return rlimits
+
+
+def set_rlimits_before_test() -> None:
+    """
+    Sets rlimit settings for test processes (see rlimits_for_tests)
+    """
+    for limit, soft, hard in rlimits_for_tests():
         resource.setrlimit(limit, (soft, hard))
 
 
-def extract_zip_stream(zip_byte_stream: bytes, destination: str) -> None:
+class ExtractionError(Exception):
+    """Raised when a zip archive is not extracted because it exceeds the configured limits or is malformed"""
+
+
+def _check_zip_limits(
+    infos: List[zipfile.ZipInfo], max_size: Optional[int], max_files: Optional[int], max_ratio: Optional[float]
+) -> None:
     """
-    Extract files in a zip archive's content <zip_byte_stream> to <destination>, a path to a local directory.
+    Raise an ExtractionError if extracting the zip archive members in infos would write more than max_size bytes or
+    more than max_files files, if any member larger than RATIO_CHECK_MIN_SIZE bytes is compressed more than max_ratio
+    times or if any member would be written outside of the destination directory.
+    """
+    max_size = config["extraction", "max_size"] if max_size is None else max_size
+    max_files = config["extraction", "max_files"] if max_files is None else max_files
+    max_ratio = config["extraction", "max_ratio"] if max_ratio is None else max_ratio
+    if len(infos) > max_files:
+        raise ExtractionError(f"zip archive contains more than {max_files} files")
+    if sum(info.file_size for info in infos) > max_size:
+        raise ExtractionError(f"zip archive contents are larger than {max_size} bytes")
+    for info in infos:
+        # small files are allowed to compress well, they can't use up much space anyway
+        if info.file_size > RATIO_CHECK_MIN_SIZE and info.file_size > max_ratio * max(info.compress_size, 1):
+            raise ExtractionError(f"{info.filename} is compressed more than {max_ratio} times")
+        if os.path.isabs(info.filename) or ".." in info.filename.split("/"):
+            raise ExtractionError(f"{info.filename} is outside of the extraction directory")
+
+
+def _set_permissions(path_or_fd: Union[str, int], mode: Optional[int], gid: Optional[int]) -> None:
+    if mode is not None:
+        os.chmod(path_or_fd, mode)
+    if gid is not None:
+        os.chown(path_or_fd, -1, gid)
+
+
+def extract_zip_stream(
+    zip_stream: Union[bytes, BinaryIO],
+    destination: str,
+    mode: Optional[int] = None,
+    group: Optional[str] = None,
+    max_size: Optional[int] = None,
+    max_files: Optional[int] = None,
+    max_ratio: Optional[float] = None,
+) -> None:
+    """
+    Extract files in a zip archive <zip_stream> (a seekable file object or the archive's content) to <destination>, a
+    path to a local directory. Members are extracted in chunks so that large files are never held in memory.
+
+    If mode or group are given, the permissions or group ownership of each file and directory are set as it is
+    created. The limits default to the values in the extraction settings, an ExtractionError is raised before
+    anything is extracted if they are exceeded.
     """
-    with zipfile.ZipFile(BytesIO(zip_byte_stream)) as zf:
-        for fname in zf.namelist():
-            *dpaths, bname = fname.split(os.sep)
-            dest = os.path.join(destination, *dpaths)
-            filename = os.path.join(dest, bname)
-            if filename.endswith("/"):
-                os.makedirs(filename, exist_ok=True)
-            else:
-                os.makedirs(dest, exist_ok=True)
-                with open(filename, "wb") as f:
-                    f.write(zf.read(fname))
+    if isinstance(zip_stream, bytes):
+        zip_stream = BytesIO(zip_stream)
+    gid = grp.getgrnam(group).gr_gid if group is not None else None
+    try:
+        zf = zipfile.ZipFile(zip_stream)
+    except zipfile.BadZipFile as e:
+        raise ExtractionError(f"invalid zip archive: {e}") from e
+    with zf:
+        infos = zf.infolist()
+        _check_zip_limits(infos, max_size, max_files, max_ratio)
+        created = set()
+        for info in infos:
+            *dpaths, bname = info.filename.split("/")
+            dest = destination
+            for dpath in dpaths:
+                dest = os.path.join(dest, dpath)
+                if dest not in created:
+                    os.makedirs(dest, exist_ok=True)
+                    _set_permissions(dest, mode, gid)
+                    created.add(dest)
+            if not bname:
+                continue
+            with zf.open(info) as src, open(os.path.join(dest, bname), "wb") as dst:
+                _set_permissions(dst.fileno(), mode, gid)
+                shutil.copyfileobj(src, dst, EXTRACT_CHUNK_SIZE)
 
 
 def recursive_iglob(root_dir: str) -> Generator[Tuple[str, str], None, None]:
@@ -0,0 +1,125 @@
+"""
+Simulation of how batch test runs from different owners share the workers.
+
+Runs a scenario against a fake redis database (requires fakeredis) in simulated time, once with every batch added
+straight to the rq batch queue (first come, first served) and once through the fair-share scheduler, and reports how
+long each owner's tests waited to start and how long each batch took to finish.
+
+Run it from the server directory with the autotester's configuration available (as for start_stop.py). The default
+scenario is one course submitting a large batch, followed shortly after by two smaller courses:
+
+    python benchmarks/fair_share.py --workers 4 --batch a:1200:30 --batch b:50:30@60 --batch c:20:60@120
+
+Each --batch is owner:tests:seconds per test[@seconds after the start of the simulation][*weight].
+"""
+
+import argparse
+import heapq
+import os
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import fakeredis
+import rq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autotest_server import scheduler  # noqa: E402
+
+
+def _parse_batch(value):
+    value, _, weight = value.partition("*")
+    value, _, arrival = value.partition("@")
+    owner, tests, runtime = value.split(":")
+    return owner, int(tests), float(runtime), float(arrival or 0), float(weight or 1)
+
+
+def _submit(conn, owner, n_tests, runtime, created_at, fair_share):
+    """Save a batch the same way the API does (with the same timeout estimate) and return the ids of its jobs"""
+    queue = rq.Queue(scheduler.BATCH_QUEUE, connection=conn)
+    last_id = conn.incrby("autotest:tests_id", n_tests)
+    ids = [str(i) for i in range(last_id - n_tests + 1, last_id + 1)]
+    with conn.pipeline() as pipe:
+        jobs = [queue.create_job("autotest_server.run_test", job_id=id_, timeout=int(runtime * 1.5)) for id_ in ids]
+        for job in jobs:
+            job.created_at = datetime.fromtimestamp(created_at, timezone.utc)
+            job.save(pipeline=pipe)
+        if fair_share:
+            pipe.zadd(scheduler.pending_key(owner), {id_: int(id_) for id_ in ids})
+            pipe.sadd(scheduler.OWNERS_KEY, owner)
+        else:
+            pipe.rpush(queue.key, *ids)
+        pipe.execute()
+    return ids
+
+
+def simulate(batches, workers, fair_share, quantum, aging):
+    """Return {owner: [(submitted, started, finished), ...]} in simulated seconds"""
+    conn = fakeredis.FakeStrictRedis()
+    queue = rq.Queue(scheduler.BATCH_QUEUE, connection=conn)
+    start = time.time()
+    now = 0.0
+    # register the workers so that the scheduler keeps as many jobs queued as it would in production
+    for i in range(workers):
+        rq.Worker([queue], connection=conn, name=f"worker-{i}").register_birth()
+    sched = scheduler.FairShareScheduler(conn, quantum=quantum, aging=aging, clock=lambda: start + now)
+    for owner, _, _, _, weight in batches:
+        conn.hset(scheduler.WEIGHTS_KEY, owner, weight)
+
+    arrivals = sorted((arrival, owner, n, runtime) for owner, n, runtime, arrival, _ in batches)
+    jobs = {}
+    running = []  # heap of (finish time, job id)
+    timings = defaultdict(list)
+    while arrivals or running or jobs:
+        while arrivals and arrivals[0][0] <= now:
+            _, owner, n, runtime = arrivals.pop(0)
+            for id_ in _submit(conn, owner, n, runtime, start + now, fair_share):
+                jobs[id_] = (owner, runtime, now)
+        while running and running[0][0] <= now:
+            heapq.heappop(running)
+        if fair_share:
+            # the scheduler is woken up whenever a worker starts a job, and on every arrival
+            sched.dispatch()
+        while len(running) < workers and (job_id := conn.lpop(queue.key)) is not None:
+            owner, runtime, submitted = jobs.pop(job_id.decode())
+            heapq.heappush(running, (now + runtime, job_id))
+            timings[owner].append((submitted, now, now + runtime))
+        next_events = [running[0][0]] if running else []
+        next_events.extend(arrival for arrival, *_ in arrivals[:1])
+        if not next_events:
+            break
+        now = min(next_events)
+    return timings
+
+
+def _report(timings):
+    print(f"{'owner':>8} {'tests':>6} {'first start':>12} {'median wait':>12} {'max wait':>10} {'batch done':>11}")
+    for owner, runs in sorted(timings.items()):
+        submitted = runs[0][0]
+        waits = [started - submitted for submitted, started, _ in runs]
+        print(
+            f"{owner:>8} {len(runs):>6} {min(waits):>11.0f}s {statistics.median(waits):>11.0f}s {max(waits):>9.0f}s "
+            f"{max(finished for _, _, finished in runs) - submitted:>10.0f}s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch", type=_parse_batch, action="append", help="owner:tests:seconds[@arrival][*weight]")
+    parser.add_argument("--quantum", type=float, default=60)
+    parser.add_argument("--aging", type=float, default=600)
+    args = parser.parse_args()
+    batches = args.batch or [_parse_batch(b) for b in ("a:1200:30", "b:50:30@60", "c:20:60@120")]
+
+    for fair_share in (False, True):
+        print("fair share:" if fair_share else "first come, first served:")
+        _report(simulate(batches, args.workers, fair_share, args.quantum, args.aging))
+        print()
+
+
+if __name__ == "__main__":
+    main()
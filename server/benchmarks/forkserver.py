@@ -0,0 +1,118 @@
+"""
+Comparison of the time it takes to run a test group with and without a forkserver.
+
+Runs the same pytest test group (a file with a few trivial tests) with the python tester a number of times, once by
+starting the test script with bash the way workers do without a forkserver, and once through a forkserver, and
+reports the latency of each test group (from starting it to reading all of its output). Both run as the current user
+with the python running this script, so pytest must be installed.
+
+Run it from the server directory with the autotester's configuration available (as for start_stop.py):
+
+    python benchmarks/forkserver.py --runs 20 --tests 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import autotest_server  # noqa: E402
+from autotest_server.sandbox_agent import ForkserverClient  # noqa: E402
+
+
+def _write_tests(directory, n_tests):
+    with open(os.path.join(directory, "test_benchmark.py"), "w") as f:
+        for i in range(n_tests):
+            f.write(f"def test_{i}():\n    assert {i} == {i}\n\n")
+    return json.dumps(
+        {"test_data": {"script_files": ["test_benchmark.py"], "tester": "pytest", "output_verbosity": "short"}}
+    )
+
+
+def _run_script(directory, specs):
+    proc = subprocess.Popen(
+        autotest_server._create_test_script_command("py"),
+        shell=True,
+        executable="/bin/bash",
+        cwd=directory,
+        env={**os.environ, "PYTHON": sys.executable},
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        start_new_session=True,
+    )
+    return proc.communicate(specs)
+
+
+def _run_forkserver(server, directory, specs):
+    return server.run(directory, {**os.environ, "PYTHON": sys.executable}, []).communicate(specs)
+
+
+def _time(run, runs):
+    """Return the duration in seconds of each call to run and the output of the last one"""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = run()
+        durations.append(time.perf_counter() - start)
+    return durations, output
+
+
+def _report(name, durations):
+    print(
+        f"{name:>12}: mean {statistics.mean(durations) * 1000:8.1f}ms  "
+        f"median {statistics.median(durations) * 1000:8.1f}ms  max {max(durations) * 1000:8.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20, help="the number of times each test group is run")
+    parser.add_argument("--tests", type=int, default=5, help="the number of tests in the test group")
+    parser.add_argument("--preload", nargs="*", default=[], help="other modules for the forkserver to import")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        workspace = os.path.join(directory, "workspace")
+        os.mkdir(workspace)
+        specs = _write_tests(workspace, args.tests)
+
+        script_durations, script_output = _time(lambda: _run_script(workspace, specs), args.runs)
+
+        server = ForkserverClient(
+            "benchmark",
+            os.path.join(directory, "forkserver.sock"),
+            sys.executable,
+            "py",
+            args.preload,
+            command_prefix=[],
+        )
+        start = time.perf_counter()
+        server.connect()
+        startup = time.perf_counter() - start
+        try:
+            forkserver_durations, forkserver_output = _time(
+                lambda: _run_forkserver(server, workspace, specs), args.runs
+            )
+        finally:
+            server.stop()
+            server.process.wait()
+
+    _report("test script", script_durations)
+    _report("forkserver", forkserver_durations)
+    print(f"forkserver startup (once per tester environment): {startup * 1000:.1f}ms")
+    if [json.loads(line)["status"] for line in script_output[0].splitlines()] != [
+        json.loads(line)["status"] for line in forkserver_output[0].splitlines()
+    ]:
+        print("the test results differ:", script_output, forkserver_output, sep="\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import pwd
 import os
 import grp
 import json
+import hashlib
 import subprocess
 import getpass
 import redis
@@ -69,7 +70,11 @@ def install_all_testers():
         skeleton = json.load(f)
         skeleton["definitions"]["installed_testers"]["enum"] = list(settings.keys())
         skeleton["definitions"]["tester_schemas"]["oneOf"] = list(settings.values())
-        REDIS_CONNECTION.set("autotest:schema", json.dumps(skeleton))
+        schema = json.dumps(skeleton)
+        with REDIS_CONNECTION.pipeline() as pipe:
+            pipe.set("autotest:schema", schema)
+            pipe.set("autotest:schema_version", hashlib.sha256(schema.encode()).hexdigest())
+            pipe.execute()
 
 
 def install():
@@ -1,5 +1,4 @@
 import argparse
-import json
 import os
 import shutil
 import time
@@ -8,6 +7,7 @@ import sys
 import signal
 import subprocess
 from autotest_server.config import config
+from autotest_server import scheduler, settings_store
 
 _THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 _PID_FILE = os.path.join(_THIS_DIR, "supervisord.pid")
@@ -43,6 +43,45 @@ killasgroup=true
 
 """
 
+CALLBACK_CONTENT = """[program:callback_delivery]
+command={python} -m autotest_server.callbacks
+process_name=callback_delivery
+numprocs=1
+directory={directory}
+stopsignal=TERM
+autostart=true
+autorestart=true
+stopasgroup=true
+killasgroup=true
+
+"""
+
+SCHEDULER_CONTENT = """[program:fair_share_scheduler]
+command={python} -m autotest_server.scheduler
+process_name=fair_share_scheduler
+numprocs=1
+directory={directory}
+stopsignal=TERM
+autostart=true
+autorestart=true
+stopasgroup=true
+killasgroup=true
+
+"""
+
+PREFETCH_CONTENT = """[program:prefetch]
+command={python} -m autotest_server.prefetch
+process_name=prefetch
+numprocs=1
+directory={directory}
+stopsignal=TERM
+autostart=true
+autorestart=true
+stopasgroup=true
+killasgroup=true
+
+"""
+
 REDIS_CONNECTION = redis.Redis.from_url(config["redis_url"], decode_responses=True)
 
 
@@ -59,9 +98,13 @@ def create_enqueuer_wrapper(rq):
                 directory=os.path.dirname(os.path.realpath(__file__)),
             )
             f.write(c)
+        f.write(CALLBACK_CONTENT.format(python=sys.executable, directory=os.path.dirname(os.path.realpath(__file__))))
+        f.write(SCHEDULER_CONTENT.format(python=sys.executable, directory=os.path.dirname(os.path.realpath(__file__))))
+        f.write(PREFETCH_CONTENT.format(python=sys.executable, directory=os.path.dirname(os.path.realpath(__file__))))
 
 
 def start(rq, supervisord, extra_args):
+    settings_store.migrate(REDIS_CONNECTION)
     create_enqueuer_wrapper(rq)
     subprocess.run([supervisord, "-c", _CONF_FILE, *extra_args], check=True, cwd=_THIS_DIR)
 
@@ -77,23 +120,41 @@ def stop():
 
 def stat(rq, extra_args):
     subprocess.run([rq, "info", "--url", config["redis_url"], *extra_args], check=True)
+    usage = REDIS_CONNECTION.hgetall(scheduler.USAGE_KEY)
+    for owner in sorted(REDIS_CONNECTION.smembers(scheduler.OWNERS_KEY) | set(usage)):
+        pending = REDIS_CONNECTION.zcard(scheduler.pending_key(owner))
+        print(f"{owner}: {pending} batch tests waiting, {float(usage.get(owner, 0)):.0f} worker seconds dispatched")
 
 
 def clean(age, dry_run):
-    for settings_id, settings in dict(REDIS_CONNECTION.hgetall("autotest:settings") or {}).items():
-        settings = json.loads(settings)
-        last_access_timestamp = settings.get("_last_access")
-        access = int(time.time() - (last_access_timestamp or 0))
-        if last_access_timestamp is None or (access > (age * SECONDS_PER_DAY)):
-            dir_path = os.path.join(config["workspace"], "scripts", str(settings_id))
-            if dry_run and os.path.isdir(dir_path):
-                last_access = "UNKNOWN" if last_access_timestamp is None else access // SECONDS_PER_DAY
+    settings_store.migrate(REDIS_CONNECTION)
+    now = time.time()
+    expired = REDIS_CONNECTION.zrangebyscore(
+        settings_store.LAST_ACCESS_KEY, "-inf", now - age * SECONDS_PER_DAY, withscores=True
+    )
+    for settings_id, last_access_timestamp in expired:
+        dir_path = os.path.join(config["workspace"], "scripts", str(settings_id))
+        if dry_run:
+            if os.path.isdir(dir_path):
+                # settings migrated from the legacy layout without an access time have a score of 0
+                last_access = (
+                    "UNKNOWN" if not last_access_timestamp else int(now - last_access_timestamp) // SECONDS_PER_DAY
+                )
                 print(f"{dir_path} -> last accessed {last_access or '< 1'} days ago")
-            else:
-                settings["_error"] = "the settings for this test have expired, please re-upload the settings."
-                REDIS_CONNECTION.hset("autotest:settings", key=settings_id, value=json.dumps(settings))
-                if os.path.isdir(dir_path):
-                    shutil.rmtree(dir_path)
+        else:
+            with REDIS_CONNECTION.pipeline() as pipe:
+                pipe.hset(
+                    settings_store.settings_key(settings_id),
+                    mapping={
+                        "error": "the settings for this test have expired, please re-upload the settings.",
+                        "status": "error",
+                    },
+                )
+                pipe.zrem(settings_store.LAST_ACCESS_KEY, settings_id)
+                pipe.delete(settings_store.runtimes_key(settings_id))
+                pipe.execute()
+            if os.path.isdir(dir_path):
+                shutil.rmtree(dir_path)
 
 
 def _exec_type(path):